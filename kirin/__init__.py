@@ -92,6 +92,11 @@ redis_client = Redis(
 # activate a command
 import kirin.command.load_realtime
 import kirin.command.piv_worker
+import kirin.command.build_schedule_snapshot
+import kirin.command.dispatch_outbox
+import kirin.command.real_time_update_partitions
+import kirin.command.retention_worker
+import kirin.command.migrate_stop_time_update_storage
 
 from kirin.core import model
 
@@ -0,0 +1,85 @@
+# coding=utf-8
+
+# Copyright (c) 2001, Canal TP and/or its affiliates. All rights reserved.
+#
+# This file is part of Navitia,
+#     the software to build cool stuff with public transport.
+#
+# Hope you'll enjoy and contribute to this project,
+#     powered by Canal TP (www.canaltp.fr).
+# Help us simplify mobility and open public transport:
+#     a non ending quest to the responsive locomotion way of traveling!
+#
+# LICENCE: This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Stay tuned using
+# twitter @navitia
+# [matrix] channel #navitia:matrix.org (https://app.element.io/#/room/#navitia:matrix.org)
+# https://groups.google.com/d/forum/navitia
+# www.navitia.io
+
+
+from __future__ import absolute_import, print_function, unicode_literals, division
+
+import logging
+import os
+import time
+
+from kirin import manager
+from kirin.core.contributor_registry import contributor_registry
+from kirin.core.navitia_referential import NavitiaReferential
+from kirin.core.schedule_snapshot import get_schedule_snapshot_path, write_schedule_snapshot
+from kirin.core.vj_prefetcher import VehicleJourneyPrefetcher
+
+
+@manager.command
+def build_schedule_snapshot(contributor_id):
+    """
+    Write the base-schedule snapshot (VJs and stop_points) of the contributor's coverage
+    in NAVITIA_SCHEDULE_SNAPSHOT_DIR, to be memory-mapped by all kirin processes of the host
+    """
+    logger = logging.getLogger(__name__)
+    start = time.time()
+    contributor = contributor_registry.get(contributor_id)
+    if contributor is None:
+        logger.error("contributor %s not found", contributor_id)
+        return
+    path = get_schedule_snapshot_path(contributor.id)
+    if path is None:
+        logger.error("NAVITIA_SCHEDULE_SNAPSHOT_DIR is not set")
+        return
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+
+    prefetcher = VehicleJourneyPrefetcher(contributor)
+    publication_date = prefetcher.navitia.get_publication_date()
+    prefetcher.build(prefetcher.get_window_start(), publication_date)
+    referential = NavitiaReferential(prefetcher.navitia)
+    try:
+        referential.load(publication_date)
+    except Exception as e:
+        logger.error("impossible to load stop_points of coverage %s: %s", contributor.navitia_coverage, e)
+        return
+
+    nb_entries = write_schedule_snapshot(
+        path, contributor.navitia_coverage, prefetcher.index, referential.stop_points_by_stop_area_code
+    )
+    logger.info(
+        "schedule snapshot of contributor %s written in %s: %s entries, %s bytes, in %.2f s",
+        contributor.id,
+        path,
+        nb_entries,
+        os.path.getsize(path),
+        time.time() - start,
+    )
@@ -0,0 +1,60 @@
+# coding=utf-8
+
+# Copyright (c) 2001, Canal TP and/or its affiliates. All rights reserved.
+#
+# This file is part of Navitia,
+#     the software to build cool stuff with public transport.
+#
+# Hope you'll enjoy and contribute to this project,
+#     powered by Canal TP (www.canaltp.fr).
+# Help us simplify mobility and open public transport:
+#     a non ending quest to the responsive locomotion way of traveling!
+#
+# LICENCE: This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Stay tuned using
+# twitter @navitia
+# [matrix] channel #navitia:matrix.org (https://app.element.io/#/room/#navitia:matrix.org)
+# https://groups.google.com/d/forum/navitia
+# www.navitia.io
+
+
+from __future__ import absolute_import, print_function, unicode_literals, division
+
+import logging
+import time
+
+from kirin import manager, app
+from kirin.core.model import db
+from kirin.core.outbox import dispatch_outbox as dispatch
+
+logger = logging.getLogger(__name__)
+
+
+@manager.command
+def dispatch_outbox():
+    """
+    Publish the feeds of the outbox for navitia, in order (to be used with USE_FEED_OUTBOX)
+    """
+    batch_size = int(app.config.get(str("FEED_OUTBOX_BATCH_SIZE"), 100))
+    poll_interval = float(app.config.get(str("FEED_OUTBOX_POLL_INTERVAL"), 0.2))
+    logger.info("launching the outbox dispatcher")
+    while True:
+        try:
+            if dispatch(batch_size) < batch_size:
+                time.sleep(poll_interval)
+        except Exception as e:
+            logger.warning("error while dispatching the outbox: {}".format(e))
+            db.session.rollback()
+            time.sleep(poll_interval)
@@ -0,0 +1,63 @@
+# coding=utf-8
+
+# Copyright (c) 2001, Canal TP and/or its affiliates. All rights reserved.
+#
+# This file is part of Navitia,
+#     the software to build cool stuff with public transport.
+#
+# Hope you'll enjoy and contribute to this project,
+#     powered by Canal TP (www.canaltp.fr).
+# Help us simplify mobility and open public transport:
+#     a non ending quest to the responsive locomotion way of traveling!
+#
+# LICENCE: This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Stay tuned using
+# twitter @navitia
+# [matrix] channel #navitia:matrix.org (https://app.element.io/#/room/#navitia:matrix.org)
+# https://groups.google.com/d/forum/navitia
+# www.navitia.io
+
+
+from __future__ import absolute_import, print_function, unicode_literals, division
+
+import logging
+
+from kirin import manager
+from kirin.core.model import (
+    db,
+    TripUpdate,
+    STOP_TIME_UPDATE_ROWS_STORAGE,
+    STOP_TIME_UPDATE_COMPACT_STORAGE,
+    PURGE_BATCH_SIZE,
+)
+
+
+@manager.command
+def migrate_stop_time_update_storage(storage=STOP_TIME_UPDATE_COMPACT_STORAGE, batch_size=PURGE_BATCH_SIZE):
+    """
+    Convert the StopTimeUpdates of all TripUpdates to the given storage ("rows" or "compact"),
+    by batches of TripUpdates, each in its own transaction
+    """
+    logger = logging.getLogger(__name__)
+    if storage not in (STOP_TIME_UPDATE_ROWS_STORAGE, STOP_TIME_UPDATE_COMPACT_STORAGE):
+        raise ValueError("unknown StopTimeUpdate storage '{}'".format(storage))
+    nb_converted = 0
+    while True:
+        nb_batch = TripUpdate.convert_stop_time_update_storage_batch(storage, int(batch_size))
+        db.session.commit()
+        if not nb_batch:
+            break
+        nb_converted += nb_batch
+        logger.info("{} TripUpdates converted to '{}' storage".format(nb_converted, storage))
@@ -33,26 +33,69 @@
 from __future__ import absolute_import, print_function, unicode_literals, division
 
 from kirin import manager, app, new_relic
-from kirin.core.model import db
 from kirin.core.types import ConnectorType
-from kirin.core.build_wrapper import wrap_build
+from kirin.core.build_wrapper import wrap_build, wrap_build_batch
 from kirin.piv import KirinModelBuilder
 from kirin.piv.piv import get_piv_contributors, get_piv_contributor
+from kirin.piv.model_maker import get_piv_key_from_raw
 
 from kombu.mixins import ConsumerMixin
 from kombu import Connection, Exchange, Queue
-from datetime import datetime, timedelta
+from datetime import timedelta, datetime
 from copy import deepcopy
 import logging
 import time
 
-from kirin.utils import log_exception
+from kirin.utils import log_exception, save_superseded_rt_data
 
 logger = logging.getLogger(__name__)
 
 CONF_RELOAD_INTERVAL = timedelta(
     seconds=float(str(app.config.get(str("BROKER_CONSUMER_CONFIGURATION_RELOAD_INTERVAL"))))
 )
+BATCH_SIZE = int(app.config.get(str("PIV_WORKER_BATCH_SIZE"), 1))
+BATCH_TIMEOUT = timedelta(milliseconds=int(app.config.get(str("PIV_WORKER_BATCH_TIMEOUT"), 100)))
+COALESCE_MIN_LAG = app.config.get(str("PIV_WORKER_COALESCE_MIN_LAG"))
+
+
+def get_message_lag(message):
+    """
+    :return: the time elapsed since the message was published, or None if the publisher didn't set its timestamp
+    """
+    timestamp = message.properties.get("timestamp")
+    if timestamp is None:
+        return None
+    if not isinstance(timestamp, datetime):
+        timestamp = datetime.utcfromtimestamp(timestamp)
+    return datetime.utcnow() - timestamp
+
+
+def should_coalesce(lag, min_lag=None):
+    """
+    :param lag: lag of the oldest message of the batch (None if it can't be computed)
+    :param min_lag: lag (in seconds) from which the messages are coalesced (never if None)
+    :return: True if only the last message of each train is to be processed
+    (never when the lag is unknown, as the worker can't tell it is late)
+    """
+    return min_lag is not None and lag is not None and lag.total_seconds() >= min_lag
+
+
+def coalesce_messages(bodies):
+    """
+    PIV messages provide the complete state of a train: only the last message of each train is worth processing
+    :param bodies: PIV messages, in the order they were produced
+    :return: (messages to process, [(superseded message, key of its train)]), in the order they were produced
+    """
+    piv_keys = [get_piv_key_from_raw(body) for body in bodies]
+    last_positions = {piv_key: position for position, piv_key in enumerate(piv_keys) if piv_key is not None}
+    kept_bodies = []
+    superseded = []
+    for position, (body, piv_key) in enumerate(zip(bodies, piv_keys)):
+        if piv_key is None or last_positions[piv_key] == position:
+            kept_bodies.append(body)
+        else:
+            superseded.append((body, piv_key))
+    return kept_bodies, superseded
 
 
 class PivWorker(ConsumerMixin):
@@ -74,12 +117,14 @@ class PivWorker(ConsumerMixin):
             )
         if not contributor.queue_name:
             raise ValueError("Missing 'queue_name' configuration for contributor '{0}'".format(contributor.id))
-        self.last_config_checked_time = datetime.now()
         self.builder = KirinModelBuilder(contributor)
         # store config to spot configuration changes
         self.broker_url = deepcopy(contributor.broker_url)
         self.navitia_coverage = deepcopy(contributor.navitia_coverage)
         self.navitia_token = deepcopy(contributor.navitia_token)
+        # messages received and not processed yet, in batch mode
+        self.batch = []
+        self.batch_start_time = None
 
     @new_relic.agent.background_task(name="piv_worker-enter", group="Task")
     def __enter__(self):
@@ -91,6 +136,12 @@ class PivWorker(ConsumerMixin):
     def __exit__(self, type, value, traceback):
         self.connection.release()
 
+    def run(self, **kwargs):
+        if BATCH_SIZE > 1:
+            # on_iteration() is called at least this often when no message is received, to flush the batch
+            kwargs.setdefault("safety_interval", BATCH_TIMEOUT.total_seconds())
+        return super(PivWorker, self).run(**kwargs)
+
     def _get_exchange(self, exchange_name):
         return Exchange(name=exchange_name, type="fanout", durable=True, no_declare=True, auto_delete=False)
 
@@ -104,13 +155,23 @@ class PivWorker(ConsumerMixin):
             Consumer(
                 queues=[self.queue],
                 accept=["plain/text"],  # avoid deserializing to json dict
-                prefetch_count=1,
+                prefetch_count=BATCH_SIZE,
                 callbacks=[self.process_message],
             )
         ]
 
-    @new_relic.agent.background_task(name="piv_worker-process_message", group="Task")
     def process_message(self, body, message):
+        if BATCH_SIZE <= 1:
+            self.process_single_message(body, message)
+            return
+        if not self.batch:
+            self.batch_start_time = time.time()
+        self.batch.append((body, message))
+        if len(self.batch) >= BATCH_SIZE:
+            self.process_batch()
+
+    @new_relic.agent.background_task(name="piv_worker-process_message", group="Task")
+    def process_single_message(self, body, message):
         try:
             wrap_build(self.builder, body)
         except Exception as e:
@@ -122,15 +183,44 @@ class PivWorker(ConsumerMixin):
             # * we do not want to process this message after another one (produced later) on the same train
             message.ack()
 
+    @new_relic.agent.background_task(name="piv_worker-process_batch", group="Task")
+    def process_batch(self):
+        """
+        Process the messages received in a single transaction, publish a single feed for all of them,
+        then acknowledge them (same as for a single message, even in case of error)
+        """
+        batch, self.batch = self.batch, []
+        try:
+            bodies = [body for body, _ in batch]
+            lags = [lag for lag in (get_message_lag(message) for _, message in batch) if lag is not None]
+            lag = max(lags) if lags else None
+            if lag is not None:
+                logger.info(
+                    "processing {} messages, lag: {} s".format(len(batch), lag.total_seconds()),
+                    extra={str("contributor"): self.builder.contributor.id, str("lag"): lag.total_seconds()},
+                )
+            # lag-aware mode: when the worker is late, intermediate states of a train are skipped
+            if should_coalesce(lag, COALESCE_MIN_LAG):
+                bodies, superseded = coalesce_messages(bodies)
+                if superseded:
+                    save_superseded_rt_data(
+                        superseded, self.builder.contributor.connector_type, self.builder.contributor.id
+                    )
+            wrap_build_batch(self.builder, bodies)
+        except Exception as e:
+            log_exception(e, "piv_worker")
+        finally:
+            for _, message in batch:
+                message.ack()
+
     @new_relic.agent.background_task(name="piv_worker-on_iteration", group="Task")
     def on_iteration(self):
-        if datetime.now() - self.last_config_checked_time < CONF_RELOAD_INTERVAL:
-            return
-        else:
-            # SQLAlchemy is not querying the DB for read (uses cache instead),
-            # unless we specifically tell that the data is expired.
-            db.session.expire(self.builder.contributor)
-            self.last_config_checked_time = datetime.now()
+        if self.batch and (
+            len(self.batch) >= BATCH_SIZE or time.time() - self.batch_start_time >= BATCH_TIMEOUT.total_seconds()
+        ):
+            self.process_batch()
+        # The contributor registry only reloads contributors when notified of a change,
+        # so checking the configuration at each iteration is cheap and takes changes into account immediately.
         contributor = get_piv_contributor(self.builder.contributor.id)
         if (
             not contributor
@@ -145,6 +235,8 @@ class PivWorker(ConsumerMixin):
                     self.builder.contributor.id
                 )
             )
+            if self.batch:
+                self.process_batch()
             self.should_stop = True
             return
 
@@ -178,6 +270,3 @@ def piv_worker():
         finally:
             if should_wait:
                 time.sleep(CONF_RELOAD_INTERVAL.total_seconds())
-            db.session.expire(
-                contributor
-            )  # force db-reload otherwise staying locked on previous contributor's config
@@ -0,0 +1,72 @@
+# coding=utf-8
+
+# Copyright (c) 2001, Canal TP and/or its affiliates. All rights reserved.
+#
+# This file is part of Navitia,
+#     the software to build cool stuff with public transport.
+#
+# Hope you'll enjoy and contribute to this project,
+#     powered by Canal TP (www.canaltp.fr).
+# Help us simplify mobility and open public transport:
+#     a non ending quest to the responsive locomotion way of traveling!
+#
+# LICENCE: This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Stay tuned using
+# twitter @navitia
+# [matrix] channel #navitia:matrix.org (https://app.element.io/#/room/#navitia:matrix.org)
+# https://groups.google.com/d/forum/navitia
+# www.navitia.io
+
+
+from __future__ import absolute_import, print_function, unicode_literals, division
+
+import logging
+
+from kirin import manager, app
+from kirin.core import rtu_partitions
+
+
+def _get_nb_days_ahead(nb_days_ahead):
+    if nb_days_ahead is None:
+        return app.config.get(str("REAL_TIME_UPDATE_PARTITIONS_DAYS_AHEAD"), 7)
+    return int(nb_days_ahead)
+
+
+@manager.command
+def partition_real_time_update(nb_days_ahead=None):
+    """
+    Partition table real_time_update by day of creation (optional migration, requires PostgreSQL >= 11):
+    old RealTimeUpdates are then purged by dropping partitions
+    """
+    rtu_partitions.partition_real_time_update(_get_nb_days_ahead(nb_days_ahead))
+
+
+@manager.command
+def create_real_time_update_partitions(nb_days_ahead=None):
+    """
+    Create the daily partitions of real_time_update for the next days (to be run daily)
+    """
+    created_partitions = rtu_partitions.create_real_time_update_partitions(_get_nb_days_ahead(nb_days_ahead))
+    logging.getLogger(__name__).info("{} partitions created".format(len(created_partitions)))
+
+
+@manager.command
+def drop_real_time_update_partitions():
+    """
+    Drop the partitions of real_time_update older than the retention of all contributors
+    and not referenced by any TripUpdate
+    """
+    dropped_partitions = rtu_partitions.drop_expired_real_time_update_partitions()
+    logging.getLogger(__name__).info("{} partitions dropped".format(len(dropped_partitions)))
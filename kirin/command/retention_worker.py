@@ -0,0 +1,104 @@
+# coding=utf-8
+
+# Copyright (c) 2001, Canal TP and/or its affiliates. All rights reserved.
+#
+# This file is part of Navitia,
+#     the software to build cool stuff with public transport.
+#
+# Hope you'll enjoy and contribute to this project,
+#     powered by Canal TP (www.canaltp.fr).
+# Help us simplify mobility and open public transport:
+#     a non ending quest to the responsive locomotion way of traveling!
+#
+# LICENCE: This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Stay tuned using
+# twitter @navitia
+# [matrix] channel #navitia:matrix.org (https://app.element.io/#/room/#navitia:matrix.org)
+# https://groups.google.com/d/forum/navitia
+# www.navitia.io
+
+
+from __future__ import absolute_import, print_function, unicode_literals, division
+
+import logging
+import time
+
+from kirin import manager, app
+from kirin.core.model import db
+from kirin.core.retention import (
+    RetentionRateLimiter,
+    get_contributors_to_purge,
+    get_replication_lag,
+    purge_contributor_slice,
+)
+from kirin.core.rtu_partitions import (
+    is_real_time_update_partitioned,
+    drop_expired_real_time_update_partitions,
+    create_real_time_update_partitions,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def _purge_all_contributors(rate_limiter):
+    """
+    Purge a slice of each contributor, pausing between slices as told by the rate limiter
+    :return: the number of objects deleted
+    """
+    is_partitioned = is_real_time_update_partitioned()
+    if is_partitioned:
+        drop_expired_real_time_update_partitions()
+        create_real_time_update_partitions(app.config.get(str("REAL_TIME_UPDATE_PARTITIONS_DAYS_AHEAD"), 7))
+    nb_deleted = 0
+    for contributor in get_contributors_to_purge():
+        start = time.time()
+        nb_slice_deleted = purge_contributor_slice(
+            contributor, rate_limiter.batch_size, purge_real_time_updates=not is_partitioned
+        )
+        pause = rate_limiter.update(time.time() - start, get_replication_lag())
+        nb_deleted += nb_slice_deleted
+        if nb_slice_deleted:
+            time.sleep(pause)
+    return nb_deleted
+
+
+@manager.command
+def retention_worker():
+    """
+    Continuously purge expired TripUpdates and RealTimeUpdates by small slices (to be used with
+    USE_RETENTION_WORKER, that disables the nightly purge tasks)
+    """
+    rate_limiter = RetentionRateLimiter(
+        min_batch_size=int(app.config.get(str("RETENTION_WORKER_MIN_BATCH_SIZE"), 50)),
+        max_batch_size=int(app.config.get(str("RETENTION_WORKER_MAX_BATCH_SIZE"), 1000)),
+        target_duration=float(app.config.get(str("RETENTION_WORKER_TARGET_BATCH_DURATION"), 0.2)),
+        max_replication_lag=float(app.config.get(str("RETENTION_WORKER_MAX_REPLICATION_LAG"), 5)),
+        interval=float(app.config.get(str("RETENTION_WORKER_INTERVAL"), 1)),
+    )
+    idle_interval = float(app.config.get(str("RETENTION_WORKER_IDLE_INTERVAL"), 60))
+    logger.info("launching the retention worker")
+    while True:
+        try:
+            nb_deleted = _purge_all_contributors(rate_limiter)
+            logger.info(
+                "retention pass: {} objects deleted, slices of {}".format(nb_deleted, rate_limiter.batch_size),
+                extra={str("deleted_count"): nb_deleted, str("batch_size"): rate_limiter.batch_size},
+            )
+        except Exception as e:
+            logger.warning("error in the retention worker: {}".format(e))
+            db.session.rollback()
+            nb_deleted = 0
+        if not nb_deleted:
+            time.sleep(idle_interval)
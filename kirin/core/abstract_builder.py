@@ -40,6 +40,8 @@ from flask import current_app
 
 from kirin import redis_client
 from kirin.core.model import Contributor, RealTimeUpdate, TripUpdate
+from kirin.core.schedule_snapshot import get_schedule_snapshot
+from kirin.core.vj_prefetcher import get_vj_prefetcher
 
 
 class AbstractKirinModelBuilder(six.with_metaclass(ABCMeta, object)):
@@ -63,6 +65,22 @@ class AbstractKirinModelBuilder(six.with_metaclass(ABCMeta, object)):
             pubdate_timeout=current_app.config.get(str("NAVITIA_PUBDATE_CACHE_TIMEOUT"), 600),
         ).instance(contributor.navitia_coverage)
         self.contributor = contributor
+        # None if no snapshot is used for this contributor
+        self.schedule_snapshot = get_schedule_snapshot(contributor)
+        # None if VJs are not prefetched for this contributor
+        self.vj_prefetcher = get_vj_prefetcher(contributor)
+
+    def find_local_vjs(self, since_dt=None, until_dt=None, headsign=None, code=None):
+        """
+        Search VJs in the schedule snapshot, then in the prefetched VJs
+        :return: list of navitia VJs, or None if navitia has to be requested
+        """
+        for vjs_source in (self.schedule_snapshot, self.vj_prefetcher):
+            if vjs_source:
+                navitia_vjs = vjs_source.find_vjs(since_dt, until_dt, headsign=headsign, code=code)
+                if navitia_vjs:
+                    return navitia_vjs
+        return None
 
     def build_rt_update(self, input_raw):
         # type: (Any) -> Tuple[RealTimeUpdate, Dict[unicode, unicode]]
@@ -36,11 +36,13 @@ import socket
 from collections import namedtuple
 
 import six
+from flask import current_app
 
 import kirin
 from kirin import gtfs_realtime_pb2
-from kirin.core.model import TripUpdate
-from kirin.core.populate_pb import convert_to_gtfsrt
+from kirin.core.model import TripUpdate, db
+from kirin.core.outbox import is_outbox_enabled, add_to_outbox
+from kirin.core.populate_pb import cache_feed_entities, make_feed_header, serialize_feed
 from kirin.exceptions import MessageNotPublished, KirinException
 from kirin.new_relic import is_invalid_input_exception, record_custom_parameter
 from kirin.utils import set_rtu_status_ko, allow_reprocess_same_data, record_call, db_commit
@@ -165,64 +167,183 @@ def publish(feed, contributor_id):
         raise MessageNotPublished()
 
 
-def handle(builder, real_time_update, trip_updates):
+def get_dated_vj_key(trip_update):
     """
-    Receive a RealTimeUpdate with at least one TripUpdate filled with the data received
-    by the connector.
-    Each TripUpdate is associated with the base-schedule VehicleJourney, complete/merge realtime is done using builder
-    Then persist in db, publish for Navitia
-    Returns real_time_update and the log_dict
+    Key identifying the dated VJ of a TripUpdate (unique in db)
     """
-    if not real_time_update:
-        raise TypeError()
-    id_timestamp_tuples = [(tu.vj.navitia_trip_id, tu.vj.start_timestamp) for tu in trip_updates]
-    old_trip_updates = TripUpdate.find_by_dated_vjs(id_timestamp_tuples)
+    return trip_update.vj.navitia_trip_id, trip_update.vj.start_timestamp
+
+
+def index_by_dated_vj(trip_updates):
+    """
+    Index TripUpdates by dated VJ, so that matching incoming TripUpdates with the ones in db
+    is done in constant time for each of them (instead of scanning the whole list)
+    """
+    return {get_dated_vj_key(tu): tu for tu in trip_updates}
+
+
+def merge_into_real_time_update(builder, real_time_update, trip_updates):
+    """
+    Associate each TripUpdate with the base-schedule VehicleJourney and merge it with the current realtime,
+    then link the resulting TripUpdates to real_time_update (nothing is committed)
+    TripUpdates identical to the last one merged in db (same fingerprint) are skipped, as they change nothing
+    Returns the number of TripUpdates skipped
+    """
+    id_timestamp_tuples = [get_dated_vj_key(tu) for tu in trip_updates]
+    old_trip_updates = index_by_dated_vj(TripUpdate.find_by_dated_vjs(id_timestamp_tuples))
+    unchanged_count = 0
     for trip_update in trip_updates:
         # find if there is already a row in db
-        old = next(
-            (
-                tu
-                for tu in old_trip_updates
-                if tu.vj.navitia_trip_id == trip_update.vj.navitia_trip_id
-                and tu.vj.start_timestamp == trip_update.vj.start_timestamp
-            ),
-            None,
-        )
+        old = old_trip_updates.get(get_dated_vj_key(trip_update))
+        # computed before merge, that modifies trip_update
+        fingerprint = trip_update.compute_fingerprint()
+        if old is not None and old.fingerprint == fingerprint:
+            unchanged_count += 1
+            continue
         # merge the base schedule, the current realtime, and the new realtime
         current_trip_update = builder.merge_trip_updates(trip_update.vj.navitia_vj, old, trip_update)
 
         # manage and adjust consistency if possible
         if current_trip_update and manage_consistency(current_trip_update):
+            current_trip_update.fingerprint = fingerprint
             # we have to link the current_vj_update with the new real_time_update
             # this link is done quite late to avoid too soon persistence of trip_update by sqlalchemy
-            current_trip_update.real_time_updates.append(real_time_update)
+            # (done from the new real_time_update, so that the history of the TripUpdate isn't loaded)
+            real_time_update.trip_updates.append(current_trip_update)
+    return unchanged_count
 
-    db_commit(real_time_update)
 
-    feed = convert_to_gtfsrt(real_time_update.trip_updates, gtfs_realtime_pb2.FeedHeader.DIFFERENTIAL)
-    feed_str = feed.SerializeToString()
-    publish(feed_str, builder.contributor.id)
+def serialize_trip_updates(trip_updates):
+    """
+    Serialize the FeedEntity of each TripUpdate and store it in the TripUpdate (nothing is committed),
+    so that full feeds are built without converting TripUpdates again
+    Returns the serialized FeedEntities
+    """
+    db.session.flush()  # FeedEntities refer to the ids of new VJs
+    return cache_feed_entities(trip_updates)
+
+
+def prune_real_time_update_links(trip_updates):
+    """
+    Limit the links of the TripUpdates to their RealTimeUpdates (nothing is committed):
+    only the MAX_RT_UPDATES_PER_TRIP_UPDATE last ones and the ones of the last RT_UPDATES_PER_TRIP_UPDATE_WINDOW
+    seconds are kept, when set
+    """
+    max_count = current_app.config.get(str("MAX_RT_UPDATES_PER_TRIP_UPDATE"))
+    window = current_app.config.get(str("RT_UPDATES_PER_TRIP_UPDATE_WINDOW"))
+    return TripUpdate.prune_real_time_update_links(
+        [tu.vj_id for tu in trip_updates],
+        max_count=max_count,
+        max_age=datetime.timedelta(seconds=window) if window is not None else None,
+    )
+
 
-    data_time = datetime.datetime.utcfromtimestamp(feed.header.timestamp)
-    log_dict = {
-        "contributor": builder.contributor.id,
+def publish_feed_entities(contributor_id, serialized_entities):
+    """
+    Publish a DIFFERENTIAL feed of the given serialized FeedEntities for navitia
+    Returns the log_dict
+    """
+    header = make_feed_header(gtfs_realtime_pb2.FeedHeader.DIFFERENTIAL)
+    feed_str = serialize_feed(header, serialized_entities)
+    publish(feed_str, contributor_id)
+
+    data_time = datetime.datetime.utcfromtimestamp(header.timestamp)
+    return {
+        "contributor": contributor_id,
         "timestamp": data_time,
-        "trip_update_count": len(feed.entity),
+        "trip_update_count": len(serialized_entities),
         "size": len(feed_str),
     }
-    # After merging trip_updates information of connector realtime, navitia and kirin database, if there is no new
-    # information destined to navitia, update real_time_update with status = 'KO' and a proper error message.
-    if not real_time_update.trip_updates and real_time_update.status == "OK":
-        msg = "No new information destined to navitia for this {}".format(real_time_update.connector)
-        set_rtu_status_ko(real_time_update, msg, is_reprocess_same_data_allowed=False)
-        logging.getLogger(__name__).warning(
-            "RealTimeUpdate id={}: {}".format(real_time_update.id, msg), extra=log_dict
-        )
+
+
+def check_new_information(real_time_update, log_dict):
+    """
+    After merging trip_updates information of connector realtime, navitia and kirin database, if there is no new
+    information destined to navitia, update real_time_update with status = 'KO' and a proper error message.
+    Returns True if real_time_update was updated (nothing is committed)
+    """
+    if real_time_update.trip_updates or real_time_update.status != "OK":
+        return False
+    msg = "No new information destined to navitia for this {}".format(real_time_update.connector)
+    set_rtu_status_ko(real_time_update, msg, is_reprocess_same_data_allowed=False)
+    logging.getLogger(__name__).warning(
+        "RealTimeUpdate id={}: {}".format(real_time_update.id, msg), extra=log_dict
+    )
+    return True
+
+
+def handle(builder, real_time_update, trip_updates):
+    """
+    Receive a RealTimeUpdate with at least one TripUpdate filled with the data received
+    by the connector.
+    Each TripUpdate is associated with the base-schedule VehicleJourney, complete/merge realtime is done using builder
+    Then persist in db, publish for Navitia
+    Returns real_time_update and the log_dict
+    """
+    if not real_time_update:
+        raise TypeError()
+    unchanged_count = merge_into_real_time_update(builder, real_time_update, trip_updates)
+    serialized_entities = serialize_trip_updates(real_time_update.trip_updates)
+    prune_real_time_update_links(real_time_update.trip_updates)
+
+    if is_outbox_enabled():
+        # the feed is published by the outbox dispatcher, once committed with the TripUpdates
+        # (as in wrap_build_batch(), no empty feed is enqueued)
+        if serialized_entities:
+            log_dict = add_to_outbox(builder.contributor.id, serialized_entities)
+        else:
+            log_dict = {"contributor": builder.contributor.id, "trip_update_count": 0}
+        log_dict.update({"unchanged_trip_update_count": unchanged_count})
+        check_new_information(real_time_update, log_dict)
+        db_commit(real_time_update)
+        return real_time_update, log_dict
+
+    db_commit(real_time_update)
+
+    log_dict = publish_feed_entities(builder.contributor.id, serialized_entities)
+    log_dict.update({"unchanged_trip_update_count": unchanged_count})
+
+    if check_new_information(real_time_update, log_dict):
         db_commit(real_time_update)
 
     return real_time_update, log_dict
 
 
+def _manage_build_error(e, contributor, rt_update, log_dict):
+    """
+    Set the status of rt_update (if built) after an error in its processing (nothing is committed)
+    Returns the status of the processing
+    """
+    status = "failure"
+    allow_reprocess = True
+    if is_invalid_input_exception(e):
+        status = "warning"  # Kirin did his job correctly if the input is invalid and rejected
+        allow_reprocess = False  # reprocess is useless if input is invalid
+
+    if rt_update is not None:
+        error = e.data["error"] if (isinstance(e, KirinException) and "error" in e.data) else e.message
+        set_rtu_status_ko(rt_update, error, is_reprocess_same_data_allowed=allow_reprocess)
+    else:
+        # rt_update is not built, make sure reprocess is allowed
+        allow_reprocess_same_data(contributor.id)
+
+    log_dict.update({"exc_summary": six.text_type(e), "reason": e})
+
+    record_custom_parameter("reason", e)  # using __str__() here to have complete details
+    return status
+
+
+def _record_build(status, start_datetime, log_dict):
+    log_dict.update({"duration": (datetime.datetime.utcnow() - start_datetime).total_seconds()})
+    record_call(status, **log_dict)
+    if status == "OK":
+        logging.getLogger(__name__).info(status, extra=log_dict)
+    elif status == "warning":
+        logging.getLogger(__name__).warning(status, extra=log_dict)
+    else:
+        logging.getLogger(__name__).error(status, extra=log_dict)
+
+
 def wrap_build(builder, input_raw):
     """
     Function wrapping the processing of realtime information of an external feed
@@ -250,31 +371,98 @@ def wrap_build(builder, input_raw):
         log_dict.update(handler_log_dict)
 
     except Exception as e:
-        status = "failure"
-        allow_reprocess = True
-        if is_invalid_input_exception(e):
-            status = "warning"  # Kirin did his job correctly if the input is invalid and rejected
-            allow_reprocess = False  # reprocess is useless if input is invalid
-
+        status = _manage_build_error(e, contributor, rt_update, log_dict)
         if rt_update is not None:
-            error = e.data["error"] if (isinstance(e, KirinException) and "error" in e.data) else e.message
-            set_rtu_status_ko(rt_update, error, is_reprocess_same_data_allowed=allow_reprocess)
             db_commit(rt_update)
-        else:
-            # rt_update is not built, make sure reprocess is allowed
-            allow_reprocess_same_data(contributor.id)
+        raise  # filters later for APM (auto.)
 
-        log_dict.update({"exc_summary": six.text_type(e), "reason": e})
+    finally:
+        _record_build(status, start_datetime, log_dict)
 
-        record_custom_parameter("reason", e)  # using __str__() here to have complete details
-        raise  # filters later for APM (auto.)
 
+def _rollback_savepoint(savepoint):
+    """
+    Roll back the changes made since the SAVEPOINT, if not already released (or rolled back):
+    unlike db.session.rollback(), the transaction of the batch is never rolled back
+    """
+    if savepoint.session is not None:
+        savepoint.rollback()
+
+
+def wrap_build_batch(builder, inputs_raw):
+    """
+    Process a batch of realtime feeds in a single transaction, then publish a single feed for navitia.
+    Each feed keeps its own RealTimeUpdate and status, as if processed by wrap_build():
+    its processing is done in a SAVEPOINT, so that an error only discards the changes of this feed.
+    :param builder: the KirinModelBuilder to be called (must inherit from abstract_builder.AbstractKirinModelBuilder)
+    :param inputs_raw: the feeds to process, in the order they were produced
+    """
+    contributor = builder.contributor
+    processed = []  # [(rt_update, status, start_datetime, log_dict)]
+    for input_raw in inputs_raw:
+        start_datetime = datetime.datetime.utcnow()
+        rt_update = None
+        log_dict = {"contributor": contributor.id}
+        status = "OK"
+        # create a raw rt_update obj, the commit only releases its SAVEPOINT
+        rt_update_savepoint = db.session.begin_nested()
+        try:
+            rt_update, rtu_log_dict = builder.build_rt_update(input_raw)
+            log_dict.update(rtu_log_dict)
+
+            trip_updates_savepoint = db.session.begin_nested()
+            try:
+                trip_updates, tu_log_dict = builder.build_trip_updates(rt_update)
+                log_dict.update(tu_log_dict)
+                unchanged_count = merge_into_real_time_update(builder, rt_update, trip_updates)
+                log_dict.update({"unchanged_trip_update_count": unchanged_count})
+                trip_updates_savepoint.commit()
+            except Exception:
+                _rollback_savepoint(trip_updates_savepoint)
+                raise
+        except Exception as e:
+            _rollback_savepoint(rt_update_savepoint)
+            status = _manage_build_error(e, contributor, rt_update, log_dict)
+        processed.append((rt_update, status, start_datetime, log_dict))
+
+    # the same TripUpdate can be modified by several feeds: it is published once, in its last state
+    trip_updates = []
+    for rt_update, status, _, log_dict in processed:
+        if status != "OK":
+            continue
+        for trip_update in rt_update.trip_updates:
+            if trip_update not in trip_updates:
+                trip_updates.append(trip_update)
+        check_new_information(rt_update, log_dict)
+    serialized_entities = serialize_trip_updates(trip_updates)
+    prune_real_time_update_links(trip_updates)
+
+    if is_outbox_enabled():
+        # the feed is published by the outbox dispatcher, once committed with the TripUpdates
+        if serialized_entities:
+            outbox_log_dict = add_to_outbox(contributor.id, serialized_entities)
+            for _, status, _, log_dict in processed:
+                if status == "OK":
+                    log_dict.update(outbox_log_dict)
+        db.session.commit()
+        for _, status, start_datetime, log_dict in processed:
+            _record_build(status, start_datetime, log_dict)
+        return
+
+    db.session.commit()
+
+    try:
+        if serialized_entities:
+            publish_log_dict = publish_feed_entities(contributor.id, serialized_entities)
+            for _, status, _, log_dict in processed:
+                if status == "OK":
+                    log_dict.update(publish_log_dict)
+    except Exception as e:
+        for i, (rt_update, status, start_datetime, log_dict) in enumerate(processed):
+            if status == "OK":
+                status = _manage_build_error(e, contributor, rt_update, log_dict)
+                processed[i] = (rt_update, status, start_datetime, log_dict)
+        db.session.commit()
     finally:
-        log_dict.update({"duration": (datetime.datetime.utcnow() - start_datetime).total_seconds()})
-        record_call(status, **log_dict)
-        if status == "OK":
-            logging.getLogger(__name__).info(status, extra=log_dict)
-        elif status == "warning":
-            logging.getLogger(__name__).warning(status, extra=log_dict)
-        else:
-            logging.getLogger(__name__).error(status, extra=log_dict)
+        for _, status, start_datetime, log_dict in processed:
+            _record_build(status, start_datetime, log_dict)
@@ -0,0 +1,85 @@
+# coding=utf-8
+
+# Copyright (c) 2001, Canal TP and/or its affiliates. All rights reserved.
+#
+# This file is part of Navitia,
+#     the software to build cool stuff with public transport.
+#
+# Hope you'll enjoy and contribute to this project,
+#     powered by Canal TP (www.canaltp.fr).
+# Help us simplify mobility and open public transport:
+#     a non ending quest to the responsive locomotion way of traveling!
+#
+# LICENCE: This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Stay tuned using
+# twitter @navitia
+# [matrix] channel #navitia:matrix.org (https://app.element.io/#/room/#navitia:matrix.org)
+# https://groups.google.com/d/forum/navitia
+# www.navitia.io
+
+
+from __future__ import absolute_import, print_function, unicode_literals, division
+
+import copy
+import logging
+
+from kirin.core.model import Contributor
+
+# Process-wide registry of KirinModelBuilders: {contributor_id: (config_hash, builder)}
+_builders = {}
+
+
+def get_contributor_config_hash(contributor):
+    """
+    :return: hash of the whole configuration of the contributor (all its columns)
+    """
+    return hash(tuple(getattr(contributor, c.name) for c in Contributor.__table__.columns))
+
+
+def get_builder(builder_class, contributor):
+    """
+    Get a KirinModelBuilder of the contributor, the shared one being built only if its configuration changed
+    (or if it was never built in this process).
+
+    The shared builder is never modified, as it can be used by concurrent requests: a shallow copy of it
+    (sharing its navitia wrapper) is returned, bound to the given contributor as it is usually loaded in the
+    current request's session. The caller can then set its own state on it.
+    """
+    config_hash = get_contributor_config_hash(contributor)
+    config_hash_and_builder = _builders.get(contributor.id)
+    if (
+        config_hash_and_builder is None
+        or config_hash_and_builder[0] != config_hash
+        or not isinstance(config_hash_and_builder[1], builder_class)
+    ):
+        logging.getLogger(__name__).info(
+            "building a new {} for contributor {}".format(builder_class, contributor.id)
+        )
+        config_hash_and_builder = _builders[contributor.id] = (config_hash, builder_class(contributor))
+
+    builder = copy.copy(config_hash_and_builder[1])
+    builder.contributor = contributor
+    return builder
+
+
+def invalidate_builder(contributor_id):
+    """
+    Drop the builder of the contributor (to be called when its configuration changes)
+    """
+    _builders.pop(contributor_id, None)
+
+
+def clear():
+    _builders.clear()
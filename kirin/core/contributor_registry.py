@@ -0,0 +1,205 @@
+# coding=utf-8
+
+# Copyright (c) 2001, Canal TP and/or its affiliates. All rights reserved.
+#
+# This file is part of Navitia,
+#     the software to build cool stuff with public transport.
+#
+# Hope you'll enjoy and contribute to this project,
+#     powered by Canal TP (www.canaltp.fr).
+# Help us simplify mobility and open public transport:
+#     a non ending quest to the responsive locomotion way of traveling!
+#
+# LICENCE: This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Stay tuned using
+# twitter @navitia
+# [matrix] channel #navitia:matrix.org (https://app.element.io/#/room/#navitia:matrix.org)
+# https://groups.google.com/d/forum/navitia
+# www.navitia.io
+
+
+from __future__ import absolute_import, print_function, unicode_literals, division
+
+import logging
+import threading
+from datetime import datetime, timedelta
+
+import sqlalchemy
+from flask import current_app
+
+from kirin.core.model import db, Contributor
+
+# Channel notified by the trigger on the contributor table (see migration 3d0c8b1ae2f4)
+CONTRIBUTOR_CHANGE_CHANNEL = "contributor_change"
+
+
+class ContributorRegistry(object):
+    """
+    Process-wide cache of all contributors, to avoid querying the db each time a contributor is needed.
+
+    Contributors are loaded all at once, and reloaded only when they changed:
+    * immediately for changes committed by this process (see session events below)
+    * on PostgreSQL notification (LISTEN/NOTIFY) for changes made by other processes
+    * every CONTRIBUTOR_REGISTRY_POLL_INTERVAL as a fallback if listening to notifications is not possible
+
+    Cached contributors are detached from any session: they are meant for read-only use.
+    The listening connection is shared by all threads (or greenlets) of the process, under a lock.
+    """
+
+    def __init__(self):
+        self._contributors = None
+        self._loaded_at = None
+        self._listen_connection = None
+        self._lock = threading.RLock()
+
+    def invalidate(self):
+        self._contributors = None
+
+    def _listen(self):
+        if self._listen_connection is not None:
+            return True
+        try:
+            # dedicated connection, removed from the pool and kept in autocommit to receive notifications
+            self._listen_connection = db.engine.raw_connection()
+            self._listen_connection.detach()
+            # the pool's checkout hooks (see set_utc_on_connect) leave a transaction open:
+            # autocommit can't be set inside a transaction
+            self._listen_connection.connection.rollback()
+            self._listen_connection.connection.autocommit = True
+            cursor = self._listen_connection.cursor()
+            cursor.execute("LISTEN {};".format(CONTRIBUTOR_CHANGE_CHANNEL))
+            cursor.close()
+            return True
+        except Exception as e:
+            logging.getLogger(__name__).warning(
+                "impossible to listen to contributor changes, polling instead: {}".format(e)
+            )
+            if self._listen_connection is not None:
+                self._close_listen_connection()
+            return False
+
+    def _close_listen_connection(self):
+        try:
+            self._listen_connection.close()
+        except Exception:
+            pass
+        self._listen_connection = None
+
+    def _is_notified(self):
+        """
+        :return: True if a change was notified since last call (or if notifications may have been missed)
+        """
+        try:
+            dbapi_connection = self._listen_connection.connection
+            dbapi_connection.poll()
+            if dbapi_connection.notifies:
+                del dbapi_connection.notifies[:]
+                return True
+            return False
+        except Exception as e:
+            logging.getLogger(__name__).warning("lost listening connection on contributor changes: {}".format(e))
+            self._close_listen_connection()
+            return True
+
+    def _is_stale(self):
+        if self._contributors is None:
+            return True
+        if self._listen_connection is not None:
+            return self._is_notified()
+        poll_interval = timedelta(seconds=current_app.config.get(str("CONTRIBUTOR_REGISTRY_POLL_INTERVAL"), 60))
+        return datetime.utcnow() - self._loaded_at > poll_interval
+
+    def _load(self):
+        is_listening = self._listen()
+        if is_listening:
+            # notifications received before the reload are irrelevant
+            self._is_notified()
+        session = sqlalchemy.orm.Session(bind=db.engine)
+        try:
+            contributors = session.query(Contributor).all()
+            session.expunge_all()
+        finally:
+            session.close()
+        self._contributors = {c.id: c for c in contributors}
+        self._loaded_at = datetime.utcnow()
+        logging.getLogger(__name__).debug("{} contributors loaded".format(len(contributors)))
+
+    def _get_contributors(self):
+        with self._lock:
+            if self._is_stale():
+                self._load()
+            return self._contributors
+
+    def get(self, contributor_id, connector_type=None, include_deactivated=False):
+        """
+        :return: the contributor with given id (and connector_type if provided) or None if it doesn't exist
+        """
+        contributor = self._get_contributors().get(contributor_id)
+        if contributor is None:
+            return None
+        if connector_type is not None and contributor.connector_type != connector_type:
+            return None
+        if not include_deactivated and not contributor.is_active:
+            return None
+        return contributor
+
+    def find_by_connector_type(self, connector_type, include_deactivated=False):
+        return sorted(
+            (
+                c
+                for c in self._get_contributors().values()
+                if c.connector_type == connector_type and (include_deactivated or c.is_active)
+            ),
+            key=lambda c: c.id,
+        )
+
+
+contributor_registry = ContributorRegistry()
+
+
+# Changes committed by this process invalidate the registry right away, without waiting for the notification
+
+
+def _mark_contributor_change(session):
+    session.info[str("contributor_changed")] = True
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, "after_flush")
+def _on_flush(session, flush_context):
+    if any(isinstance(o, Contributor) for o in session.new | session.dirty | session.deleted):
+        _mark_contributor_change(session)
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, "after_bulk_update")
+def _on_bulk_update(update_context):
+    if update_context.mapper.class_ is Contributor:
+        _mark_contributor_change(update_context.session)
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, "after_bulk_delete")
+def _on_bulk_delete(delete_context):
+    if delete_context.mapper.class_ is Contributor:
+        _mark_contributor_change(delete_context.session)
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, "after_commit")
+def _on_commit(session):
+    if session.info.pop(str("contributor_changed"), False):
+        contributor_registry.invalidate()
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, "after_soft_rollback")
+def _on_rollback(session, previous_transaction):
+    session.info.pop(str("contributor_changed"), None)
@@ -39,16 +39,6 @@ from kirin.core.model import StopTimeUpdate
 from kirin.core.types import ModificationType
 
 
-def find_st_in_vj(st_id, vj_sts):
-    """
-    Find a stop_time in the navitia vehicle journey
-    :param st_id: id of the requested stop_time
-    :param vj_sts: list of stop_times available in the vj
-    :return: stop_time if found else None
-    """
-    return next((vj_st for vj_st in vj_sts if vj_st.get("stop_point", {}).get("id") == st_id), None)
-
-
 def is_stop_event_served(event_name, stop_id, stop_order, nav_stop, db_tu, new_stu):
     """
     Returns True if the considered stop_time event (arrival or departure) is currently served
@@ -236,7 +226,7 @@ def yield_next_stop_from_trip_update(new_trip_update, db_trip_update):
     # Iterate on the new trip update stop_times if it is complete (all stop_times present in it)
     for order, new_stu in enumerate(new_trip_update.stop_time_updates):
         # Find corresponding stop_time in the theoretical VJ
-        vj_st = find_st_in_vj(new_stu.stop_id, new_trip_update.vj.navitia_vj.get("stop_times", []))
+        vj_st = new_trip_update.vj.find_navitia_stop_time(new_stu.stop_id)
         if vj_st:
             yield order, vj_st
         else:
@@ -323,6 +313,8 @@ def merge(navitia_vj, db_trip_update, new_trip_update, is_new_complete):
     """
     res = db_trip_update if db_trip_update else new_trip_update
     res_stoptime_updates = []
+    # StopTimeUpdates in db that new StopTimeUpdates replace: {id(new StopTimeUpdate): StopTimeUpdate in db}
+    replaced_db_sts = {}
 
     res.status = new_trip_update.status
     res.effect = new_trip_update.effect
@@ -419,6 +411,8 @@ def merge(navitia_vj, db_trip_update, new_trip_update, is_new_complete):
             )
             has_changes |= (db_st is None) or db_st.is_not_equal(new_st_update)
             res_st = new_st_update if has_changes else db_st
+            if res_st is new_st_update and db_st is not None:
+                replaced_db_sts[id(new_st_update)] = db_st
 
         elif db_trip_update is None and new_st is not None:
             """
@@ -469,7 +463,27 @@ def merge(navitia_vj, db_trip_update, new_trip_update, is_new_complete):
     res.effect = new_trip_update.effect
 
     if has_changes:
-        res.stop_time_updates = res_stoptime_updates
+        res.stop_time_updates = _reuse_db_stop_time_updates(res_stoptime_updates, replaced_db_sts)
         return res
 
     return None
+
+
+def _reuse_db_stop_time_updates(stop_time_updates, replaced_db_sts):
+    """
+    Replace new StopTimeUpdates by the ones in db they replace, updated with their fields:
+    rows of unchanged stops are kept as is, rows of changed stops are only updated
+    (replacing the whole collection would delete and re-insert all of them)
+    This is done once the merge is over, as StopTimeUpdates in db are read during the merge.
+    """
+    res = []
+    # StopTimeUpdates in db already kept as is can't replace another one
+    reused_db_sts = {id(st) for st in stop_time_updates}
+    for st in stop_time_updates:
+        db_st = replaced_db_sts.get(id(st))
+        if db_st is not None and id(db_st) not in reused_db_sts:
+            reused_db_sts.add(id(db_st))
+            db_st.update_from(st)
+            st = db_st
+        res.append(st)
+    return res
@@ -30,12 +30,19 @@
 # www.navitia.io
 
 from __future__ import absolute_import, print_function, unicode_literals, division
+import hashlib
+import logging
+from contextlib import contextmanager
 from datetime import timedelta
 from sqlalchemy.dialects import postgresql
-from sqlalchemy.orm import backref, deferred
+from sqlalchemy.orm import backref, deferred, contains_eager, selectinload, object_session
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.ext.orderinglist import ordering_list
+from flask import current_app
 from flask_sqlalchemy import SQLAlchemy
 import datetime
+import time
+import six
 import sqlalchemy
 from sqlalchemy import desc
 from kirin.core.types import ModificationType, TripEffect, ConnectorType
@@ -59,6 +66,18 @@ DEFAULT_DAYS_TO_KEEP_RT_UPDATE = 30
 GTFS_RT_DAYS_TO_KEEP_TRIP_UPDATE = 3
 GTFS_RT_DAYS_TO_KEEP_RT_UPDATE = 10
 
+# max number of dated VJs looked for in one query when searching TripUpdates in bulk
+DATED_VJS_LOOKUP_CHUNK_SIZE = 500
+
+# max number of TripUpdates deleted in one transaction when purging
+PURGE_BATCH_SIZE = 1000
+
+# storages of StopTimeUpdates: a row each in stop_time_update, or a compact array in trip_update
+STOP_TIME_UPDATE_ROWS_STORAGE = "rows"
+STOP_TIME_UPDATE_COMPACT_STORAGE = "compact"
+# key in session.info of the TripUpdates in compact storage whose StopTimeUpdates changed since last flush
+CHANGED_COMPACT_TRIP_UPDATES = "changed_compact_trip_updates"
+
 # force the server to use UTC time for each connection checkouted from the pool
 @sqlalchemy.event.listens_for(sqlalchemy.pool.Pool, "checkout")
 def set_utc_on_connect(dbapi_con, connection_record, connection_proxy):
@@ -67,6 +86,24 @@ def set_utc_on_connect(dbapi_con, connection_record, connection_proxy):
     c.close()
 
 
+@contextmanager
+def count_queries():
+    """
+    Count the SQL statements sent to the database inside the block
+    (the counter is a one-element list, to be read after the block)
+    """
+    counter = [0]
+
+    def _count(*args, **kwargs):
+        counter[0] += 1
+
+    sqlalchemy.event.listen(db.engine, "before_cursor_execute", _count)
+    try:
+        yield counter
+    finally:
+        sqlalchemy.event.remove(db.engine, "before_cursor_execute", _count)
+
+
 def gen_uuid():
     """
     Generate uuid as string
@@ -166,6 +203,78 @@ class VehicleJourney(db.Model):  # type: ignore
     def get_circulation_date(self):
         return self.start_timestamp.date()
 
+    def _get_stop_time_index(self, code_type=None):
+        """
+        Lazily build the index of navitia's stop_times positions (not persisted, built once per VJ and key).
+        Stop_times are indexed by stop_point id, or by the stop_point code of the given type if provided
+        (only the first code of that type is considered for each stop_point).
+        Each key is associated to the ordered list of its positions (a stop may be served multiple times).
+        """
+        stop_time_indexes = getattr(self, "_stop_time_indexes", None)
+        if stop_time_indexes is None:
+            stop_time_indexes = self._stop_time_indexes = {}
+        stop_time_index = stop_time_indexes.get(code_type)
+        if stop_time_index is None:
+            stop_time_index = {}
+            navitia_vj = getattr(self, "navitia_vj", None) or {}
+            for position, vj_st in enumerate(navitia_vj.get("stop_times", [])):
+                stop_point = vj_st.get("stop_point") or {}
+                if code_type is None:
+                    key = stop_point.get("id")
+                else:
+                    key = next((c["value"] for c in stop_point.get("codes", []) if c["type"] == code_type), None)
+                if key is not None:
+                    stop_time_index.setdefault(key, []).append(position)
+            stop_time_indexes[code_type] = stop_time_index
+        return stop_time_index
+
+    def get_stop_time_positions(self, stop_key, code_type=None):
+        """
+        :param stop_key: id of the stop_point (or its code value if code_type is provided)
+        :param code_type: type of the stop_point code to search on (search on stop_point id if None)
+        :return: ordered list of positions of the matching stop_times in navitia's VJ
+        """
+        return self._get_stop_time_index(code_type).get(stop_key, [])
+
+    def _get_stop_area_code_index(self):
+        """
+        Lazily build the index of navitia's stop_times by code of their stop_area (not persisted).
+        Built in a single pass on the VJ, each (type, value) code is associated to the ordered list of
+        stop_times whose stop_area bears it (a stop may be served multiple times).
+        """
+        code_index = getattr(self, "_stop_area_code_index", None)
+        if code_index is None:
+            code_index = {}
+            navitia_vj = getattr(self, "navitia_vj", None) or {}
+            for vj_st in navitia_vj.get("stop_times", []):
+                stop_area = (vj_st.get("stop_point") or {}).get("stop_area") or {}
+                for code in stop_area.get("codes") or []:
+                    stop_times = code_index.setdefault((code.get("type"), code.get("value")), [])
+                    # a stop_area bearing the same code twice still matches its stop_time only once
+                    if not stop_times or stop_times[-1] is not vj_st:
+                        stop_times.append(vj_st)
+            self._stop_area_code_index = code_index
+        return code_index
+
+    def find_navitia_stop_times_by_stop_area_code(self, code_type, code_value):
+        """
+        :return: ordered list of navitia's stop_times whose stop_area bears the given code
+        """
+        return self._get_stop_area_code_index().get((code_type, code_value), [])
+
+    def find_navitia_stop_time(self, stop_point_id, order=None):
+        """
+        Find a stop_time in navitia's VJ
+        To handle a vj with the same stop served multiple times (lollipop) the stop_time at the given order
+        is preferred, otherwise the first stop_time on the stop_point is returned.
+        :return: stop_time if found else None
+        """
+        positions = self.get_stop_time_positions(stop_point_id)
+        if not positions:
+            return None
+        position = order if order in positions else positions[0]
+        return self.navitia_vj["stop_times"][position]
+
 
 class StopTimeUpdate(db.Model, TimestampMixin):  # type: ignore
     """
@@ -195,6 +304,19 @@ class StopTimeUpdate(db.Model, TimestampMixin):  # type: ignore
     arrival_delay = db.Column(db.Interval, nullable=True)
     arrival_status = db.Column(Db_ModificationType, nullable=False, default="none")
 
+    # persisted fields describing the stop time (compared and copied between StopTimeUpdates)
+    _fields = (
+        "stop_id",
+        "message",
+        "order",
+        "departure",
+        "departure_delay",
+        "departure_status",
+        "arrival",
+        "arrival_delay",
+        "arrival_status",
+    )
+
     def __init__(
         self,
         navitia_stop,
@@ -242,17 +364,18 @@ class StopTimeUpdate(db.Model, TimestampMixin):  # type: ignore
         :param other:
         :return:
         """
-        return (
-            self.stop_id != other.stop_id
-            or self.message != other.message
-            or self.order != other.order
-            or self.departure != other.departure
-            or self.departure_delay != other.departure_delay
-            or self.departure_status != other.departure_status
-            or self.arrival != other.arrival
-            or self.arrival_delay != other.arrival_delay
-            or self.arrival_status != other.arrival_status
-        )
+        return any(getattr(self, field) != getattr(other, field) for field in self._fields)
+
+    def update_from(self, other):
+        """
+        Copy the fields of other that differ, so that an existing row is updated
+        (only on the columns that changed) instead of being replaced
+        """
+        for field in self._fields:
+            value = getattr(other, field)
+            if getattr(self, field) != value:
+                setattr(self, field, value)
+        self.navitia_stop = getattr(other, "navitia_stop", None)
 
     def get_stop_event_status(self, event_name):
         if not hasattr(self, "{}_status".format(event_name)):
@@ -317,6 +440,20 @@ class TripUpdate(db.Model, TimestampMixin):  # type: ignore
     headsign = db.Column(db.Text, nullable=True)
     contributor_id = db.Column(db.Text, db.ForeignKey("contributor.id"), nullable=False)
     db.Index("contributor_id_idx", contributor_id)
+    # copy of the VJ's start_timestamp (that never changes), to select TripUpdates of a contributor on a period
+    # with a single index
+    start_timestamp = db.Column(db.DateTime, nullable=False)
+    db.Index("trip_update_contributor_id_start_timestamp_idx", contributor_id, start_timestamp)
+    # serialized GTFS-RT FeedEntity of the TripUpdate, as last published (None if never published)
+    feed_entity = deferred(db.Column(db.LargeBinary, nullable=True))
+    # StopTimeUpdates of the TripUpdate in compact storage (see encode_stop_time_updates()),
+    # None if they are stored in stop_time_update
+    stop_time_updates_data = db.Column(postgresql.JSONB, nullable=True)
+    # fingerprint of the last TripUpdate received and merged into this one (see compute_fingerprint())
+    fingerprint = db.Column(db.Text, nullable=True)
+
+    # persisted fields describing the trip (without its StopTimeUpdates)
+    _fields = ("status", "effect", "message", "company_id", "physical_mode_id", "headsign")
 
     def __init__(
         self,
@@ -330,6 +467,7 @@ class TripUpdate(db.Model, TimestampMixin):  # type: ignore
     ):
         self.created_at = datetime.datetime.utcnow()
         self.vj = vj
+        self.start_timestamp = vj.start_timestamp
         self.status = status
         self.company_id = company_id
         self.effect = effect
@@ -364,44 +502,295 @@ class TripUpdate(db.Model, TimestampMixin):  # type: ignore
         )
 
     @classmethod
-    def find_by_dated_vjs(cls, id_timestamp_tuples):
-        from sqlalchemy import tuple_
+    def find_by_dated_vjs(cls, id_timestamp_tuples, chunk_size=DATED_VJS_LOOKUP_CHUNK_SIZE):
+        """
+        Find TripUpdates of given dated VJs ((navitia_trip_id, start_timestamp) tuples).
+        Dated VJs are searched by chunks of bounded size, and StopTimeUpdates are loaded with a second batched
+        query (a joined eager load would return one row for each StopTimeUpdate of each TripUpdate).
+        """
+        logger = logging.getLogger(__name__)
+        trip_updates = []
+        for chunk_start in range(0, len(id_timestamp_tuples), chunk_size):
+            chunk = id_timestamp_tuples[chunk_start : chunk_start + chunk_size]
+            start_datetime = datetime.datetime.utcnow()
+            with count_queries() as query_count:
+                chunk_trip_updates = cls._find_by_dated_vjs_chunk(chunk)
+            logger.debug(
+                "TripUpdates lookup on {nb_vjs} dated VJs: {nb_tus} found, {nb_queries} queries, {d} s".format(
+                    nb_vjs=len(chunk),
+                    nb_tus=len(chunk_trip_updates),
+                    nb_queries=query_count[0],
+                    d=(datetime.datetime.utcnow() - start_datetime).total_seconds(),
+                )
+            )
+            trip_updates.extend(chunk_trip_updates)
+        return trip_updates
 
-        return (
+    @classmethod
+    def _find_by_dated_vjs_chunk(cls, id_timestamp_tuples):
+        # dated VJs are joined as a VALUES list, that PostgreSQL handles as a small table
+        values = []
+        params = []
+        for i, (navitia_trip_id, start_timestamp) in enumerate(id_timestamp_tuples):
+            values.append("(:navitia_trip_id_{i}, :start_timestamp_{i})".format(i=i))
+            params.append(sqlalchemy.bindparam("navitia_trip_id_{}".format(i), navitia_trip_id, type_=db.Text))
+            params.append(
+                sqlalchemy.bindparam("start_timestamp_{}".format(i), start_timestamp, type_=db.DateTime)
+            )
+        dated_vjs = (
+            sqlalchemy.text(
+                "SELECT * FROM (VALUES {values}) AS dated_vj (navitia_trip_id, start_timestamp)".format(
+                    values=", ".join(values)
+                )
+            )
+            .bindparams(*params)
+            .columns(navitia_trip_id=db.Text, start_timestamp=db.DateTime)
+            .alias("dated_vjs")
+        )
+
+        trip_updates = (
             cls.query.join(VehicleJourney)
-            .filter(
-                tuple_(VehicleJourney.navitia_trip_id, VehicleJourney.start_timestamp).in_(id_timestamp_tuples)
+            .join(
+                dated_vjs,
+                sqlalchemy.and_(
+                    VehicleJourney.navitia_trip_id == dated_vjs.c.navitia_trip_id,
+                    VehicleJourney.start_timestamp == dated_vjs.c.start_timestamp,
+                ),
             )
+            .options(contains_eager(cls.vj), selectinload(cls.stop_time_updates))
             .order_by(VehicleJourney.navitia_trip_id)
             .all()
         )
+        # StopTimeUpdates in compact storage are reset by selectinload, after the load of TripUpdates
+        for trip_update in trip_updates:
+            trip_update.restore_compact_stop_time_updates()
+        return trip_updates
 
     @classmethod
-    def find_by_contributor_period(cls, contributors, start_date=None, end_date=None):
-        query = cls.query.filter(cls.contributor_id.in_(contributors))
+    def filter_by_contributor_period(cls, query, contributors, start_date=None, end_date=None):
+        """
+        Restrict the query to TripUpdates of the contributors whose VJ starts in [start_date, end_date[
+        (uses the index on (contributor_id, start_timestamp))
+        """
+        query = query.filter(cls.contributor_id.in_(contributors))
         if start_date:
-            start_dt = datetime.datetime.combine(start_date, datetime.time(0, 0))
             query = query.filter(
-                sqlalchemy.text("vehicle_journey_1.start_timestamp >= '{start_dt}'".format(start_dt=start_dt))
+                cls.start_timestamp >= datetime.datetime.combine(start_date, datetime.time(0, 0))
             )
         if end_date:
-            end_dt = datetime.datetime.combine(end_date, datetime.time(0, 0))
-            query = query.filter(
-                sqlalchemy.text("vehicle_journey_1.start_timestamp < '{end_dt}'".format(end_dt=end_dt))
+            query = query.filter(cls.start_timestamp < datetime.datetime.combine(end_date, datetime.time(0, 0)))
+        return query
+
+    @classmethod
+    def find_by_contributor_period(cls, contributors, start_date=None, end_date=None):
+        return cls.filter_by_contributor_period(cls.query, contributors, start_date, end_date).all()
+
+    @classmethod
+    def find_feed_entities_by_contributor_period(
+        cls, contributors, start_date=None, end_date=None, chunk_size=1000
+    ):
+        """
+        Iterate on (vj_id, feed_entity) of TripUpdates of the contributors by ascending vj_id, without loading
+        TripUpdates: rows are read by chunks (keyset pagination on vj_id) through a server-side cursor,
+        so that memory doesn't depend on the number of TripUpdates
+        """
+        query = cls.filter_by_contributor_period(
+            db.session.query(cls.vj_id, cls.feed_entity), contributors, start_date, end_date
+        ).order_by(cls.vj_id)
+        last_vj_id = None
+        while True:
+            chunk_query = query if last_vj_id is None else query.filter(cls.vj_id > last_vj_id)
+            nb_rows = 0
+            for row in chunk_query.limit(chunk_size).yield_per(chunk_size):
+                nb_rows += 1
+                last_vj_id = row.vj_id
+                yield row
+            if nb_rows < chunk_size:
+                return
+
+    @classmethod
+    def remove_batch_by_contributors_and_period(
+        cls, contributors, start_date=None, end_date=None, batch_size=PURGE_BATCH_SIZE
+    ):
+        """
+        Delete (without loading them) at most batch_size TripUpdates of the contributors on the period
+        by deleting their VJ: TripUpdates, StopTimeUpdates and associations to RealTimeUpdates
+        are deleted by the db (ON DELETE CASCADE)
+        :return: the number of TripUpdates deleted
+        """
+        vj_ids = cls.filter_by_contributor_period(
+            db.session.query(cls.vj_id), contributors, start_date, end_date
+        ).limit(batch_size)
+        return VehicleJourney.query.filter(VehicleJourney.id.in_(vj_ids)).delete(synchronize_session=False)
+
+    @classmethod
+    def remove_by_contributors_and_period(
+        cls, contributors, start_date=None, end_date=None, batch_size=PURGE_BATCH_SIZE, sleep_ratio=0
+    ):
+        """
+        Delete TripUpdates of the contributors on the period by batches, committing after each batch
+        so that locks are held briefly.
+        Between batches, sleep for sleep_ratio times the duration of the last batch:
+        the more the db is loaded, the slower the purge goes.
+        :return: the number of TripUpdates deleted
+        """
+        logger = logging.getLogger(__name__)
+        start = time.time()
+        nb_deleted = 0
+        while True:
+            batch_start = time.time()
+            nb_batch_deleted = cls.remove_batch_by_contributors_and_period(
+                contributors, start_date, end_date, batch_size
+            )
+            db.session.commit()
+            batch_duration = time.time() - batch_start
+            nb_deleted += nb_batch_deleted
+            logger.info(
+                "purge of TripUpdates of {} until {}: {} deleted ({} in {:.2f} s)".format(
+                    contributors, end_date, nb_deleted, nb_batch_deleted, batch_duration
+                ),
+                extra={
+                    str("trip_update_deleted_count"): nb_deleted,
+                    str("duration"): time.time() - start,
+                },
             )
-        return query.all()
+            if nb_batch_deleted < batch_size:
+                return nb_deleted
+            time.sleep(batch_duration * sleep_ratio)
+
+    @classmethod
+    def prune_real_time_update_links(cls, vj_ids, max_count=None, max_age=None):
+        """
+        Delete links of the TripUpdates to their RealTimeUpdates beyond the max_count most recent ones,
+        or to RealTimeUpdates created more than max_age (timedelta) ago (nothing is committed)
+        :return: the number of links deleted
+        """
+        if not vj_ids or (max_count is None and max_age is None):
+            return 0
+        conditions = []
+        params = {"vj_ids": tuple(vj_ids)}
+        if max_count is not None:
+            conditions.append("links.rank > :max_count")
+            params["max_count"] = max_count
+        if max_age is not None:
+            conditions.append("links.created_at < :min_created_at")
+            params["min_created_at"] = datetime.datetime.utcnow() - max_age
+        return db.session.execute(
+            """
+            DELETE FROM associate_realtimeupdate_tripupdate a USING (
+                SELECT l.real_time_update_id, l.trip_update_id, rtu.created_at,
+                    row_number() OVER (
+                        PARTITION BY l.trip_update_id ORDER BY rtu.created_at DESC, rtu.id DESC
+                    ) AS rank
+                FROM associate_realtimeupdate_tripupdate l
+                JOIN real_time_update rtu ON rtu.id = l.real_time_update_id
+                WHERE l.trip_update_id IN :vj_ids
+            ) links
+            WHERE a.real_time_update_id = links.real_time_update_id AND a.trip_update_id = links.trip_update_id
+            AND ({conditions})
+            """.format(
+                conditions=" OR ".join(conditions)
+            ),
+            params,
+        ).rowcount
 
     @classmethod
-    def remove_by_contributors_and_period(cls, contributors, start_date=None, end_date=None):
-        trip_updates_to_remove = cls.find_by_contributor_period(
-            contributors=contributors, start_date=start_date, end_date=end_date
+    def convert_stop_time_update_storage_batch(cls, storage, batch_size):
+        """
+        Convert the StopTimeUpdates of at most batch_size TripUpdates to the given storage (not committed)
+        :return: the number of TripUpdates converted
+        """
+        to_compact = storage == STOP_TIME_UPDATE_COMPACT_STORAGE
+        trip_updates = (
+            cls.query.filter(
+                cls.stop_time_updates_data.is_(None) if to_compact else cls.stop_time_updates_data.isnot(None)
+            )
+            .limit(batch_size)
+            .all()
         )
-        for t in trip_updates_to_remove:
-            f = sqlalchemy.text("associate_realtimeupdate_tripupdate.trip_update_id='{}'".format(t.vj_id))
-            db.session.query(associate_realtimeupdate_tripupdate).filter(f).delete(synchronize_session=False)
-            db.session.delete(t)
+        if not trip_updates:
+            return 0
+        vj_ids = [tu.vj_id for tu in trip_updates]
+        if to_compact:
+            for tu in trip_updates:
+                tu.stop_time_updates_data = encode_stop_time_updates(tu.stop_time_updates)
+            db.session.flush()
+            db.session.execute(
+                StopTimeUpdate.__table__.delete().where(StopTimeUpdate.trip_update_id.in_(vj_ids))
+            )
+        else:
+            rows = []
+            for tu in trip_updates:
+                for st in decode_stop_time_updates(tu.stop_time_updates_data):
+                    row = {field: getattr(st, field) for field in StopTimeUpdate._fields}
+                    row.update(id=st.id, trip_update_id=tu.vj_id)
+                    rows.append(row)
+            if rows:
+                db.session.execute(StopTimeUpdate.__table__.insert(), rows)
+            db.session.execute(
+                cls.__table__.update().where(cls.vj_id.in_(vj_ids)).values(stop_time_updates_data=None)
+            )
+        # the TripUpdates loaded are stale
+        db.session.expire_all()
+        return len(trip_updates)
 
-        db.session.commit()
+    def compute_fingerprint(self):
+        """
+        Stable digest of the realtime content of a TripUpdate received (before merge), and of the base-schedule
+        it applies to: merging again a TripUpdate with the same fingerprint changes nothing
+        """
+        navitia_vj = getattr(self.vj, "navitia_vj", None) or {}
+        content = [
+            [getattr(self, field) for field in self._fields],
+            [[getattr(st, field) for field in StopTimeUpdate._fields] for st in self.stop_time_updates],
+            [
+                [st.get("stop_point", {}).get("id"), st.get("utc_arrival_time"), st.get("utc_departure_time")]
+                for st in navitia_vj.get("stop_times", [])
+            ],
+        ]
+        return hashlib.sha1(six.text_type(content).encode("utf-8")).hexdigest()
+
+    def is_compact(self):
+        return self.__dict__.get("stop_time_updates_data") is not None
+
+    def restore_compact_stop_time_updates(self):
+        """
+        Set the StopTimeUpdates in compact storage as the loaded stop_time_updates
+        (they are not in the session, as they have no row in stop_time_update)
+        """
+        if self.is_compact():
+            stop_time_updates = decode_stop_time_updates(self.stop_time_updates_data)
+            for st in stop_time_updates:
+                st._compact_trip_update = self
+            set_committed_value(self, "stop_time_updates", stop_time_updates)
+            self.reset_stop_index()
+
+    def mark_stop_time_updates_changed(self):
+        """
+        Register the TripUpdate to encode its StopTimeUpdates at next flush (if in compact storage):
+        only changed TripUpdates are encoded
+        """
+        if self.is_compact():
+            session = object_session(self)
+            if session is not None:
+                session.info.setdefault(CHANGED_COMPACT_TRIP_UPDATES, set()).add(self)
+
+    def _get_stop_index(self):
+        """
+        Lazily build the index of StopTimeUpdates by stop_id (reset each time stop_time_updates is modified).
+        Each stop_id is associated to the list of its StopTimeUpdates (a stop may be served multiple times),
+        in the order of stop_time_updates.
+        """
+        stop_index = getattr(self, "_stop_index", None)
+        if stop_index is None:
+            stop_index = {}
+            for st in self.stop_time_updates:
+                stop_index.setdefault(st.stop_id, []).append(st)
+            self._stop_index = stop_index
+        return stop_index
+
+    def reset_stop_index(self):
+        self._stop_index = None
 
     def find_stop(self, stop_id, order=None):
         # To handle a vj with the same stop served multiple times (lollipop) we search first with
@@ -409,10 +798,165 @@ class TripUpdate(db.Model, TimestampMixin):  # type: ignore
         # For COTS, since we don't care about the order, search only with stop_id if no element found
         # Note: if the trip_update stops list is not a strict ending sublist of stops list of navitia_vj
         # then the whole trip is ignored in model_maker.
-        first = next((st for st in self.stop_time_updates if st.stop_id == stop_id and st.order == order), None)
+        # Order is checked on the StopTimeUpdates found for stop_id (not indexed), as ordering_list may
+        # re-number StopTimeUpdates.
+        stop_time_updates = self._get_stop_index().get(stop_id)
+        if not stop_time_updates:
+            return None
+        first = next((st for st in stop_time_updates if st.order == order), None)
         if first:
             return first
-        return next((st for st in self.stop_time_updates if st.stop_id == stop_id), None)
+        return stop_time_updates[0]
+
+
+@sqlalchemy.event.listens_for(TripUpdate.stop_time_updates, "append")
+@sqlalchemy.event.listens_for(TripUpdate.stop_time_updates, "remove")
+def _reset_stop_index_on_change(trip_update, stop_time_update, initiator):
+    trip_update.reset_stop_index()
+    trip_update.mark_stop_time_updates_changed()
+    # in compact storage, changes of the StopTimeUpdate itself are changes of its TripUpdate
+    stop_time_update._compact_trip_update = trip_update
+
+
+@sqlalchemy.event.listens_for(TripUpdate.stop_time_updates, "bulk_replace")
+def _reset_stop_index_on_replace(trip_update, stop_time_updates, initiator):
+    # assignment of a new list (same members in a new order fire neither append nor remove)
+    trip_update.reset_stop_index()
+    trip_update.mark_stop_time_updates_changed()
+
+
+def _mark_compact_trip_update_on_set(stop_time_update, value, oldvalue, initiator):
+    trip_update = stop_time_update.__dict__.get("_compact_trip_update")
+    if trip_update is not None:
+        trip_update.mark_stop_time_updates_changed()
+
+
+for _field in StopTimeUpdate._fields:
+    sqlalchemy.event.listen(getattr(StopTimeUpdate, _field), "set", _mark_compact_trip_update_on_set)
+
+
+@sqlalchemy.event.listens_for(TripUpdate, "expire")
+def _reset_stop_index_on_expire(trip_update, attrs):
+    trip_update.reset_stop_index()
+
+
+@sqlalchemy.event.listens_for(TripUpdate, "refresh")
+def _reset_stop_index_on_refresh(trip_update, context, attrs):
+    trip_update.reset_stop_index()
+    if attrs is None or "stop_time_updates" in attrs:
+        trip_update.restore_compact_stop_time_updates()
+
+
+@sqlalchemy.event.listens_for(TripUpdate, "load")
+def _restore_compact_stop_time_updates_on_load(trip_update, context):
+    trip_update.restore_compact_stop_time_updates()
+
+
+def get_stop_time_update_storage():
+    return current_app.config.get(str("STOP_TIME_UPDATE_STORAGE"), STOP_TIME_UPDATE_ROWS_STORAGE)
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, "before_flush")
+def _store_compact_stop_time_updates(session, flush_context, instances):
+    """
+    New TripUpdates take the configured storage, others keep theirs (see 'migrate_stop_time_update_storage').
+    StopTimeUpdates of TripUpdates in compact storage are encoded in the TripUpdate and never flushed:
+    only new TripUpdates and the ones whose StopTimeUpdates changed are encoded.
+    """
+    changed_trip_updates = session.info.pop(CHANGED_COMPACT_TRIP_UPDATES, set())
+    is_compact_storage = get_stop_time_update_storage() == STOP_TIME_UPDATE_COMPACT_STORAGE
+    for obj in session.new:
+        if isinstance(obj, TripUpdate):
+            if is_compact_storage and not obj.is_compact():
+                obj.stop_time_updates_data = []
+            changed_trip_updates.add(obj)
+    compact_stop_time_updates = set()
+    for obj in changed_trip_updates:
+        if not obj.is_compact() or "stop_time_updates" not in obj.__dict__ or obj in session.deleted:
+            continue
+        stop_time_updates = list(obj.stop_time_updates)
+        obj.stop_time_updates_data = encode_stop_time_updates(stop_time_updates)
+        # the collection is marked as unchanged, so that no row is inserted or deleted for its items
+        set_committed_value(obj, "stop_time_updates", stop_time_updates)
+        compact_stop_time_updates.update(id(st) for st in stop_time_updates)
+    for obj in list(session.new):
+        if isinstance(obj, StopTimeUpdate) and id(obj) in compact_stop_time_updates:
+            session.expunge(obj)
+
+
+# compact storage: a list of StopTimeUpdates, each being [id, stop_id, order, message,
+# departure, departure_delay, departure_status, arrival, arrival_delay, arrival_status]
+# with datetimes as seconds since EPOCH (UTC) and delays in seconds
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def _to_seconds(value):
+    if value is None:
+        return None
+    if isinstance(value, datetime.datetime):
+        value = value - EPOCH
+    return int(value.total_seconds())
+
+
+def _to_datetime(seconds):
+    return EPOCH + timedelta(seconds=seconds) if seconds is not None else None
+
+
+def _to_timedelta(seconds):
+    return timedelta(seconds=seconds) if seconds is not None else None
+
+
+def encode_stop_time_updates(stop_time_updates):
+    return [
+        [
+            st.id,
+            st.stop_id,
+            st.order,
+            st.message,
+            _to_seconds(st.departure),
+            _to_seconds(st.departure_delay),
+            st.departure_status,
+            _to_seconds(st.arrival),
+            _to_seconds(st.arrival_delay),
+            st.arrival_status,
+        ]
+        for st in stop_time_updates
+    ]
+
+
+def _decode_stop_time_update(id, *fields):
+    stop_time_update = StopTimeUpdate(*fields)
+    stop_time_update.id = id
+    return stop_time_update
+
+
+def decode_stop_time_updates(data):
+    return [
+        _decode_stop_time_update(
+            id,
+            {"id": stop_id},
+            _to_datetime(departure),
+            _to_datetime(arrival),
+            _to_timedelta(departure_delay),
+            _to_timedelta(arrival_delay),
+            departure_status,
+            arrival_status,
+            message,
+            order,
+        )
+        for (
+            id,
+            stop_id,
+            order,
+            message,
+            departure,
+            departure_delay,
+            departure_status,
+            arrival,
+            arrival_delay,
+            arrival_status,
+        ) in data
+    ]
 
 
 class RealTimeUpdate(db.Model, TimestampMixin):  # type: ignore
@@ -428,7 +972,7 @@ class RealTimeUpdate(db.Model, TimestampMixin):  # type: ignore
 
     id = db.Column(postgresql.UUID, default=gen_uuid, primary_key=True)
     connector = db.Column(Db_ConnectorType, nullable=False)
-    status = db.Column(db.Enum("OK", "KO", "pending", name="rt_status"), nullable=False)
+    status = db.Column(db.Enum("OK", "KO", "pending", "superseded", name="rt_status"), nullable=False)
     db.Index("status_idx", status)
     error = db.Column(db.Text, nullable=True)
     raw_data = deferred(db.Column(db.Text, nullable=True))
@@ -484,18 +1028,32 @@ class RealTimeUpdate(db.Model, TimestampMixin):  # type: ignore
         return result
 
     @classmethod
-    def remove_by_contributors_until(cls, contributors, until):
-        sub_query = (
+    def _query_removable_ids(cls, contributors, until):
+        return (
             db.session.query(cls.id)
             .outerjoin(associate_realtimeupdate_tripupdate)
             .filter(cls.contributor_id.in_(contributors))
             .filter(cls.created_at < until)
             .filter(associate_realtimeupdate_tripupdate.c.real_time_update_id == None)
         )  # '==' works, not 'is'
+
+    @classmethod
+    def remove_by_contributors_until(cls, contributors, until):
+        sub_query = cls._query_removable_ids(contributors, until)
         cls.query.filter(cls.id.in_(sub_query)).delete(synchronize_session=False)
 
         db.session.commit()
 
+    @classmethod
+    def remove_batch_by_contributors_until(cls, contributors, until, batch_size=PURGE_BATCH_SIZE):
+        """
+        Delete at most batch_size RealTimeUpdates of the contributors created before until
+        and not referenced by any TripUpdate (nothing is committed)
+        :return: the number of RealTimeUpdates deleted
+        """
+        sub_query = cls._query_removable_ids(contributors, until).limit(batch_size)
+        return cls.query.filter(cls.id.in_(sub_query)).delete(synchronize_session=False)
+
     @classmethod
     def get_last_rtu(cls, connector_type, contributor_id):
         q = cls.query.filter_by(connector=connector_type, contributor_id=contributor_id)
@@ -559,3 +1117,49 @@ class Contributor(db.Model):  # type: ignore
     @classmethod
     def query_existing(cls):
         return cls.query.filter_by(is_active=True)
+
+
+class FeedOutbox(db.Model):  # type: ignore
+    """
+    Feed to be published for navitia, written in the same transaction as the TripUpdates it contains,
+    then published (in order) and deleted by the 'dispatch_outbox' command
+    """
+
+    id = db.Column(db.BigInteger, primary_key=True)
+    created_at = db.Column(db.DateTime(), default=datetime.datetime.utcnow, nullable=False)
+    contributor_id = db.Column(db.Text, db.ForeignKey("contributor.id"), nullable=False)
+    feed = db.Column(db.LargeBinary, nullable=False)
+
+    def __init__(self, contributor_id, feed):
+        self.contributor_id = contributor_id
+        self.feed = feed
+
+    # first key of the transaction-level advisory locks serializing the writers of the outbox
+    # (the second one being the hash of the contributor)
+    WRITERS_LOCK_NAMESPACE = 716673529
+
+    @classmethod
+    def lock_writers(cls, contributor_id):
+        """
+        Wait for the other transactions writing feeds of the contributor in the outbox to end, and block the next
+        ones until the end of the current transaction: the feeds of a contributor are committed in the order of
+        their ids, so none is dispatched out of order (the order between contributors doesn't matter)
+        """
+        db.session.execute(
+            sqlalchemy.text("SELECT pg_advisory_xact_lock(:namespace, hashtext(:contributor_id))"),
+            {"namespace": cls.WRITERS_LOCK_NAMESPACE, "contributor_id": contributor_id},
+        )
+
+    @classmethod
+    def lock_next(cls, limit):
+        """
+        :return: the oldest feeds to publish, locked until the end of the transaction
+        """
+        return cls.query.order_by(cls.id).limit(limit).with_for_update().all()
+
+    @classmethod
+    def remove(cls, ids):
+        """
+        Remove exactly the given feeds (a range could include feeds committed after they were locked)
+        """
+        cls.query.filter(cls.id.in_(ids)).delete(synchronize_session=False)
@@ -0,0 +1,215 @@
+# coding=utf-8
+
+# Copyright (c) 2001, Canal TP and/or its affiliates. All rights reserved.
+#
+# This file is part of Navitia,
+#     the software to build cool stuff with public transport.
+#
+# Hope you'll enjoy and contribute to this project,
+#     powered by Canal TP (www.canaltp.fr).
+# Help us simplify mobility and open public transport:
+#     a non ending quest to the responsive locomotion way of traveling!
+#
+# LICENCE: This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Stay tuned using
+# twitter @navitia
+# [matrix] channel #navitia:matrix.org (https://app.element.io/#/room/#navitia:matrix.org)
+# https://groups.google.com/d/forum/navitia
+# www.navitia.io
+
+
+from __future__ import absolute_import, print_function, unicode_literals, division
+
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+
+from flask import current_app
+
+from kirin.exceptions import SubServiceError
+
+# number of objects requested per page when downloading a whole collection
+NAVITIA_REFERENTIAL_PAGE_SIZE = 1000
+
+# Process-wide referentials: {navitia coverage url: NavitiaReferential}
+_referentials = {}
+
+
+class NavitiaReferential(object):
+    """
+    Warm cache of the referential of a navitia coverage: companies, physical modes and stop_points.
+
+    The whole referential is downloaded in the background on first use, then again each time navitia's
+    publication date changes (checked every NAVITIA_REFERENTIAL_CHECK_INTERVAL), the previous referential being
+    used in the meantime.
+    Objects that can't be found in it (not loaded yet, missing) are requested to navitia using the given fallback.
+    """
+
+    def __init__(self, navitia):
+        self.navitia = navitia
+        self.publication_date = None
+        self.checked_at = None
+        # navitia's current publication date (the referential may not be loaded for it yet)
+        self.navitia_publication_date = None
+        self.navitia_publication_date_checked_at = None
+        self.load_thread = None
+        self.is_loaded = False
+        self.companies_by_code = {}
+        self.physical_modes_by_id = {}
+        self.stop_points_by_stop_area_code = {}
+        self.nb_hits = 0
+        self.nb_misses = 0
+
+    def _query_collection(self, collection):
+        start_page = 0
+        while True:
+            response, status = self.navitia.query(
+                "{}/".format(collection),
+                q={"count": str(NAVITIA_REFERENTIAL_PAGE_SIZE), "start_page": str(start_page)},
+            )
+            if status != 200:
+                raise SubServiceError("navitia returned status {} on {}".format(status, collection))
+            objects = response.get(collection, [])
+            for obj in objects:
+                yield obj
+            pagination = response.get("pagination", {})
+            if not objects or (start_page + 1) * NAVITIA_REFERENTIAL_PAGE_SIZE >= pagination.get(
+                "total_result", 0
+            ):
+                return
+            start_page += 1
+
+    def load(self, publication_date):
+        start = time.time()
+        companies_by_code = {}
+        for company in self._query_collection("companies"):
+            for code in company.get("codes", []):
+                companies_by_code.setdefault((code.get("type"), code.get("value")), company)
+        physical_modes_by_id = {pm.get("id"): pm for pm in self._query_collection("physical_modes")}
+        # as for a 'stop_area.has_code()' filter, the first stop_point of the stop_area is kept
+        stop_points_by_stop_area_code = {}
+        for stop_point in self._query_collection("stop_points"):
+            for code in (stop_point.get("stop_area") or {}).get("codes", []):
+                stop_points_by_stop_area_code.setdefault((code.get("type"), code.get("value")), stop_point)
+
+        self.companies_by_code = companies_by_code
+        self.physical_modes_by_id = physical_modes_by_id
+        self.stop_points_by_stop_area_code = stop_points_by_stop_area_code
+        self.publication_date = publication_date
+        self.is_loaded = True
+        logging.getLogger(__name__).info(
+            "navitia referential of {} loaded in {:.2f} s: {} companies codes, {} physical modes, "
+            "{} stop_area codes".format(
+                self.navitia.url,
+                time.time() - start,
+                len(companies_by_code),
+                len(physical_modes_by_id),
+                len(stop_points_by_stop_area_code),
+            )
+        )
+
+    def _load_in_background(self, publication_date):
+        def _load():
+            try:
+                self.load(publication_date)
+            except Exception as e:
+                # keep the previous referential if any, it will be reloaded on next check
+                logging.getLogger(__name__).warning(
+                    "impossible to load navitia referential of {}: {}".format(self.navitia.url, e)
+                )
+
+        self.load_thread = threading.Thread(target=_load, name=str("navitia_referential"))
+        self.load_thread.daemon = True
+        self.load_thread.start()
+
+    def _get_check_interval(self):
+        return timedelta(seconds=current_app.config.get(str("NAVITIA_REFERENTIAL_CHECK_INTERVAL"), 60))
+
+    def get_publication_date(self):
+        """
+        :return: navitia's publication date, requested at most once every NAVITIA_REFERENTIAL_CHECK_INTERVAL
+        (the referential is not loaded for it)
+        """
+        now = datetime.utcnow()
+        checked_at = self.navitia_publication_date_checked_at
+        if checked_at is None or now - checked_at >= self._get_check_interval():
+            self.navitia_publication_date = self.navitia.get_publication_date()
+            self.navitia_publication_date_checked_at = now
+        return self.navitia_publication_date
+
+    def refresh(self):
+        """
+        (Re)load the referential in the background if never loaded or if navitia's publication date changed
+        """
+        now = datetime.utcnow()
+        if self.checked_at is not None and now - self.checked_at < self._get_check_interval():
+            return
+        if self.load_thread is not None and self.load_thread.is_alive():
+            return
+        self.checked_at = now
+        try:
+            publication_date = self.get_publication_date()
+        except Exception as e:
+            logging.getLogger(__name__).warning("impossible to get navitia's publication date: {}".format(e))
+            return
+        if not self.is_loaded or publication_date != self.publication_date:
+            self._load_in_background(publication_date)
+
+    def _find(self, index_name, key, request_fallback):
+        self.refresh()
+        obj = getattr(self, index_name).get(key)
+        if obj is None:
+            self.nb_misses += 1
+            return request_fallback()
+        self.nb_hits += 1
+        return obj
+
+    def find_company(self, code_type, code_value, request_fallback):
+        return self._find("companies_by_code", (code_type, code_value), request_fallback)
+
+    def find_physical_mode(self, physical_mode_id, request_fallback):
+        return self._find("physical_modes_by_id", physical_mode_id, request_fallback)
+
+    def find_stop_point_by_stop_area_code(self, code_type, code_value, request_fallback):
+        return self._find("stop_points_by_stop_area_code", (code_type, code_value), request_fallback)
+
+    def get_status(self):
+        return {
+            "publication_date": self.publication_date,
+            "is_loaded": self.is_loaded,
+            "nb_hits": self.nb_hits,
+            "nb_misses": self.nb_misses,
+        }
+
+
+def get_navitia_referential(navitia):
+    """
+    :param navitia: navitia_wrapper instance of the coverage (the last one provided is used to query navitia)
+    :return: the referential of the coverage, shared by all builders of this process
+    """
+    referential = _referentials.get(navitia.url)
+    if referential is None:
+        referential = _referentials[navitia.url] = NavitiaReferential(navitia)
+    referential.navitia = navitia
+    return referential
+
+
+def get_navitia_referentials_status():
+    return {url: referential.get_status() for url, referential in _referentials.items()}
+
+
+def clear():
+    _referentials.clear()
@@ -0,0 +1,125 @@
+# coding=utf-8
+
+# Copyright (c) 2001, Canal TP and/or its affiliates. All rights reserved.
+#
+# This file is part of Navitia,
+#     the software to build cool stuff with public transport.
+#
+# Hope you'll enjoy and contribute to this project,
+#     powered by Canal TP (www.canaltp.fr).
+# Help us simplify mobility and open public transport:
+#     a non ending quest to the responsive locomotion way of traveling!
+#
+# LICENCE: This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Stay tuned using
+# twitter @navitia
+# [matrix] channel #navitia:matrix.org (https://app.element.io/#/room/#navitia:matrix.org)
+# https://groups.google.com/d/forum/navitia
+# www.navitia.io
+
+
+from __future__ import absolute_import, print_function, unicode_literals, division
+
+import datetime
+import logging
+
+from flask import current_app
+
+import kirin
+from kirin import gtfs_realtime_pb2
+from kirin.core.model import FeedOutbox, db
+from kirin.core.populate_pb import make_feed_header, serialize_feed
+from kirin.utils import record_call
+
+
+def is_outbox_enabled():
+    return current_app.config.get(str("USE_FEED_OUTBOX"), False)
+
+
+def add_to_outbox(contributor_id, serialized_entities):
+    """
+    Add the DIFFERENTIAL feed of the given serialized FeedEntities to the outbox, in the current transaction
+    (nothing is committed: the feed is published once committed with the TripUpdates)
+    Returns the log_dict
+    """
+    header = make_feed_header(gtfs_realtime_pb2.FeedHeader.DIFFERENTIAL)
+    feed_str = serialize_feed(header, serialized_entities)
+    FeedOutbox.lock_writers(contributor_id)
+    db.session.add(FeedOutbox(contributor_id, feed_str))
+    return {
+        "contributor": contributor_id,
+        "timestamp": datetime.datetime.utcfromtimestamp(header.timestamp),
+        "trip_update_count": len(serialized_entities),
+        "size": len(feed_str),
+    }
+
+
+def merge_feeds(feed_strs):
+    """
+    Merge consecutive DIFFERENTIAL feeds into one: each entity is kept in its last state, at its last position
+    """
+    merged_feed = gtfs_realtime_pb2.FeedMessage()
+    entities = []
+    for feed_str in feed_strs:
+        feed = gtfs_realtime_pb2.FeedMessage()
+        feed.ParseFromString(feed_str)
+        merged_feed.header.CopyFrom(feed.header)
+        entity_ids = {entity.id for entity in feed.entity}
+        entities = [entity for entity in entities if entity.id not in entity_ids]
+        entities.extend(feed.entity)
+    merged_feed.entity.extend(entities)
+    return merged_feed
+
+
+def dispatch_outbox(batch_size):
+    """
+    Publish the oldest feeds of the outbox in order, consecutive feeds of a contributor being merged,
+    then remove them from the outbox once confirmed by the broker.
+    A failure before the removal leads to publishing them again (at-least-once delivery).
+    Returns the number of feeds dispatched
+    """
+    outbox_feeds = FeedOutbox.lock_next(batch_size)
+    if not outbox_feeds:
+        db.session.commit()  # release the transaction
+        return 0
+
+    # group consecutive feeds of the same contributor
+    groups = []
+    for outbox_feed in outbox_feeds:
+        if groups and groups[-1][-1].contributor_id == outbox_feed.contributor_id:
+            groups[-1].append(outbox_feed)
+        else:
+            groups.append([outbox_feed])
+
+    now = datetime.datetime.utcnow()
+    for group in groups:
+        contributor_id = group[0].contributor_id
+        feed = merge_feeds([outbox_feed.feed for outbox_feed in group])
+        feed_str = feed.SerializeToString()
+        kirin.rmq_handler.publish(feed_str, contributor_id, wait_for_confirm=False)
+        log_dict = {
+            "contributor": contributor_id,
+            "feed_count": len(group),
+            "trip_update_count": len(feed.entity),
+            "size": len(feed_str),
+            "outbox_delay": (now - group[0].created_at).total_seconds(),
+        }
+        record_call("Outbox feed publication", **log_dict)
+        logging.getLogger(__name__).info("Outbox feed publication", extra=log_dict)
+    kirin.rmq_handler.wait_for_confirms()
+
+    FeedOutbox.remove([outbox_feed.id for outbox_feed in outbox_feeds])
+    db.session.commit()
+    return len(outbox_feeds)
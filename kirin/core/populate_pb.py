@@ -30,10 +30,21 @@
 # www.navitia.io
 from __future__ import absolute_import, print_function, unicode_literals, division
 
+import io
+import logging
+import time
+
+from google.protobuf.internal.encoder import _VarintBytes
+
 from kirin import gtfs_realtime_pb2, kirin_pb2
+from kirin.core.model import TripUpdate, db
 from kirin.core.types import stop_time_status_to_protobuf, ModificationType
 import datetime
 
+# tags of FeedMessage's fields (length-delimited): header = 1, entity = 2
+FEED_HEADER_TAG = _VarintBytes(1 << 3 | 2)
+FEED_ENTITY_TAG = _VarintBytes(2 << 3 | 2)
+
 
 def date_to_str(date):
     if date:
@@ -60,6 +71,107 @@ def convert_to_gtfsrt(trip_updates, incrementality=gtfs_realtime_pb2.FeedHeader.
     return feed
 
 
+def make_feed_header(incrementality=gtfs_realtime_pb2.FeedHeader.DIFFERENTIAL):
+    header = gtfs_realtime_pb2.FeedHeader()
+    header.incrementality = incrementality
+    header.gtfs_realtime_version = "1"
+    header.timestamp = to_posix_time(datetime.datetime.utcnow())
+    return header
+
+
+def serialize_entity(trip_update):
+    pb_entity = gtfs_realtime_pb2.FeedEntity()
+    fill_entity(pb_entity, trip_update)
+    return pb_entity.SerializeToString()
+
+
+def _write_field(output, tag, value_str):
+    output.write(tag)
+    output.write(_VarintBytes(len(value_str)))
+    output.write(value_str)
+
+
+def serialize_feed(header, serialized_entities):
+    """
+    Serialize a FeedMessage from its header and already serialized FeedEntities, without decoding them
+    (the encoding of a message being the concatenation of the encoding of its fields)
+    """
+    output = io.BytesIO()
+    _write_field(output, FEED_HEADER_TAG, header.SerializeToString())
+    for entity_str in serialized_entities:
+        _write_field(output, FEED_ENTITY_TAG, entity_str)
+    return output.getvalue()
+
+
+def cache_feed_entities(trip_updates):
+    """
+    Store the serialized FeedEntity of each TripUpdate in it (to be committed with it)
+    Returns the serialized FeedEntities
+    """
+    serialized_entities = []
+    for trip_update in trip_updates:
+        trip_update.feed_entity = serialize_entity(trip_update)
+        serialized_entities.append(trip_update.feed_entity)
+    return serialized_entities
+
+
+def write_full_gtfsrt(output, contributors, start_date=None, end_date=None, chunk_size=1000):
+    """
+    Write the serialized FULL_DATASET feed of the contributors in output, entity by entity,
+    from the FeedEntities stored in TripUpdates (TripUpdates without stored FeedEntity are converted by chunks)
+    Returns the number of entities written
+    """
+    _write_field(
+        output, FEED_HEADER_TAG, make_feed_header(gtfs_realtime_pb2.FeedHeader.FULL_DATASET).SerializeToString()
+    )
+    nb_entities = 0
+    vj_ids_to_convert = []
+
+    def _write_converted_entities():
+        for trip_update in TripUpdate.query.filter(TripUpdate.vj_id.in_(vj_ids_to_convert)).all():
+            _write_field(output, FEED_ENTITY_TAG, serialize_entity(trip_update))
+            # only needed once: don't keep it (and its VJ and StopTimeUpdates) in the identity map
+            db.session.expunge(trip_update)
+        del vj_ids_to_convert[:]
+
+    for vj_id, feed_entity in TripUpdate.find_feed_entities_by_contributor_period(
+        contributors, start_date, end_date, chunk_size=chunk_size
+    ):
+        nb_entities += 1
+        if feed_entity is None:
+            vj_ids_to_convert.append(vj_id)
+            if len(vj_ids_to_convert) >= chunk_size:
+                _write_converted_entities()
+        else:
+            _write_field(output, FEED_ENTITY_TAG, bytes(feed_entity))
+    if vj_ids_to_convert:
+        _write_converted_entities()
+    return nb_entities
+
+
+def convert_to_full_gtfsrt_str(contributors, start_date=None, end_date=None, chunk_size=1000):
+    """
+    Serialize the FULL_DATASET feed of the contributors (see write_full_gtfsrt())
+    Returns the serialized feed and its number of entities
+
+    The feed is published as a single AMQP message, so it is held in memory as a whole:
+    the buffer is released as soon as its content is copied to limit the peak to about twice the feed size
+    """
+    start = time.time()
+    output = io.BytesIO()
+    nb_entities = write_full_gtfsrt(output, contributors, start_date, end_date, chunk_size=chunk_size)
+    feed_str = output.getvalue()
+    output.close()
+    duration = max(time.time() - start, 1e-6)
+    logging.getLogger(__name__).info(
+        "full feed of {} built: {} entities ({:.0f} rows/s), {} bytes ({:.0f} bytes/s)".format(
+            contributors, nb_entities, nb_entities / duration, len(feed_str), len(feed_str) / duration
+        ),
+        extra={str("duration"): duration, str("trip_update_count"): nb_entities, str("size"): len(feed_str)},
+    )
+    return feed_str, nb_entities
+
+
 def get_st_event(st_status):
     if st_status in ("delete", "deleted_for_detour"):
         return gtfs_realtime_pb2.TripUpdate.StopTimeUpdate.SKIPPED
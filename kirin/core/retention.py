@@ -0,0 +1,127 @@
+# coding=utf-8
+
+# Copyright (c) 2001, Canal TP and/or its affiliates. All rights reserved.
+#
+# This file is part of Navitia,
+#     the software to build cool stuff with public transport.
+#
+# Hope you'll enjoy and contribute to this project,
+#     powered by Canal TP (www.canaltp.fr).
+# Help us simplify mobility and open public transport:
+#     a non ending quest to the responsive locomotion way of traveling!
+#
+# LICENCE: This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Stay tuned using
+# twitter @navitia
+# [matrix] channel #navitia:matrix.org (https://app.element.io/#/room/#navitia:matrix.org)
+# https://groups.google.com/d/forum/navitia
+# www.navitia.io
+
+
+from __future__ import absolute_import, print_function, unicode_literals, division
+
+import datetime
+import logging
+
+from kirin.core.model import Contributor, RealTimeUpdate, TripUpdate, db
+
+
+class RetentionRateLimiter(object):
+    """
+    Adapt the size of purge slices and the pause between them to the load of the db:
+    the slice size grows by min_batch_size after each fast slice, and is halved (with a doubled pause)
+    after a slice lasting more than target_duration or when replicas lag more than max_replication_lag
+    """
+
+    def __init__(self, min_batch_size, max_batch_size, target_duration, max_replication_lag, interval):
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.target_duration = target_duration
+        self.max_replication_lag = max_replication_lag
+        self.interval = interval
+        self.max_interval = interval * 64
+        self.batch_size = min_batch_size
+        self.pause = interval
+
+    def update(self, batch_duration, replication_lag=None):
+        """
+        :return: the pause before the next slice
+        """
+        is_overloaded = batch_duration > self.target_duration or (
+            replication_lag is not None and replication_lag > self.max_replication_lag
+        )
+        if is_overloaded:
+            self.batch_size = max(self.min_batch_size, self.batch_size // 2)
+            self.pause = min(self.max_interval, self.pause * 2)
+        else:
+            self.batch_size = min(self.max_batch_size, self.batch_size + self.min_batch_size)
+            self.pause = self.interval
+        return self.pause
+
+
+# replay_lag is only available from PostgreSQL 10: not requested anymore after a failure
+_replication_lag_status = {"available": True}
+
+
+def get_replication_lag():
+    """
+    :return: the replay lag (seconds) of the slowest replica, or None if unknown
+    """
+    if not _replication_lag_status["available"]:
+        return None
+    try:
+        return float(
+            db.session.execute(
+                "SELECT COALESCE(MAX(EXTRACT(EPOCH FROM replay_lag)), 0) FROM pg_stat_replication"
+            ).scalar()
+        )
+    except Exception as e:
+        logging.getLogger(__name__).info("replication lag is not available: {}".format(e))
+        _replication_lag_status["available"] = False
+        db.session.rollback()
+        return None
+
+
+def purge_contributor_slice(contributor, batch_size, purge_real_time_updates=True):
+    """
+    Delete at most batch_size expired TripUpdates and batch_size expired RealTimeUpdates of the contributor,
+    according to its nb_days_to_keep_trip_update and nb_days_to_keep_rt_update
+    :return: the number of objects deleted
+    """
+    today = datetime.date.today()
+    nb_deleted = TripUpdate.remove_batch_by_contributors_and_period(
+        [contributor.id],
+        end_date=today - datetime.timedelta(days=contributor.nb_days_to_keep_trip_update),
+        batch_size=batch_size,
+    )
+    db.session.commit()
+    if purge_real_time_updates:
+        nb_deleted += RealTimeUpdate.remove_batch_by_contributors_until(
+            [contributor.id],
+            until=today - datetime.timedelta(days=contributor.nb_days_to_keep_rt_update),
+            batch_size=batch_size,
+        )
+        db.session.commit()
+    if nb_deleted:
+        logging.getLogger(__name__).debug(
+            "retention of {}: {} objects deleted".format(contributor.id, nb_deleted),
+            extra={str("contributor"): contributor.id, str("deleted_count"): nb_deleted},
+        )
+    return nb_deleted
+
+
+def get_contributors_to_purge():
+    # deactivated contributors' data are purged too (see purge_contributor command)
+    return Contributor.query.all()
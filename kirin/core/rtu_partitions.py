@@ -0,0 +1,260 @@
+# coding=utf-8
+
+# Copyright (c) 2001, Canal TP and/or its affiliates. All rights reserved.
+#
+# This file is part of Navitia,
+#     the software to build cool stuff with public transport.
+#
+# Hope you'll enjoy and contribute to this project,
+#     powered by Canal TP (www.canaltp.fr).
+# Help us simplify mobility and open public transport:
+#     a non ending quest to the responsive locomotion way of traveling!
+#
+# LICENCE: This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Stay tuned using
+# twitter @navitia
+# [matrix] channel #navitia:matrix.org (https://app.element.io/#/room/#navitia:matrix.org)
+# https://groups.google.com/d/forum/navitia
+# www.navitia.io
+
+
+from __future__ import absolute_import, print_function, unicode_literals, division
+
+import datetime
+import logging
+import re
+
+from kirin.core.model import Contributor, db
+from kirin.exceptions import InternalException
+
+# Optional daily range partitioning of real_time_update on created_at (requires PostgreSQL >= 11):
+# * real_time_update_pYYYYMMDD holds RealTimeUpdates created on YYYY-MM-DD
+# * real_time_update_before_YYYYMMDD holds the RealTimeUpdates created before the table was partitioned
+# * real_time_update_default holds the RealTimeUpdates created on a day whose partition doesn't exist yet
+#   (they are moved to it when it's created)
+
+TABLE_NAME = "real_time_update"
+DEFAULT_PARTITION_NAME = "real_time_update_default"
+DAILY_PARTITION_PATTERN = re.compile(r"^real_time_update_p(\d{8})$")
+LEGACY_PARTITION_PATTERN = re.compile(r"^real_time_update_before_(\d{8})$")
+
+
+def get_daily_partition_name(day):
+    return "{}_p{:%Y%m%d}".format(TABLE_NAME, day)
+
+
+def get_legacy_partition_name(day):
+    return "{}_before_{:%Y%m%d}".format(TABLE_NAME, day)
+
+
+def get_partition_upper_bound(partition_name):
+    """
+    :return: the (excluded) upper bound of the RealTimeUpdates' creation date in the partition,
+    or None if the partition isn't managed by Kirin
+    """
+    match = DAILY_PARTITION_PATTERN.match(partition_name)
+    if match:
+        return datetime.datetime.strptime(match.group(1), "%Y%m%d").date() + datetime.timedelta(days=1)
+    match = LEGACY_PARTITION_PATTERN.match(partition_name)
+    if match:
+        return datetime.datetime.strptime(match.group(1), "%Y%m%d").date()
+    return None
+
+
+def is_real_time_update_partitioned():
+    # 'p' is the relkind of partitioned tables
+    return (
+        db.session.execute("SELECT relkind FROM pg_class WHERE oid = 'real_time_update'::regclass").scalar()
+        == "p"
+    )
+
+
+def get_real_time_update_partitions():
+    return [
+        row[0]
+        for row in db.session.execute(
+            "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+            "WHERE i.inhparent = 'real_time_update'::regclass ORDER BY c.relname"
+        )
+    ]
+
+
+def _create_daily_partition(day, has_default_partition):
+    partition_name = get_daily_partition_name(day)
+    bounds = {"partition": partition_name, "day": day, "next_day": day + datetime.timedelta(days=1)}
+    day_filter = "created_at >= '{day}' AND created_at < '{next_day}'".format(**bounds)
+    if (
+        not has_default_partition
+        or not db.session.execute(
+            "SELECT EXISTS (SELECT 1 FROM {} WHERE {})".format(DEFAULT_PARTITION_NAME, day_filter)
+        ).scalar()
+    ):
+        db.session.execute(
+            "CREATE TABLE {partition} PARTITION OF real_time_update "
+            "FOR VALUES FROM ('{day}') TO ('{next_day}')".format(**bounds)
+        )
+        return partition_name
+
+    # the RealTimeUpdates of this day already inserted (in the default partition) are moved to its partition
+    db.session.execute("LOCK TABLE real_time_update IN ACCESS EXCLUSIVE MODE")
+    db.session.execute("CREATE TABLE {} (LIKE real_time_update INCLUDING DEFAULTS)".format(partition_name))
+    db.session.execute(
+        "WITH moved AS (DELETE FROM {} WHERE {} RETURNING *) INSERT INTO {} SELECT * FROM moved".format(
+            DEFAULT_PARTITION_NAME, day_filter, partition_name
+        )
+    )
+    db.session.execute(
+        "ALTER TABLE real_time_update ATTACH PARTITION {partition} "
+        "FOR VALUES FROM ('{day}') TO ('{next_day}')".format(**bounds)
+    )
+    return partition_name
+
+
+def create_real_time_update_partitions(nb_days_ahead):
+    """
+    Create the missing daily partitions of real_time_update from today to today + nb_days_ahead
+    (days still covered by the partition of the RealTimeUpdates created before partitioning are skipped)
+    :return: names of the partitions created
+    """
+    existing_partitions = set(get_real_time_update_partitions())
+    today = datetime.datetime.utcnow().date()
+    first_day = max(
+        [today]
+        + [get_partition_upper_bound(p) for p in existing_partitions if LEGACY_PARTITION_PATTERN.match(p)]
+    )
+    created_partitions = []
+    for day in (today + datetime.timedelta(days=i) for i in range(nb_days_ahead + 1)):
+        if day < first_day or get_daily_partition_name(day) in existing_partitions:
+            continue
+        created_partitions.append(
+            _create_daily_partition(day, has_default_partition=DEFAULT_PARTITION_NAME in existing_partitions)
+        )
+    db.session.commit()
+    if created_partitions:
+        logging.getLogger(__name__).info("partitions of real_time_update created: {}".format(created_partitions))
+    return created_partitions
+
+
+def partition_real_time_update(nb_days_ahead):
+    """
+    Convert real_time_update to a table partitioned by day of creation, existing rows being kept
+    in a single partition (bounded after the last existing RealTimeUpdate, at tomorrow at the earliest,
+    so that it holds the ones created today). As PostgreSQL can't reference a partitioned table by its id
+    only, the foreign key from associate_realtimeupdate_tripupdate to real_time_update is dropped (partitions
+    are only dropped when their RealTimeUpdates aren't referenced anymore,
+    see drop_expired_real_time_update_partitions())
+    """
+    logger = logging.getLogger(__name__)
+    if is_real_time_update_partitioned():
+        logger.info("real_time_update is already partitioned")
+        return
+    if int(db.session.execute("SHOW server_version_num").scalar()) < 110000:
+        raise InternalException("partitioning real_time_update requires PostgreSQL >= 11")
+
+    db.session.execute("LOCK TABLE real_time_update IN ACCESS EXCLUSIVE MODE")
+    # no RealTimeUpdate can be created anymore until the conversion is committed
+    last_created_at = db.session.execute("SELECT max(created_at) FROM real_time_update").scalar()
+    upper_bound = datetime.datetime.utcnow().date() + datetime.timedelta(days=1)
+    if last_created_at is not None:
+        upper_bound = max(upper_bound, last_created_at.date() + datetime.timedelta(days=1))
+    legacy_partition = get_legacy_partition_name(upper_bound)
+    db.session.execute(
+        "ALTER TABLE associate_realtimeupdate_tripupdate "
+        "DROP CONSTRAINT IF EXISTS associate_realtimeupdate_tripupdate_real_time_update_id_fkey"
+    )
+    # indexes (and the primary key) of the partitioned table are created with the names of the current ones
+    index_names = [
+        row[0]
+        for row in db.session.execute("SELECT indexname FROM pg_indexes WHERE tablename = 'real_time_update'")
+    ]
+    for index_name in index_names:
+        db.session.execute('ALTER INDEX "{0}" RENAME TO "{0}_legacy"'.format(index_name))
+    db.session.execute("ALTER TABLE real_time_update RENAME TO {}".format(legacy_partition))
+    db.session.execute(
+        "CREATE TABLE real_time_update (LIKE {} INCLUDING DEFAULTS) PARTITION BY RANGE (created_at)".format(
+            legacy_partition
+        )
+    )
+    # the primary key of a partitioned table must contain the partitioning column
+    db.session.execute(
+        "ALTER TABLE real_time_update ADD CONSTRAINT real_time_update_pkey PRIMARY KEY (id, created_at)"
+    )
+    db.session.execute(
+        "ALTER TABLE real_time_update ADD CONSTRAINT real_time_update_contributor_id_fkey "
+        "FOREIGN KEY (contributor_id) REFERENCES contributor(id)"
+    )
+    db.session.execute("CREATE INDEX status_idx ON real_time_update (status)")
+    db.session.execute("CREATE INDEX realtime_update_created_at ON real_time_update (created_at)")
+    db.session.execute(
+        "CREATE INDEX realtime_update_contributor_id_and_created_at ON real_time_update (created_at, contributor_id)"
+    )
+    # the check constraint spares the scan of existing rows when attaching them as a partition
+    db.session.execute(
+        "ALTER TABLE {partition} ADD CONSTRAINT {partition}_created_at_check CHECK (created_at < '{day}')".format(
+            partition=legacy_partition, day=upper_bound
+        )
+    )
+    db.session.execute(
+        "ALTER TABLE real_time_update ATTACH PARTITION {} FOR VALUES FROM (MINVALUE) TO ('{}')".format(
+            legacy_partition, upper_bound
+        )
+    )
+    # RealTimeUpdates can be inserted even if the partitions ahead are not created in time
+    db.session.execute("CREATE TABLE {} PARTITION OF real_time_update DEFAULT".format(DEFAULT_PARTITION_NAME))
+    db.session.commit()
+    logger.info("real_time_update partitioned, existing RealTimeUpdates are in {}".format(legacy_partition))
+    create_real_time_update_partitions(nb_days_ahead)
+
+
+def get_real_time_update_retention_limit():
+    """
+    Partitions hold RealTimeUpdates of all contributors: they can only be dropped after the longest retention
+    """
+    nb_days_to_keep = db.session.query(db.func.max(Contributor.nb_days_to_keep_rt_update)).scalar()
+    if nb_days_to_keep is None:
+        return None
+    return datetime.date.today() - datetime.timedelta(days=nb_days_to_keep)
+
+
+def drop_expired_real_time_update_partitions(until=None):
+    """
+    Drop partitions of RealTimeUpdates created before until (by default, the retention limit
+    of all contributors) and not referenced by any TripUpdate anymore
+    :return: names of the partitions dropped
+    """
+    logger = logging.getLogger(__name__)
+    if until is None:
+        until = get_real_time_update_retention_limit()
+        if until is None:
+            return []
+    dropped_partitions = []
+    for partition_name in get_real_time_update_partitions():
+        upper_bound = get_partition_upper_bound(partition_name)
+        if upper_bound is None or upper_bound > until:
+            continue
+        is_referenced = db.session.execute(
+            "SELECT EXISTS (SELECT 1 FROM associate_realtimeupdate_tripupdate a "
+            "JOIN {} rtu ON rtu.id = a.real_time_update_id)".format(partition_name)
+        ).scalar()
+        if is_referenced:
+            logger.info("partition {} is still referenced by TripUpdates, not dropped".format(partition_name))
+            continue
+        db.session.execute("ALTER TABLE real_time_update DETACH PARTITION {}".format(partition_name))
+        db.session.execute("DROP TABLE {}".format(partition_name))
+        db.session.commit()
+        dropped_partitions.append(partition_name)
+    if dropped_partitions:
+        logger.info("partitions of real_time_update dropped: {}".format(dropped_partitions))
+    return dropped_partitions
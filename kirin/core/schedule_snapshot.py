@@ -0,0 +1,389 @@
+# coding=utf-8
+
+# Copyright (c) 2001, Canal TP and/or its affiliates. All rights reserved.
+#
+# This file is part of Navitia,
+#     the software to build cool stuff with public transport.
+#
+# Hope you'll enjoy and contribute to this project,
+#     powered by Canal TP (www.canaltp.fr).
+# Help us simplify mobility and open public transport:
+#     a non ending quest to the responsive locomotion way of traveling!
+#
+# LICENCE: This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Stay tuned using
+# twitter @navitia
+# [matrix] channel #navitia:matrix.org (https://app.element.io/#/room/#navitia:matrix.org)
+# https://groups.google.com/d/forum/navitia
+# www.navitia.io
+
+
+from __future__ import absolute_import, print_function, unicode_literals, division
+
+import calendar
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+from datetime import datetime, time, timedelta
+
+import navitia_wrapper
+from flask import current_app
+
+from kirin.core.vj_prefetcher import get_vj_keys, get_search_key
+
+# Read-only binary snapshot of the base-schedule of a coverage (VJs and stop_points), shared by all processes of
+# a host through mmap: only the pages actually read are loaded, and once only for the whole host.
+#
+# Layout (little-endian):
+# * magic "KIRINSS1"
+# * uint32 length of the metadata, then metadata as JSON (coverage, publication_date, window_start, window_end)
+# * uint64 number of entries, then the entries sorted by (key_hash, start_ts), each one being
+#   (uint64 key_hash, int64 start_ts, uint64 offset, uint32 length):
+#   * key_hash: first 8 bytes of the md5 of the search key
+#   * start_ts: UTC timestamp of the start of the VJ's circulation (-1 for stop_points)
+#   * offset, length: position of the JSON of the object in the data section
+# * data section: JSON of each VJ and stop_point, stored once
+
+SNAPSHOT_MAGIC = b"KIRINSS1"
+_META_LENGTH = struct.Struct(str("<I"))
+_NB_ENTRIES = struct.Struct(str("<Q"))
+_ENTRY = struct.Struct(str("<QqQI"))
+_KEY_HASH = struct.Struct(str("<Q"))
+_DATETIME_FORMAT = "%Y%m%dT%H%M%S"
+_TIME_FORMAT = "%H%M%S"
+
+# Process-wide snapshots: {contributor_id: ((path, navitia_coverage, navitia_token), ScheduleSnapshot)}
+_snapshots = {}
+
+
+def _get_key_hash(key):
+    return _KEY_HASH.unpack(hashlib.md5("|".join(key).encode("utf-8")).digest()[:8])[0]
+
+
+def _get_stop_point_key(code_type, code_value):
+    return "stop_area_code", code_type, code_value
+
+
+def _to_timestamp(dt):
+    return calendar.timegm(dt.utctimetuple())
+
+
+def _encode_time(obj):
+    # navitia_wrapper converts stop_times' times to datetime.time
+    if isinstance(obj, time):
+        return {"__time__": obj.strftime(_TIME_FORMAT)}
+    raise TypeError("{} is not JSON serializable".format(repr(obj)))
+
+
+def _decode_time(obj):
+    if "__time__" in obj:
+        return datetime.strptime(obj["__time__"], _TIME_FORMAT).time()
+    return obj
+
+
+def write_schedule_snapshot(path, coverage, vjs_index, stop_points_by_stop_area_code):
+    """
+    Write the snapshot of a VehicleJourneysIndex and of stop_points indexed by their stop_area's codes
+    The file is written aside then renamed, so that processes mapping the previous snapshot are not disturbed.
+    """
+    data = []
+    data_size = [0]
+    data_positions = {}
+
+    def _add_data(obj_id, obj):
+        position = data_positions.get(obj_id)
+        if position is None:
+            blob = json.dumps(obj, default=_encode_time, separators=(",", ":")).encode("utf-8")
+            position = data_positions[obj_id] = (data_size[0], len(blob))
+            data.append(blob)
+            data_size[0] += len(blob)
+        return position
+
+    entries = []
+    for key, vj_entries in vjs_index.vjs_by_key.items():
+        if None in key:
+            continue
+        key_hash = _get_key_hash(key)
+        for start_dt, nav_vj in vj_entries:
+            offset, length = _add_data(("vj", nav_vj.get("id")), nav_vj)
+            entries.append((key_hash, _to_timestamp(start_dt), offset, length))
+    for (code_type, code_value), stop_point in stop_points_by_stop_area_code.items():
+        offset, length = _add_data(("stop_point", stop_point.get("id")), stop_point)
+        entries.append((_get_key_hash(_get_stop_point_key(code_type, code_value)), -1, offset, length))
+    entries = sorted(set(entries))
+
+    metadata = json.dumps(
+        {
+            "coverage": coverage,
+            "publication_date": vjs_index.publication_date,
+            "window_start": vjs_index.window_start.strftime(_DATETIME_FORMAT),
+            "window_end": vjs_index.window_end.strftime(_DATETIME_FORMAT),
+        }
+    ).encode("utf-8")
+
+    tmp_path = "{}.tmp".format(path)
+    with open(tmp_path, "wb") as f:
+        f.write(SNAPSHOT_MAGIC)
+        f.write(_META_LENGTH.pack(len(metadata)))
+        f.write(metadata)
+        f.write(_NB_ENTRIES.pack(len(entries)))
+        for entry in entries:
+            f.write(_ENTRY.pack(*entry))
+        for blob in data:
+            f.write(blob)
+    os.rename(tmp_path, path)
+    return len(entries)
+
+
+class ScheduleSnapshotFile(object):
+    """
+    Memory-mapped snapshot file: objects are deserialized only when looked up
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mmap[: len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+            raise ValueError("{} is not a schedule snapshot".format(path))
+        offset = len(SNAPSHOT_MAGIC)
+        (meta_length,) = _META_LENGTH.unpack_from(self.mmap, offset)
+        offset += _META_LENGTH.size
+        self.metadata = json.loads(self.mmap[offset : offset + meta_length].decode("utf-8"))
+        offset += meta_length
+        (self.nb_entries,) = _NB_ENTRIES.unpack_from(self.mmap, offset)
+        self.entries_offset = offset + _NB_ENTRIES.size
+        self.data_offset = self.entries_offset + self.nb_entries * _ENTRY.size
+        self.window_start = datetime.strptime(self.metadata["window_start"], _DATETIME_FORMAT)
+        self.window_end = datetime.strptime(self.metadata["window_end"], _DATETIME_FORMAT)
+
+    def _get_entry(self, position):
+        return _ENTRY.unpack_from(self.mmap, self.entries_offset + position * _ENTRY.size)
+
+    def _find_first_position(self, key_hash):
+        low, high = 0, self.nb_entries
+        while low < high:
+            middle = (low + high) // 2
+            if self._get_entry(middle)[0] < key_hash:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _read(self, offset, length):
+        start = self.data_offset + offset
+        return json.loads(self.mmap[start : start + length].decode("utf-8"), object_hook=_decode_time)
+
+    def find(self, key, since_ts=None, until_ts=None):
+        """
+        :return: objects stored for the key (with a start in [since_ts, until_ts] if provided), each one once
+        Beware that objects of another key with the same hash may be returned: the caller has to check them.
+        """
+        key_hash = _get_key_hash(key)
+        objects = []
+        read_offsets = set()
+        position = self._find_first_position(key_hash)
+        while position < self.nb_entries:
+            entry_hash, start_ts, offset, length = self._get_entry(position)
+            position += 1
+            if entry_hash != key_hash:
+                break
+            if since_ts is not None and not since_ts <= start_ts <= until_ts:
+                continue
+            if offset not in read_offsets:
+                read_offsets.add(offset)
+                objects.append(self._read(offset, length))
+        return objects
+
+
+class ScheduleSnapshot(object):
+    """
+    Base-schedule snapshot of a contributor, built by the 'build_schedule_snapshot' command.
+
+    The file is remapped when it is replaced, and its publication date is compared with navitia's one
+    (both checked every NAVITIA_REFERENTIAL_CHECK_INTERVAL).
+    As for the VJ prefetcher, searches that can't be answered by the snapshot (missing file, stale snapshot,
+    out of the window, nothing found) return None: the caller is then expected to request navitia.
+    """
+
+    def __init__(self, path, coverage, check_interval=timedelta(minutes=1), navitia=None):
+        self.path = path
+        self.coverage = coverage
+        self.check_interval = check_interval
+        # navitia instance used to check the publication date (not checked if None)
+        self.navitia = navitia
+        self.snapshot_file = None
+        self.mtime = None
+        self.stale = False
+        self.checked_at = None
+        self.nb_hits = 0
+        self.nb_misses = 0
+
+    def refresh(self):
+        now = datetime.utcnow()
+        if self.checked_at is not None and now - self.checked_at < self.check_interval:
+            return
+        self.checked_at = now
+        self._map_file()
+        self._check_publication_date()
+
+    def _map_file(self):
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            # no snapshot (yet): the previous one stays valid until the file is replaced
+            return
+        if mtime == self.mtime:
+            return
+        try:
+            snapshot_file = ScheduleSnapshotFile(self.path)
+            if snapshot_file.metadata.get("coverage") != self.coverage:
+                raise ValueError("snapshot of coverage {}".format(snapshot_file.metadata.get("coverage")))
+        except Exception as e:
+            logging.getLogger(__name__).warning("impossible to map snapshot {}: {}".format(self.path, e))
+            return
+        # the previous mapping is released once the lookups in progress are done with it
+        self.snapshot_file = snapshot_file
+        self.mtime = mtime
+
+    def _check_publication_date(self):
+        snapshot_file = self.snapshot_file
+        if self.navitia is None or snapshot_file is None:
+            return
+        try:
+            publication_date = self.navitia.get_publication_date()
+        except Exception as e:
+            # the previous verdict is kept until navitia answers again
+            logging.getLogger(__name__).warning("impossible to get navitia's publication date: {}".format(e))
+            return
+        stale = publication_date != snapshot_file.metadata.get("publication_date")
+        if stale and not self.stale:
+            logging.getLogger(__name__).warning(
+                "snapshot {} of publication date {} is stale (navitia's publication date: {}), not used".format(
+                    self.path, snapshot_file.metadata.get("publication_date"), publication_date
+                )
+            )
+        self.stale = stale
+
+    def _count(self, found):
+        if found:
+            self.nb_hits += 1
+        else:
+            self.nb_misses += 1
+
+    def find_vjs(self, since_dt=None, until_dt=None, headsign=None, code=None):
+        """
+        Search VJs by headsign or by code (type, value), circulating in [since_dt, until_dt] if provided
+        :return: list of navitia VJs, or None if the snapshot can't answer
+        """
+        self.refresh()
+        snapshot_file = self.snapshot_file
+        if (
+            snapshot_file is None
+            or self.stale
+            or (
+                since_dt is not None
+                and not (snapshot_file.window_start <= since_dt and until_dt < snapshot_file.window_end)
+            )
+        ):
+            self._count(False)
+            return None
+        key = get_search_key(headsign, code)
+        if since_dt is None:
+            nav_vjs = snapshot_file.find(key)
+        else:
+            nav_vjs = snapshot_file.find(key, _to_timestamp(since_dt), _to_timestamp(until_dt))
+        nav_vjs = [nav_vj for nav_vj in nav_vjs if key in get_vj_keys(nav_vj)]
+        self._count(nav_vjs)
+        return nav_vjs or None
+
+    def find_stop_point_by_stop_area_code(self, code_type, code_value):
+        """
+        :return: the stop_point of the stop_area having this code, or None if the snapshot can't answer
+        """
+        self.refresh()
+        snapshot_file = self.snapshot_file
+        if snapshot_file is None or self.stale:
+            self._count(False)
+            return None
+        stop_point = next(
+            (
+                sp
+                for sp in snapshot_file.find(_get_stop_point_key(code_type, code_value))
+                if any(
+                    c.get("type") == code_type and c.get("value") == code_value
+                    for c in (sp.get("stop_area") or {}).get("codes", [])
+                )
+            ),
+            None,
+        )
+        self._count(stop_point)
+        return stop_point
+
+    def get_status(self):
+        metadata = self.snapshot_file.metadata if self.snapshot_file else {}
+        return {
+            "publication_date": metadata.get("publication_date"),
+            "window_start": metadata.get("window_start"),
+            "window_end": metadata.get("window_end"),
+            "stale": self.stale,
+            "nb_hits": self.nb_hits,
+            "nb_misses": self.nb_misses,
+        }
+
+
+def get_schedule_snapshot_path(contributor_id):
+    snapshot_dir = current_app.config.get(str("NAVITIA_SCHEDULE_SNAPSHOT_DIR"))
+    if not snapshot_dir:
+        return None
+    return os.path.join(snapshot_dir, "{}.snapshot".format(contributor_id))
+
+
+def get_schedule_snapshot(contributor):
+    """
+    :return: the schedule snapshot of the contributor if NAVITIA_SCHEDULE_SNAPSHOT_DIR is set, else None
+    """
+    path = get_schedule_snapshot_path(contributor.id)
+    if path is None:
+        return None
+    navitia_config = (path, contributor.navitia_coverage, contributor.navitia_token)
+    config_and_snapshot = _snapshots.get(contributor.id)
+    if config_and_snapshot is None or config_and_snapshot[0] != navitia_config:
+        # dedicated navitia wrapper without cache: the publication date is checked once per interval at most
+        navitia = navitia_wrapper.Navitia(
+            url=current_app.config.get(str("NAVITIA_URL")),
+            token=contributor.navitia_token,
+            timeout=current_app.config.get(str("NAVITIA_TIMEOUT"), 5),
+        ).instance(contributor.navitia_coverage)
+        config_and_snapshot = _snapshots[contributor.id] = (
+            navitia_config,
+            ScheduleSnapshot(
+                path,
+                contributor.navitia_coverage,
+                timedelta(seconds=current_app.config.get(str("NAVITIA_REFERENTIAL_CHECK_INTERVAL"), 60)),
+                navitia=navitia,
+            ),
+        )
+    return config_and_snapshot[1]
+
+
+def get_schedule_snapshots_status():
+    return {contributor_id: snapshot.get_status() for contributor_id, (_, snapshot) in _snapshots.items()}
+
+
+def clear():
+    _snapshots.clear()
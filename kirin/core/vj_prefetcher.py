@@ -0,0 +1,240 @@
+# coding=utf-8
+
+# Copyright (c) 2001, Canal TP and/or its affiliates. All rights reserved.
+#
+# This file is part of Navitia,
+#     the software to build cool stuff with public transport.
+#
+# Hope you'll enjoy and contribute to this project,
+#     powered by Canal TP (www.canaltp.fr).
+# Help us simplify mobility and open public transport:
+#     a non ending quest to the responsive locomotion way of traveling!
+#
+# LICENCE: This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Stay tuned using
+# twitter @navitia
+# [matrix] channel #navitia:matrix.org (https://app.element.io/#/room/#navitia:matrix.org)
+# https://groups.google.com/d/forum/navitia
+# www.navitia.io
+
+
+from __future__ import absolute_import, print_function, unicode_literals, division
+
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+
+import navitia_wrapper
+from flask import current_app
+
+from kirin.utils import to_navitia_utc_str
+
+# number of VJs requested per page when prefetching
+VJ_PREFETCH_PAGE_SIZE = 1000
+
+# Process-wide prefetchers: {contributor_id: ((navitia_coverage, navitia_token), VehicleJourneyPrefetcher)}
+_prefetchers = {}
+
+
+def _get_vj_start_time(nav_vj):
+    first_stop_time = nav_vj.get("stop_times", [{}])[0]
+    start_time = first_stop_time.get("utc_arrival_time")
+    if start_time is None:
+        start_time = first_stop_time.get("utc_departure_time")
+    return start_time
+
+
+def get_vj_keys(nav_vj):
+    """
+    :return: keys a VJ can be searched with: ("headsign", headsign) and ("code", type, value)
+    """
+    keys = {("headsign", nav_vj.get("headsign"))}
+    keys.update(("headsign", st.get("headsign")) for st in nav_vj.get("stop_times", []) if st.get("headsign"))
+    keys.update(("code", c.get("type"), c.get("value")) for c in nav_vj.get("codes", []))
+    return keys
+
+
+def get_search_key(headsign=None, code=None):
+    return ("headsign", headsign) if headsign is not None else ("code",) + tuple(code)
+
+
+class VehicleJourneysIndex(object):
+    """
+    Immutable index of all navitia's VJs circulating in [window_start, window_end[
+    by headsign and by code (type, value), with the UTC datetime of their start for each circulation.
+    """
+
+    def __init__(self, window_start, window_end, publication_date):
+        self.window_start = window_start
+        self.window_end = window_end
+        self.publication_date = publication_date
+        self.vjs_by_key = {}
+        self.nb_vjs = 0
+
+    def add(self, circulation_date, nav_vj):
+        start_time = _get_vj_start_time(nav_vj)
+        if start_time is None:
+            return
+        # navitia returns VJs starting in the requested day (UTC)
+        entry = (datetime.combine(circulation_date, start_time), nav_vj)
+        for key in get_vj_keys(nav_vj):
+            self.vjs_by_key.setdefault(key, []).append(entry)
+        self.nb_vjs += 1
+
+    def covers(self, since_dt, until_dt):
+        return self.window_start <= since_dt and until_dt < self.window_end
+
+    def find(self, key, since_dt=None, until_dt=None):
+        vjs = []
+        vj_ids = set()
+        for start_dt, nav_vj in self.vjs_by_key.get(key, []):
+            if since_dt is not None and not since_dt <= start_dt <= until_dt:
+                continue
+            if nav_vj.get("id") not in vj_ids:
+                vj_ids.add(nav_vj.get("id"))
+                vjs.append(nav_vj)
+        return vjs
+
+
+class VehicleJourneyPrefetcher(object):
+    """
+    Prefetch all VJs of a navitia coverage for a rolling window of days, to answer VJ searches locally.
+
+    The index is (re)built in the background when navitia's publication date changes or when the window rolls
+    (checked every NAVITIA_REFERENTIAL_CHECK_INTERVAL), the previous index being used in the meantime.
+    Searches that can't be answered by the index (not built yet, out of the window, nothing found)
+    return None: the caller is then expected to request navitia.
+    """
+
+    def __init__(self, contributor):
+        # dedicated navitia wrapper without cache: prefetched pages are not worth storing in redis
+        self.navitia = navitia_wrapper.Navitia(
+            url=current_app.config.get(str("NAVITIA_URL")),
+            token=contributor.navitia_token,
+            timeout=current_app.config.get(str("NAVITIA_TIMEOUT"), 5),
+        ).instance(contributor.navitia_coverage)
+        self.contributor_id = contributor.id
+        self.nb_days = current_app.config.get(str("NAVITIA_VJ_PREFETCH_NB_DAYS"), 3)
+        self.check_interval = timedelta(
+            seconds=current_app.config.get(str("NAVITIA_REFERENTIAL_CHECK_INTERVAL"), 60)
+        )
+        self.index = None
+        self.checked_at = None
+        self.build_thread = None
+        self.nb_hits = 0
+        self.nb_misses = 0
+
+    def get_window_start(self):
+        # the window starts the day before, to handle circulations passing midnight
+        return datetime.combine(datetime.utcnow().date() - timedelta(days=1), datetime.min.time())
+
+    def build(self, window_start, publication_date):
+        start = time.time()
+        index = VehicleJourneysIndex(window_start, window_start + timedelta(days=self.nb_days), publication_date)
+        for day in range(self.nb_days):
+            since_dt = window_start + timedelta(days=day)
+            start_page = 0
+            while True:
+                nav_vjs = self.navitia.vehicle_journeys(
+                    q={
+                        "since": to_navitia_utc_str(since_dt),
+                        "until": to_navitia_utc_str(since_dt + timedelta(days=1) - timedelta(seconds=1)),
+                        "depth": "2",  # we need this depth to get the stoptime's stop_area
+                        "show_codes": "true",  # we need the stop_points CRCICH codes
+                        "count": str(VJ_PREFETCH_PAGE_SIZE),
+                        "start_page": str(start_page),
+                    }
+                )
+                for nav_vj in nav_vjs:
+                    index.add(since_dt.date(), nav_vj)
+                if len(nav_vjs) < VJ_PREFETCH_PAGE_SIZE:
+                    break
+                start_page += 1
+        self.index = index
+        logging.getLogger(__name__).info(
+            "{} VJs prefetched for contributor {} on [{}, {}[ in {:.2f} s".format(
+                index.nb_vjs, self.contributor_id, index.window_start, index.window_end, time.time() - start
+            )
+        )
+
+    def _build_in_background(self, window_start, publication_date):
+        def _build():
+            try:
+                self.build(window_start, publication_date)
+            except Exception as e:
+                logging.getLogger(__name__).warning(
+                    "impossible to prefetch VJs for contributor {}: {}".format(self.contributor_id, e)
+                )
+
+        self.build_thread = threading.Thread(
+            target=_build, name=str("vj_prefetcher-{}".format(self.contributor_id))
+        )
+        self.build_thread.daemon = True
+        self.build_thread.start()
+
+    def refresh(self):
+        now = datetime.utcnow()
+        if self.checked_at is not None and now - self.checked_at < self.check_interval:
+            return
+        if self.build_thread is not None and self.build_thread.is_alive():
+            return
+        self.checked_at = now
+        try:
+            publication_date = self.navitia.get_publication_date()
+        except Exception as e:
+            logging.getLogger(__name__).warning("impossible to get navitia's publication date: {}".format(e))
+            return
+        window_start = self.get_window_start()
+        index = self.index
+        if index is None or index.publication_date != publication_date or index.window_start != window_start:
+            self._build_in_background(window_start, publication_date)
+
+    def find_vjs(self, since_dt=None, until_dt=None, headsign=None, code=None):
+        """
+        Search VJs by headsign or by code (type, value), circulating in [since_dt, until_dt] if provided
+        :return: list of navitia VJs, or None if the index can't answer
+        """
+        self.refresh()
+        index = self.index
+        if index is None or (since_dt is not None and not index.covers(since_dt, until_dt)):
+            self.nb_misses += 1
+            return None
+        nav_vjs = index.find(get_search_key(headsign, code), since_dt, until_dt)
+        if not nav_vjs:
+            self.nb_misses += 1
+            return None
+        self.nb_hits += 1
+        return nav_vjs
+
+
+def get_vj_prefetcher(contributor):
+    """
+    :return: the VJ prefetcher of the contributor if enabled in NAVITIA_VJ_PREFETCH_CONTRIBUTORS, else None
+    """
+    if contributor.id not in current_app.config.get(str("NAVITIA_VJ_PREFETCH_CONTRIBUTORS"), []):
+        return None
+    navitia_config = (contributor.navitia_coverage, contributor.navitia_token)
+    config_and_prefetcher = _prefetchers.get(contributor.id)
+    if config_and_prefetcher is None or config_and_prefetcher[0] != navitia_config:
+        config_and_prefetcher = _prefetchers[contributor.id] = (
+            navitia_config,
+            VehicleJourneyPrefetcher(contributor),
+        )
+    return config_and_prefetcher[1]
+
+
+def clear():
+    _prefetchers.clear()
@@ -37,9 +37,10 @@ import logging
 from flask_restful import Resource
 
 from kirin.core.build_wrapper import wrap_build
+from kirin.core.builder_registry import get_builder
+from kirin.core.contributor_registry import contributor_registry
 from kirin.cots import KirinModelBuilder
 from kirin.exceptions import InvalidArguments, SubServiceError
-from kirin.core import model
 from kirin.core.types import ConnectorType
 
 
@@ -47,7 +48,7 @@ def get_cots_contributor(include_deactivated=False):
     """
     :return 1 COTS contributor from config in db
     """
-    contributor = model.Contributor.find_by_connector_type(
+    contributor = contributor_registry.find_by_connector_type(
         ConnectorType.cots.value, include_deactivated=include_deactivated
     )
     if len(contributor) == 0:
@@ -74,7 +75,7 @@ def get_cots(req):
 
 class Cots(Resource):
     def __init__(self):
-        self.builder = KirinModelBuilder(get_cots_contributor())
+        self.builder = get_builder(KirinModelBuilder, get_cots_contributor())
 
     def post(self):
         raw_json = get_cots(flask.globals.request)
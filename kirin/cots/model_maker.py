@@ -35,7 +35,6 @@ import logging
 from datetime import datetime
 from operator import itemgetter
 
-import jmespath
 from flask.globals import current_app
 
 # For perf benches:
@@ -45,6 +44,7 @@ import ujson
 from kirin.core import model
 from kirin.core.abstract_builder import AbstractKirinModelBuilder
 from kirin.core.merge_utils import merge
+from kirin.core.navitia_referential import get_navitia_referential
 from kirin.cots.message_handler import MessageHandler
 from kirin.exceptions import InvalidArguments, InternalException, ObjectNotFound
 from kirin.utils import (
@@ -61,6 +61,7 @@ from kirin.core.types import (
     get_higher_status,
     get_effect_by_stop_time_status,
     get_mode_filter,
+    get_mode_id,
 )
 from enum import Enum
 from datetime import timedelta
@@ -114,15 +115,10 @@ def headsigns(str_headsign):
     return [signs[0], alternative_headsign]
 
 
-def get_navitia_stop_time_sncf(cr, ci, ch, nav_vj):
+def get_navitia_stop_time_sncf(cr, ci, ch, vj):
     nav_external_code = "{cr}-{ci}-{ch}".format(cr=cr, ci=ci, ch=ch)
 
-    nav_stop_times = jmespath.search(
-        "stop_times[? stop_point.stop_area.codes[? value=='{nav_ext_code}' && type=='CR-CI-CH']]".format(
-            nav_ext_code=nav_external_code
-        ),
-        nav_vj,
-    )
+    nav_stop_times = vj.find_navitia_stop_times_by_stop_area_code("CR-CI-CH", nav_external_code)
 
     log_dict = {}
     if not nav_stop_times:
@@ -447,7 +443,7 @@ class KirinModelBuilder(AbstractKirinModelBuilder):
         # manage realtime information stop_time by stop_time
         for pdp in pdps:
             # retrieve navitia's stop_point corresponding to the current COTS pdp
-            nav_stop, log_dict = self._get_navitia_stop_point(pdp, vj.navitia_vj)
+            nav_stop, log_dict = self._get_navitia_stop_point(pdp, vj)
             projected_stop_time = {"Arrivee": None, "Depart": None}  # used to check consistency
 
             if log_dict:
@@ -598,15 +594,17 @@ class KirinModelBuilder(AbstractKirinModelBuilder):
                 )
             )
 
-            navitia_vjs = self.navitia.vehicle_journeys(
-                q={
-                    "headsign": train_number,
-                    "since": to_navitia_utc_str(extended_since_dt),
-                    "until": to_navitia_utc_str(extended_until_dt),
-                    "depth": "2",  # we need this depth to get the stoptime's stop_area
-                    "show_codes": "true",  # we need the stop_points CRCICH codes
-                }
-            )
+            navitia_vjs = self.find_local_vjs(extended_since_dt, extended_until_dt, headsign=train_number)
+            if not navitia_vjs:
+                navitia_vjs = self.navitia.vehicle_journeys(
+                    q={
+                        "headsign": train_number,
+                        "since": to_navitia_utc_str(extended_since_dt),
+                        "until": to_navitia_utc_str(extended_until_dt),
+                        "depth": "2",  # we need this depth to get the stoptime's stop_area
+                        "show_codes": "true",  # we need the stop_points CRCICH codes
+                    }
+                )
 
             # Consistency check on action applied to trip
             if action_on_trip == ActionOnTrip.NOT_ADDED.name:
@@ -640,7 +638,7 @@ class KirinModelBuilder(AbstractKirinModelBuilder):
 
         return vjs.values()
 
-    def _get_navitia_stop_point(self, pdp, nav_vj):
+    def _get_navitia_stop_point(self, pdp, vj):
         """
         Get a navitia stop point from the stop_time in a 'Point de Parcours' dict.
         The dict MUST contain cr, ci, ch tags.
@@ -652,41 +650,54 @@ class KirinModelBuilder(AbstractKirinModelBuilder):
         Error messages are also returned as 'missing stop point', 'duplicate stops'
         """
         nav_st, log_dict = get_navitia_stop_time_sncf(
-            cr=get_value(pdp, "cr"), ci=get_value(pdp, "ci"), ch=get_value(pdp, "ch"), nav_vj=nav_vj
+            cr=get_value(pdp, "cr"), ci=get_value(pdp, "ci"), ch=get_value(pdp, "ch"), vj=vj
         )
         if not nav_st:
-            nav_stop, log_dict = self._request_navitia_stop_point(
+            nav_stop, log_dict = self._find_navitia_stop_point(
                 cr=get_value(pdp, "cr"), ci=get_value(pdp, "ci"), ch=get_value(pdp, "ch")
             )
         else:
             nav_stop = nav_st.get("stop_point", None)
         return nav_stop, log_dict
 
-    def _request_navitia_stop_point(self, cr, ci, ch):
+    def _find_navitia_stop_point(self, cr, ci, ch):
         external_code = "{}-{}-{}".format(cr, ci, ch)
-        stop_points = self.navitia.stop_points(
-            q={"filter": 'stop_area.has_code("CR-CI-CH", "{}")'.format(external_code), "count": "1"}
+        stop_point = None
+        if self.schedule_snapshot:
+            stop_point = self.schedule_snapshot.find_stop_point_by_stop_area_code("CR-CI-CH", external_code)
+        stop_point = stop_point or get_navitia_referential(self.navitia).find_stop_point_by_stop_area_code(
+            "CR-CI-CH", external_code, lambda: self._request_navitia_stop_point(external_code)
         )
-        if stop_points:
-            return stop_points[0], {}
+        if stop_point:
+            return stop_point, {}
 
         return None, {"log": "No stop point found", "stop_point_code": external_code}
 
+    def _request_navitia_stop_point(self, external_code):
+        stop_points = self.navitia.stop_points(
+            q={"filter": 'stop_area.has_code("CR-CI-CH", "{}")'.format(external_code), "count": "1"}
+        )
+        return stop_points[0] if stop_points else None
+
     def _get_navitia_company(self, code):
         """
         Get a navitia company for the code present in COTS
         If the company doesn't exist in navitia, another request is made to
         find company for key="RefProd" and value="1187"
         """
-        return self._request_navitia_company(code) or self._request_navitia_company(DEFAULT_COMPANY_ID)
+        return self._find_navitia_company(code) or self._find_navitia_company(DEFAULT_COMPANY_ID)
+
+    def _find_navitia_company(self, code):
+        company = get_navitia_referential(self.navitia).find_company(
+            "RefProd", code, lambda: self._request_navitia_company(code)
+        )
+        return company.get("id", None) if company else None
 
     def _request_navitia_company(self, code):
         companies = self.navitia.companies(
             q={"filter": 'company.has_code("RefProd", "{}")'.format(code), "count": "1"}
         )
-        if companies:
-            return companies[0].get("id", None)
-        return None
+        return companies[0] if companies else None
 
     def _get_navitia_physical_mode(self, indicator=None):
         """
@@ -694,13 +705,17 @@ class KirinModelBuilder(AbstractKirinModelBuilder):
         If the physical_mode doesn't exist in navitia, another request is made default physical_mode
         with filter=physical_mode.id=physical_mode:LongDistanceTrain
         """
-        return self._request_navitia_physical_mode(indicator) or self._request_navitia_physical_mode()
+        return self._find_navitia_physical_mode(indicator) or self._find_navitia_physical_mode()
+
+    def _find_navitia_physical_mode(self, indicator=None):
+        physical_mode = get_navitia_referential(self.navitia).find_physical_mode(
+            get_mode_id(indicator), lambda: self._request_navitia_physical_mode(indicator)
+        )
+        return physical_mode.get("id", None) if physical_mode else None
 
     def _request_navitia_physical_mode(self, indicator=None):
         physical_modes = self.navitia.physical_modes(q={"filter": get_mode_filter(indicator), "count": "1"})
-        if physical_modes:
-            return physical_modes[0].get("id", None)
-        return None
+        return physical_modes[0] if physical_modes else None
 
     def merge_trip_updates(self, navitia_vj, db_trip_update, new_trip_update):
         return merge(navitia_vj, db_trip_update, new_trip_update, is_new_complete=True)
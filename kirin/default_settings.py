@@ -49,13 +49,57 @@ COTS_PAR_IV_REQUEST_TIMEOUT = int(
 )
 
 
+# Contributors are cached and reloaded on change notification (or at this interval if notifications are unavailable)
+CONTRIBUTOR_REGISTRY_POLL_INTERVAL = int(
+    os.getenv("KIRIN_CONTRIBUTOR_REGISTRY_POLL_INTERVAL", timedelta(minutes=1).total_seconds())
+)
+
+# feeds for navitia written in an outbox table with the TripUpdates (instead of being published directly),
+# then published by 'manage.py dispatch_outbox'
+USE_FEED_OUTBOX = boolean(os.getenv("KIRIN_USE_FEED_OUTBOX", False))
+FEED_OUTBOX_BATCH_SIZE = int(os.getenv("KIRIN_FEED_OUTBOX_BATCH_SIZE", 100))
+FEED_OUTBOX_POLL_INTERVAL = float(os.getenv("KIRIN_FEED_OUTBOX_POLL_INTERVAL", 0.2))  # in seconds
+
+# history of the RealTimeUpdates linked to each TripUpdate, pruned at each update of the TripUpdate:
+# only the MAX_RT_UPDATES_PER_TRIP_UPDATE last ones and the ones received in the last
+# RT_UPDATES_PER_TRIP_UPDATE_WINDOW seconds are kept (whole history if not set)
+MAX_RT_UPDATES_PER_TRIP_UPDATE = (
+    int(os.getenv("KIRIN_MAX_RT_UPDATES_PER_TRIP_UPDATE"))
+    if os.getenv("KIRIN_MAX_RT_UPDATES_PER_TRIP_UPDATE")
+    else None
+)
+RT_UPDATES_PER_TRIP_UPDATE_WINDOW = (
+    int(os.getenv("KIRIN_RT_UPDATES_PER_TRIP_UPDATE_WINDOW"))
+    if os.getenv("KIRIN_RT_UPDATES_PER_TRIP_UPDATE_WINDOW")
+    else None
+)  # in seconds
+
+# storage of the StopTimeUpdates of new TripUpdates: "rows" (a row each in stop_time_update)
+# or "compact" (an array in their TripUpdate); see command 'migrate_stop_time_update_storage' to convert others
+STOP_TIME_UPDATE_STORAGE = os.getenv("KIRIN_STOP_TIME_UPDATE_STORAGE", "rows")
+
 # PIV configuration
 BROKER_CONSUMER_CONFIGURATION_RELOAD_INTERVAL = int(
     os.getenv("KIRIN_BROKER_CONSUMER_CONFIGURATION_RELOAD_INTERVAL", timedelta(minutes=1).total_seconds())
 )
+# PIV messages processed in a single transaction and published as a single feed by the piv_worker:
+# up to PIV_WORKER_BATCH_SIZE messages, received in PIV_WORKER_BATCH_TIMEOUT (1 to process messages one by one)
+PIV_WORKER_BATCH_SIZE = int(os.getenv("KIRIN_PIV_WORKER_BATCH_SIZE", 1))
+PIV_WORKER_BATCH_TIMEOUT = int(os.getenv("KIRIN_PIV_WORKER_BATCH_TIMEOUT", 100))  # in milliseconds
+# when the oldest message of a batch was published more than PIV_WORKER_COALESCE_MIN_LAG ago, only the last
+# message of each train is processed, the others being stored as 'superseded' (no coalescing if not set).
+# Coalescing requires batches (PIV_WORKER_BATCH_SIZE > 1), and messages timestamped by their publisher
+# (no coalescing when the lag can't be computed)
+PIV_WORKER_COALESCE_MIN_LAG = (
+    int(os.getenv("KIRIN_PIV_WORKER_COALESCE_MIN_LAG"))
+    if os.getenv("KIRIN_PIV_WORKER_COALESCE_MIN_LAG")
+    else None
+)  # in seconds
 
 
 GTFS_RT_TIMEOUT = int(os.getenv("KIRIN_GTFS_RT_TIMEOUT", 1))
+# polled GTFS-RT feeds: only process the entities that changed since the previous poll (opt-in, disabled by default)
+GTFS_RT_ENTITY_CHANGE_DETECTION = boolean(os.getenv("KIRIN_GTFS_RT_ENTITY_CHANGE_DETECTION", False))
 
 USE_GEVENT = boolean(os.getenv("KIRIN_USE_GEVENT", False))
 
@@ -85,6 +129,18 @@ NAVITIA_QUERY_CACHE_TIMEOUT = int(
 NAVITIA_PUBDATE_CACHE_TIMEOUT = int(
     os.getenv("KIRIN_NAVITIA_PUBDATE_CACHE_TIMEOUT", timedelta(minutes=5).total_seconds())
 )  # in seconds
+# ids of the contributors for which all navitia's VJs are prefetched (comma-separated), and for how many days
+NAVITIA_VJ_PREFETCH_CONTRIBUTORS = [
+    c.strip() for c in os.getenv("KIRIN_NAVITIA_VJ_PREFETCH_CONTRIBUTORS", "").split(",") if c.strip()
+]
+NAVITIA_VJ_PREFETCH_NB_DAYS = int(os.getenv("KIRIN_NAVITIA_VJ_PREFETCH_NB_DAYS", 3))
+# directory of the base-schedule snapshots written by 'manage.py build_schedule_snapshot <contributor_id>'
+# and memory-mapped by all processes (no snapshot used if not set)
+NAVITIA_SCHEDULE_SNAPSHOT_DIR = os.getenv("KIRIN_NAVITIA_SCHEDULE_SNAPSHOT_DIR", None)
+# interval between checks of navitia's publication date to reload the referential cache (companies, modes, stops)
+NAVITIA_REFERENTIAL_CHECK_INTERVAL = int(
+    os.getenv("KIRIN_NAVITIA_REFERENTIAL_CHECK_INTERVAL", timedelta(minutes=1).total_seconds())
+)  # in seconds
 
 CACHE_TYPE = os.getenv("KIRIN_CACHE_TYPE", "simple")
 
@@ -149,6 +205,15 @@ REDIS_LOCK_TIMEOUT_POLLER = int(
 )
 REDIS_LOCK_TIMEOUT_PURGE = int(os.getenv("KIRIN_REDIS_LOCK_TIMEOUT_PURGE", timedelta(hours=12).total_seconds()))
 
+# TripUpdates are purged by batches of this size, each in its own transaction
+PURGE_TRIP_UPDATE_BATCH_SIZE = int(os.getenv("KIRIN_PURGE_TRIP_UPDATE_BATCH_SIZE", 1000))
+# opt-in throttling: between 2 batches, the purge sleeps this ratio of the last batch's duration
+# (0, the default, never sleeps; 1 halves the load of the purge on the database, but doubles its duration)
+PURGE_TRIP_UPDATE_SLEEP_RATIO = float(os.getenv("KIRIN_PURGE_TRIP_UPDATE_SLEEP_RATIO", 0))
+# when real_time_update is partitioned (see 'partition_real_time_update' command),
+# number of days the daily partitions are created in advance
+REAL_TIME_UPDATE_PARTITIONS_DAYS_AHEAD = int(os.getenv("KIRIN_REAL_TIME_UPDATE_PARTITIONS_DAYS_AHEAD", 7))
+
 TASK_LOCK_PREFIX = "kirin.lock"
 TASK_LAST_CALL_DATETIME_PREFIX = "kirin.last_exec_datetime"
 
@@ -160,6 +225,20 @@ TASK_WAIT_FIXED = int(os.getenv("KIRIN_TASK_WAIT_FIXED", timedelta(seconds=2).to
 # (can also  be longer if a task is running).
 POLLER_MIN_INTERVAL = int(os.getenv("KIRIN_POLLER_MIN_INTERVAL", timedelta(seconds=1).total_seconds()))
 
+# Continuous purge by the 'retention_worker' command, instead of the nightly purge tasks:
+# slices of at most RETENTION_WORKER_MAX_BATCH_SIZE objects are deleted for each contributor in turn.
+# Slices shrink (and pauses grow) when a slice lasts more than RETENTION_WORKER_TARGET_BATCH_DURATION (seconds)
+# or when replicas lag more than RETENTION_WORKER_MAX_REPLICATION_LAG (seconds)
+USE_RETENTION_WORKER = boolean(os.getenv("KIRIN_USE_RETENTION_WORKER", False))
+RETENTION_WORKER_MIN_BATCH_SIZE = int(os.getenv("KIRIN_RETENTION_WORKER_MIN_BATCH_SIZE", 50))
+RETENTION_WORKER_MAX_BATCH_SIZE = int(os.getenv("KIRIN_RETENTION_WORKER_MAX_BATCH_SIZE", 1000))
+RETENTION_WORKER_TARGET_BATCH_DURATION = float(os.getenv("KIRIN_RETENTION_WORKER_TARGET_BATCH_DURATION", 0.2))
+RETENTION_WORKER_MAX_REPLICATION_LAG = float(os.getenv("KIRIN_RETENTION_WORKER_MAX_REPLICATION_LAG", 5))
+# pause (seconds) between 2 slices, when the db is not overloaded
+RETENTION_WORKER_INTERVAL = float(os.getenv("KIRIN_RETENTION_WORKER_INTERVAL", 1))
+# pause (seconds) when there is nothing left to purge
+RETENTION_WORKER_IDLE_INTERVAL = float(os.getenv("KIRIN_RETENTION_WORKER_IDLE_INTERVAL", 60))
+
 CELERYBEAT_SCHEDULE = {
     "poller": {
         "task": "kirin.tasks.poller",
@@ -197,6 +276,12 @@ CELERYBEAT_SCHEDULE = {
         "options": {"expires": timedelta(hours=1).total_seconds()},
     },
 }
+if USE_RETENTION_WORKER:
+    CELERYBEAT_SCHEDULE = {
+        name: task
+        for name, task in CELERYBEAT_SCHEDULE.items()
+        if not task["task"].startswith("kirin.tasks.purge_")
+    }
 
 # https://flask-sqlalchemy.palletsprojects.com/en/2.x/signals/
 # deprecated and slow
@@ -36,11 +36,12 @@ from flask.globals import current_app
 from flask_restful import Resource, abort
 
 from kirin.core.build_wrapper import wrap_build
+from kirin.core.builder_registry import get_builder
+from kirin.core.contributor_registry import contributor_registry
 from kirin.exceptions import InvalidArguments
 import navitia_wrapper
 from kirin.gtfs_rt import KirinModelBuilder
 from kirin import redis_client
-from kirin.core import model
 from kirin.core.types import ConnectorType
 
 
@@ -48,7 +49,7 @@ def get_gtfsrt_contributors(include_deactivated=False):
     """
     :return: all GTFS-RT contributors from db
     """
-    return model.Contributor.find_by_connector_type(
+    return contributor_registry.find_by_connector_type(
         ConnectorType.gtfs_rt.value, include_deactivated=include_deactivated
     )
 
@@ -86,15 +87,11 @@ class GtfsRT(Resource):
         if id is None:
             abort(400, message="Contributor's id is missing")
 
-        contributor = (
-            model.Contributor.query_existing()
-            .filter_by(id=id, connector_type=ConnectorType.gtfs_rt.value)
-            .first()
-        )
+        contributor = contributor_registry.get(id, connector_type=ConnectorType.gtfs_rt.value)
         if not contributor:
             abort(404, message="Contributor '{}' not found".format(id))
 
         raw_proto = _get_gtfs_rt(flask.globals.request)
 
-        wrap_build(KirinModelBuilder(contributor), raw_proto)
+        wrap_build(get_builder(KirinModelBuilder, contributor), raw_proto)
         return {"message": "GTFS-RT feed processed"}, 200
@@ -30,6 +30,7 @@
 # www.navitia.io
 from __future__ import absolute_import, print_function, unicode_literals, division
 import datetime
+import hashlib
 import logging
 
 import six
@@ -40,24 +41,36 @@ from kirin import gtfs_realtime_pb2
 from kirin.core import model
 from kirin.core.abstract_builder import AbstractKirinModelBuilder
 from kirin.core.merge_utils import merge
+from kirin.core.navitia_referential import get_navitia_referential
 from kirin.core.types import ModificationType, get_higher_status, get_effect_by_stop_time_status, ConnectorType
 from kirin.exceptions import InternalException, InvalidArguments
 from kirin.utils import make_rt_update, floor_datetime, to_navitia_utc_str, set_rtu_status_ko, manage_db_error
-from kirin.utils import record_internal_failure
-from kirin import app
+from kirin.utils import record_internal_failure, build_redis_entity_hashes_key
+from kirin import app, redis_client
 import itertools
 import calendar
 
 
+# the entities memory of a contributor is forgotten if it's not polled for this long
+ENTITY_HASHES_TTL = datetime.timedelta(days=1)
+
+
 class KirinModelBuilder(AbstractKirinModelBuilder):
-    def __init__(self, contributor):
+    def __init__(self, contributor, detect_entity_changes=False):
+        """
+        :param detect_entity_changes: only process the entities that changed since the previous feed
+            (the hashes of the processed entities must be saved with save_entity_hashes() once processed)
+        """
         super(KirinModelBuilder, self).__init__(contributor)
         self.log = logging.LoggerAdapter(
             logging.getLogger(__name__), extra={str("contributor"): self.contributor.id}
         )
         self.period_filter_tolerance = datetime.timedelta(hours=3)  # TODO better period handling
         self.stop_code_key = "source"  # TODO conf
-        self.instance_data_pub_date = self.navitia.get_publication_date()
+        self.instance_data_pub_date = get_navitia_referential(self.navitia).get_publication_date()
+        self.detect_entity_changes = detect_entity_changes
+        # hashes of the entities of the last feed, to be saved once processed: (changed, removed entity ids)
+        self.entity_hashes_update = None
 
     def build_rt_update(self, input_raw):
         # create a raw gtfs-rt obj, save the raw protobuf into the db
@@ -100,6 +113,9 @@ class KirinModelBuilder(AbstractKirinModelBuilder):
             raise InvalidArguments("invalid protobuf")
 
         proto = rt_update.proto
+        # the builder may be reused for several feeds: keep up with navitia's data publication
+        # (requested at most once every NAVITIA_REFERENTIAL_CHECK_INTERVAL, not for each feed)
+        self.instance_data_pub_date = get_navitia_referential(self.navitia).get_publication_date()
 
         input_data_time = datetime.datetime.utcfromtimestamp(proto.header.timestamp)
         log_dict.update({"input_timestamp": input_data_time})
@@ -110,24 +126,88 @@ class KirinModelBuilder(AbstractKirinModelBuilder):
 
         trip_updates = []
 
-        for entity in proto.entity:
-            if not entity.trip_update:
-                continue
+        entities = [entity for entity in proto.entity if entity.trip_update]
+        unchanged_count = 0
+        if self.detect_entity_changes:
+            changed_entities = self._filter_changed_entities(entities, input_data_time)
+            unchanged_count = len(entities) - len(changed_entities)
+            log_dict.update(
+                {
+                    "unchanged_entity_count": unchanged_count,
+                    "removed_entity_count": len(self.entity_hashes_update[1]),
+                }
+            )
+            entities = changed_entities
+
+        for entity in entities:
             tu = self._make_trip_updates(entity.trip_update, input_data_time=input_data_time)
             trip_updates.extend(tu)
+            if not tu and self.detect_entity_changes:
+                # not applied (no VJ found, or not matching it): to be processed again with the next feed
+                self.entity_hashes_update[0].pop(entity.id, None)
 
-        if not trip_updates:
+        # if all entities are unchanged, the status is set when finding there is no new information
+        if not trip_updates and not unchanged_count:
             msg = "No information for this gtfs-rt with timestamp: {}".format(proto.header.timestamp)
             set_rtu_status_ko(rt_update, msg, is_reprocess_same_data_allowed=False)
             self.log.warning(msg)
 
-        log_dict = {}
         return trip_updates, log_dict
 
-    def _get_stop_code(self, nav_stop):
-        for c in nav_stop.get("codes", []):
-            if c["type"] == self.stop_code_key:
-                return c["value"]
+    def _hash_entity(self, entity, input_data_time):
+        # the VJs of an entity depend on navitia's data and on the period searched (see _get_navitia_vjs())
+        since_dt, until_dt = self._get_search_period(input_data_time)
+        content = "{}|{}|{}|".format(self.instance_data_pub_date, since_dt, until_dt).encode("utf-8")
+        return hashlib.md5(content + entity.SerializeToString()).hexdigest()
+
+    def _filter_changed_entities(self, entities, input_data_time):
+        """
+        Compare the entities with the ones of the previous feed (hash of the serialized FeedEntity of each
+        entity id), and prepare the update of these hashes (see save_entity_hashes())
+        Entities that disappear are only forgotten: their TripUpdates are left as last received
+        :return: the entities that are new or changed
+        """
+        hashes = {entity.id: self._hash_entity(entity, input_data_time) for entity in entities}
+        try:
+            previous_hashes = {
+                entity_id.decode("utf-8"): entity_hash.decode("utf-8")
+                for entity_id, entity_hash in redis_client.hgetall(
+                    build_redis_entity_hashes_key(self.contributor.id)
+                ).items()
+            }
+        except Exception as e:
+            # whatever the exception is, we don't want to break the processing: all entities are processed
+            self.log.warning("impossible to get the hashes of previous entities: {}".format(e))
+            previous_hashes = {}
+        changed_hashes = {
+            entity_id: entity_hash
+            for entity_id, entity_hash in hashes.items()
+            if previous_hashes.get(entity_id) != entity_hash
+        }
+        removed_ids = [entity_id for entity_id in previous_hashes if entity_id not in hashes]
+        self.entity_hashes_update = (changed_hashes, removed_ids)
+        return [entity for entity in entities if entity.id in changed_hashes]
+
+    def save_entity_hashes(self):
+        """
+        Remember the entities of the last feed processed, so that only changed ones are processed in the next one
+        """
+        if self.entity_hashes_update is None:
+            return
+        changed_hashes, removed_ids = self.entity_hashes_update
+        self.entity_hashes_update = None
+        key = build_redis_entity_hashes_key(self.contributor.id)
+        try:
+            pipe = redis_client.pipeline()
+            if removed_ids:
+                pipe.hdel(key, *removed_ids)
+            if changed_hashes:
+                pipe.hmset(key, changed_hashes)
+            pipe.expire(key, int(ENTITY_HASHES_TTL.total_seconds()))
+            pipe.execute()
+        except Exception as e:
+            # entities will only be processed again
+            self.log.warning("impossible to save the hashes of entities: {}".format(e))
 
     def _make_trip_updates(self, input_trip_update, input_data_time):
         """
@@ -159,7 +239,9 @@ class KirinModelBuilder(AbstractKirinModelBuilder):
                     break
 
                 if tu_stop is not None:
-                    if self._get_stop_code(vj_stop_point) != tu_stop.stop_id:
+                    if vj_stop_order not in vj.get_stop_time_positions(
+                        tu_stop.stop_id, code_type=self.stop_code_key
+                    ):
                         is_tu_valid = False
                         break
 
@@ -211,14 +293,16 @@ class KirinModelBuilder(AbstractKirinModelBuilder):
         """
         if since_dt.tzinfo is not None or until_dt.tzinfo is not None:
             raise InternalException("Invalid datetime provided: must be naive (and UTC)")
-        navitia_vjs = self.navitia.vehicle_journeys(
-            q={
-                "filter": "vehicle_journey.has_code({}, {})".format(self.stop_code_key, vj_source_code),
-                "since": to_navitia_utc_str(since_dt),
-                "until": to_navitia_utc_str(until_dt),
-                "depth": "2",  # we need this depth to get the stoptime's stop_area
-            }
-        )
+        navitia_vjs = self.find_local_vjs(since_dt, until_dt, code=(self.stop_code_key, vj_source_code))
+        if not navitia_vjs:
+            navitia_vjs = self.navitia.vehicle_journeys(
+                q={
+                    "filter": "vehicle_journey.has_code({}, {})".format(self.stop_code_key, vj_source_code),
+                    "since": to_navitia_utc_str(since_dt),
+                    "until": to_navitia_utc_str(until_dt),
+                    "depth": "2",  # we need this depth to get the stoptime's stop_area
+                }
+            )
 
         if not navitia_vjs:
             self.log.info(
@@ -247,11 +331,15 @@ class KirinModelBuilder(AbstractKirinModelBuilder):
             record_internal_failure("Error while creating kirin VJ", contributor=self.contributor.id)
             return []
 
+    def _get_search_period(self, input_data_time):
+        since_dt = floor_datetime(input_data_time - self.period_filter_tolerance)
+        until_dt = floor_datetime(input_data_time + self.period_filter_tolerance + datetime.timedelta(hours=1))
+        return since_dt, until_dt
+
     def _get_navitia_vjs(self, trip, input_data_time):
         vj_source_code = trip.trip_id
 
-        since_dt = floor_datetime(input_data_time - self.period_filter_tolerance)
-        until_dt = floor_datetime(input_data_time + self.period_filter_tolerance + datetime.timedelta(hours=1))
+        since_dt, until_dt = self._get_search_period(input_data_time)
         self.log.debug("searching for vj {} on [{}, {}] in navitia".format(vj_source_code, since_dt, until_dt))
 
         return self._make_db_vj(vj_source_code, since_dt, until_dt)
@@ -36,8 +36,9 @@ from datetime import datetime
 import requests
 import six
 
-from kirin.core import model
 from kirin.core.build_wrapper import wrap_build
+from kirin.core.builder_registry import get_builder
+from kirin.core.contributor_registry import contributor_registry
 from kirin.core.types import ConnectorType
 from kirin.cots.model_maker import as_duration
 
@@ -127,11 +128,7 @@ def _retrieve_gtfsrt(config):
 @retry(stop_max_delay=TASK_STOP_MAX_DELAY, wait_fixed=TASK_WAIT_FIXED, retry_on_exception=should_retry_exception)
 def gtfs_poller(self, config):
     func_name = "gtfs_poller"
-    contributor = (
-        model.Contributor.query_existing()
-        .filter_by(id=config.get("contributor"), connector_type=ConnectorType.gtfs_rt.value)
-        .first()
-    )
+    contributor = contributor_registry.get(config.get("contributor"), connector_type=ConnectorType.gtfs_rt.value)
 
     logger = logging.LoggerAdapter(logging.getLogger(__name__), extra={str("contributor"): contributor.id})
 
@@ -171,5 +168,9 @@ def gtfs_poller(self, config):
             logger.debug(six.text_type(e))
             return
 
-        wrap_build(KirinModelBuilder(contributor), response.content)
+        builder = get_builder(KirinModelBuilder, contributor)
+        builder.detect_entity_changes = app.config.get(str("GTFS_RT_ENTITY_CHANGE_DETECTION"), False)
+        wrap_build(builder, response.content)
+        # only once processed, so that entities are processed again in case of failure
+        builder.save_entity_hashes()
         logger.info("%s for %s is finished", func_name, contributor.id)
@@ -35,13 +35,13 @@ import logging
 from datetime import timedelta, datetime
 from sys import maxint
 
-import jmespath
 import ujson
 from operator import itemgetter
 
 from kirin.core import model
 from kirin.core.abstract_builder import AbstractKirinModelBuilder
 from kirin.core.merge_utils import merge
+from kirin.core.navitia_referential import get_navitia_referential
 from kirin.core.types import ModificationType, TripEffect, get_higher_status, get_effect_by_stop_time_status
 from kirin.exceptions import InvalidArguments, UnsupportedValue, ObjectNotFound
 from kirin.utils import make_rt_update, get_value, as_utc_naive_dt, record_internal_failure, as_duration
@@ -177,18 +177,41 @@ def _get_first_stop_base_datetime(list_ads, hour_obj_name, skip_fully_added_stop
     return as_utc_naive_dt(str_time) if str_time else None
 
 
+def get_piv_key(json_train):
+    """
+    Key identifying the train of a PIV message (date:number:company:mode:submode:typemode)
+    """
+    train_date = get_value(json_train, "dateCirculation")
+    train_numbers = get_value(json_train, "numero")
+    train_company = get_value(get_value(json_train, "operateur"), "codeOperateur")
+    mode_dict = get_value(json_train, "modeTransport")
+    train_mode = get_value(mode_dict, "codeMode")
+    train_submode = get_value(mode_dict, "codeSousMode")
+    train_typemode = get_value(mode_dict, "typeMode")
+    return "{d}:{n}:{c}:{m}:{s}:{t}".format(
+        d=train_date, n=train_numbers, c=train_company, m=train_mode, s=train_submode, t=train_typemode
+    )
+
+
+def get_piv_key_from_raw(input_raw):
+    """
+    :return: the key identifying the train of a raw PIV message, or None if the message is invalid
+    """
+    try:
+        return get_piv_key(get_value(get_value(ujson.loads(input_raw), "objects")[0], "object"))
+    except Exception:
+        return None
+
+
 def _make_navitia_empty_vj(piv_key):
     trip_id = TRIP_PIV_ID_FORMAT.format(piv_key)
     return {"id": "vehicle_journey:{}".format(trip_id), "trip": {"id": trip_id}}
 
 
-def _extract_navitia_stop_time(uic8, nav_vj):
+def _extract_navitia_stop_time(uic8, vj):
     # In base_schedule trip, searching for a stop_time at stop_point belonging to the right stop_area
     # stop_areas bear UIC8 code, while stop_point match one stop_area and one mode currently.
-    nav_stop_times = jmespath.search(
-        "stop_times[? stop_point.stop_area.codes[? value=='{uic8}' && type=='source']]".format(uic8=uic8),
-        nav_vj,
-    )
+    nav_stop_times = vj.find_navitia_stop_times_by_stop_area_code("source", uic8)
 
     log_dict = {}
     if not nav_stop_times:
@@ -283,16 +306,7 @@ class KirinModelBuilder(AbstractKirinModelBuilder):
             raise UnsupportedValue("planTransportSource {} is not supported".format(plan_transport_source))
 
         json_train["evenement"] = higher_disruption
-        train_date = get_value(json_train, "dateCirculation")
-        train_numbers = get_value(json_train, "numero")
-        train_company = get_value(get_value(json_train, "operateur"), "codeOperateur")
-        mode_dict = get_value(json_train, "modeTransport")
-        train_mode = get_value(mode_dict, "codeMode")
-        train_submode = get_value(mode_dict, "codeSousMode")
-        train_typemode = get_value(mode_dict, "typeMode")
-        piv_key = "{d}:{n}:{c}:{m}:{s}:{t}".format(
-            d=train_date, n=train_numbers, c=train_company, m=train_mode, s=train_submode, t=train_typemode
-        )
+        piv_key = get_piv_key(json_train)
 
         list_ads = get_value(json_train, "listeArretsDesserte")
         ads = _retrieve_interesting_stops(get_value(list_ads, "arret"))
@@ -315,13 +329,15 @@ class KirinModelBuilder(AbstractKirinModelBuilder):
         log = logging.LoggerAdapter(logging.getLogger(__name__), extra={str("contributor"): self.contributor.id})
 
         log.debug("searching for vj {} in navitia".format(piv_key))
-        navitia_vjs = self.navitia.vehicle_journeys(
-            q={
-                "filter": 'vehicle_journey.has_code("rt_piv", "{}")'.format(piv_key),
-                "depth": "2",  # we need this depth to get the stoptime's stop_area
-                "show_codes": "true",  # we need the stop_areas codes
-            }
-        )
+        navitia_vjs = self.find_local_vjs(code=("rt_piv", piv_key))
+        if not navitia_vjs:
+            navitia_vjs = self.navitia.vehicle_journeys(
+                q={
+                    "filter": 'vehicle_journey.has_code("rt_piv", "{}")'.format(piv_key),
+                    "depth": "2",  # we need this depth to get the stoptime's stop_area
+                    "show_codes": "true",  # we need the stop_areas codes
+                }
+            )
 
         if not navitia_vjs:
             # Last PIV information is always right, so if the VJ doesn't exist, it's an ADD (no matter feed content)
@@ -378,7 +394,7 @@ class KirinModelBuilder(AbstractKirinModelBuilder):
 
         for arret in ads:
             # retrieve navitia's stop_point corresponding to the current PIV ad
-            nav_stop, log_dict = self._get_navitia_stop_point(arret, vj.navitia_vj)
+            nav_stop, log_dict = self._get_navitia_stop_point(arret, vj)
             rt_stop_time = {"arrivee": None, "depart": None}  # used to check consistency
 
             if log_dict:
@@ -451,9 +467,9 @@ class KirinModelBuilder(AbstractKirinModelBuilder):
         """
         Get a navitia company for the given code
         """
-        company = self._request_navitia_company(code)
+        company = self._find_navitia_company(code)
         if not company:
-            company = self._request_navitia_company(DEFAULT_COMPANY_CODE)
+            company = self._find_navitia_company(DEFAULT_COMPANY_CODE)
             if not company:
                 raise ObjectNotFound(
                     "no company found for key {}, nor for the default company {}".format(
@@ -462,6 +478,11 @@ class KirinModelBuilder(AbstractKirinModelBuilder):
                 )
         return company.get("id", None) if company else None
 
+    def _find_navitia_company(self, code):
+        return get_navitia_referential(self.navitia).find_company(
+            "source", code, lambda: self._request_navitia_company(code)
+        )
+
     def _request_navitia_company(self, code):
         companies = self.navitia.companies(
             q={"filter": 'company.has_code("source", "{}")'.format(code), "count": "1"}
@@ -476,14 +497,16 @@ class KirinModelBuilder(AbstractKirinModelBuilder):
             "FERRE": "physical_mode:LongDistanceTrain",
             "ROUTIER": "physical_mode:Coach",
         }.get(indicator, DEFAULT_PHYSICAL_MODE_ID)
-        physical_mode = self._request_navitia_physical_mode(uri)
+        physical_mode = get_navitia_referential(self.navitia).find_physical_mode(
+            uri, lambda: self._request_navitia_physical_mode(uri)
+        )
         return physical_mode.get("id", None) if physical_mode else None
 
     def _request_navitia_physical_mode(self, uri):
         physical_modes = self.navitia.physical_modes(uri=uri)
         return physical_modes[0] if physical_modes else None
 
-    def _get_navitia_stop_point(self, arret, nav_vj):
+    def _get_navitia_stop_point(self, arret, vj):
         """
         Get a navitia stop point from the stop_time in a 'Point de Parcours' dict.
         The dict MUST contain cr, ci, ch tags.
@@ -495,22 +518,31 @@ class KirinModelBuilder(AbstractKirinModelBuilder):
         Error messages are also returned as 'missing stop point', 'duplicate stops'
         """
         uic8 = get_value(get_value(arret, "emplacement"), "code")
-        nav_st, log_dict = _extract_navitia_stop_time(uic8, nav_vj)
+        nav_st, log_dict = _extract_navitia_stop_time(uic8, vj)
         if not nav_st:
-            nav_stop, req_log_dict = self._request_navitia_stop_point(uic8)
+            nav_stop, req_log_dict = self._find_navitia_stop_point(uic8)
             log_dict.update(req_log_dict)
         else:
             nav_stop = nav_st.get("stop_point", None)
         return nav_stop, log_dict
 
+    def _find_navitia_stop_point(self, uic8):
+        stop_point = None
+        if self.schedule_snapshot:
+            stop_point = self.schedule_snapshot.find_stop_point_by_stop_area_code("source", uic8)
+        stop_point = stop_point or get_navitia_referential(self.navitia).find_stop_point_by_stop_area_code(
+            "source", uic8, lambda: self._request_navitia_stop_point(uic8)
+        )
+        if stop_point:
+            return stop_point, {}
+
+        return None, {"log": "No stop point found", "stop_point_code": uic8}
+
     def _request_navitia_stop_point(self, uic8):
         stop_points = self.navitia.stop_points(
             q={"filter": 'stop_area.has_code("source", "{}")'.format(uic8), "count": "1"}
         )
-        if stop_points:
-            return stop_points[0], {}
-
-        return None, {"log": "No stop point found", "stop_point_code": uic8}
+        return stop_points[0] if stop_points else None
 
     def merge_trip_updates(self, navitia_vj, db_trip_update, new_trip_update):
         return merge(navitia_vj, db_trip_update, new_trip_update, is_new_complete=True)
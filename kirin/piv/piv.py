@@ -36,8 +36,9 @@ from flask.globals import current_app
 from flask_restful import Resource, marshal, abort
 
 from kirin.core.build_wrapper import wrap_build
+from kirin.core.builder_registry import get_builder
+from kirin.core.contributor_registry import contributor_registry
 from kirin.exceptions import InvalidArguments
-from kirin.core import model
 from kirin.core.types import ConnectorType
 from kirin.piv import KirinModelBuilder
 
@@ -46,7 +47,7 @@ def get_piv_contributors(include_deactivated=False):
     """
     :return: all PIV contributors from db (not configurable via file)
     """
-    return model.Contributor.find_by_connector_type(
+    return contributor_registry.find_by_connector_type(
         ConnectorType.piv.value, include_deactivated=include_deactivated
     )
 
@@ -56,8 +57,7 @@ def get_piv_contributor(contributor_id):
     :param contributor_id: Identifier of the contributor
     :return: The PIV contributor from DB corresponding to the input ID
     """
-    contributors = [c for c in get_piv_contributors() if c.id == contributor_id]
-    return contributors[0] if contributors else None
+    return contributor_registry.get(contributor_id, connector_type=ConnectorType.piv.value)
 
 
 def _get_piv(req):
@@ -82,13 +82,11 @@ class Piv(Resource):
         if id is None:
             abort(400, message="Contributor's id is missing")
 
-        contributor = (
-            model.Contributor.query_existing().filter_by(id=id, connector_type=ConnectorType.piv.value).first()
-        )
+        contributor = get_piv_contributor(id)
         if not contributor:
             abort(404, message="Contributor '{}' not found".format(id))
 
         raw_json = _get_piv(flask.globals.request)
 
-        wrap_build(KirinModelBuilder(contributor), raw_json)
+        wrap_build(get_builder(KirinModelBuilder, contributor), raw_json)
         return {"message": "PIV feed processed"}, 200
@@ -34,14 +34,16 @@ from __future__ import absolute_import, print_function, unicode_literals, divisi
 import six
 from kombu import BrokerConnection, Exchange, Queue, Producer
 import logging
+import threading
+import time
 from amqp.exceptions import ConnectionForced
 import gevent
 from retrying import retry
-from kirin import task_pb2, gtfs_realtime_pb2
+from kirin import task_pb2
 from google.protobuf.message import DecodeError
 import socket
-from kirin.core.model import TripUpdate, db
-from kirin.core.populate_pb import convert_to_gtfsrt
+from kirin.core.model import db
+from kirin.core.populate_pb import convert_to_full_gtfsrt_str
 from kirin.utils import str_to_date, record_call
 from datetime import datetime
 from kombu.mixins import ConsumerProducerMixin
@@ -96,12 +98,9 @@ class RTReloader(ConsumerProducerMixin):
             if hasattr(task.load_realtime, "end_date"):
                 if task.load_realtime.end_date:
                     end_date = str_to_date(task.load_realtime.end_date)
-            feed = convert_to_gtfsrt(
-                TripUpdate.find_by_contributor_period(task.load_realtime.contributors, begin_date, end_date),
-                gtfs_realtime_pb2.FeedHeader.FULL_DATASET,
+            feed_str, trip_update_count = convert_to_full_gtfsrt_str(
+                task.load_realtime.contributors, begin_date, end_date
             )
-
-            feed_str = feed.SerializeToString()
             log.info(
                 "Starting of full feed publication {}, {}".format(len(feed_str), task),
                 extra={str("size"): len(feed_str), "task": task},
@@ -125,7 +124,7 @@ class RTReloader(ConsumerProducerMixin):
                 size=len(feed_str),
                 routing_key=task.load_realtime.queue_name,
                 duration=duration,
-                trip_update_count=len(feed.entity),
+                trip_update_count=trip_update_count,
                 contributor=task.load_realtime.contributors,
             )
         finally:
@@ -133,31 +132,131 @@ class RTReloader(ConsumerProducerMixin):
 
 
 class RabbitMQHandler(object):
-    def __init__(self, connection_string, exchange_name, exchange_type="topic"):
+    """
+    Publishes on a long-lived channel of a dedicated connection, in publisher confirms mode:
+    the exchange is declared once per channel, and the channel is reopened on a new connection after any failure.
+    """
+
+    def __init__(self, connection_string, exchange_name, exchange_type="topic", confirm_timeout=10):
         self._connection = BrokerConnection(connection_string)
+        self._publish_connection = None
         self._connections = {self._connection}  # set of connection for the heartbeat
         self._exchange = Exchange(
             exchange_name, durable=True, delivery_mode=2, type=exchange_type, auto_delete=False, no_declare=False
         )
+        self._confirm_timeout = confirm_timeout
+        self._publish_lock = threading.RLock()
+        self._producer = None
+        self._last_delivery_tag = 0
+        self._unconfirmed = {}  # {delivery_tag: publication time} of messages not confirmed by the broker yet
+        self._nb_rejected = 0
+        # messages not confirmed when their connection was lost (the broker may never have received them)
+        self._nb_lost = 0
+        self._nb_published = 0
+        self._last_confirm_latency = None
         monitor_heartbeats(self._connections)
 
+    def _on_ack(self, delivery_tag, multiple):
+        self._on_confirm(delivery_tag, multiple)
+
+    def _on_nack(self, delivery_tag, multiple):
+        self._nb_rejected += self._on_confirm(delivery_tag, multiple)
+
+    def _on_confirm(self, delivery_tag, multiple):
+        tags = [t for t in self._unconfirmed if t <= delivery_tag] if multiple else [delivery_tag]
+        published_times = [self._unconfirmed.pop(t) for t in tags if t in self._unconfirmed]
+        if published_times:
+            self._last_confirm_latency = time.time() - max(published_times)
+        return len(published_times)
+
+    def _get_producer(self):
+        if self._producer is None:
+            self._publish_connection = self._connection.clone()
+            self._connections.add(self._publish_connection)
+            channel = self._publish_connection.channel()
+            channel.confirm_select()
+            channel.events["basic_ack"].add(self._on_ack)
+            channel.events["basic_nack"].add(self._on_nack)
+            self._exchange.declare(channel=channel)
+            self._last_delivery_tag = 0
+            self._producer = Producer(channel, exchange=self._exchange, auto_declare=False)
+        return self._producer
+
+    def _reset_producer(self):
+        connection, self._publish_connection, self._producer = self._publish_connection, None, None
+        # delivery tags restart on the next channel: pending messages are reported by wait_for_confirms()
+        self._nb_lost += len(self._unconfirmed)
+        self._unconfirmed.clear()
+        if connection is not None:
+            self._connections.discard(connection)
+            try:
+                connection.release()
+            except Exception as e:
+                logging.getLogger(__name__).debug("error while releasing publication connection: %s", e)
+
     @retry(wait_fixed=200, stop_max_attempt_number=3)
-    def publish(self, item, contributor_id):
-        with self._connection.channel() as channel:
-            with Producer(channel) as producer:
-                producer.publish(
-                    item, exchange=self._exchange, routing_key=contributor_id, declare=[self._exchange]
+    def publish(self, item, contributor_id, wait_for_confirm=True):
+        """
+        Publish item, then wait for the broker to confirm it (and all previous publications) if wait_for_confirm.
+        Several items can be published with wait_for_confirm=False, then confirmed at once with wait_for_confirms().
+        """
+        with self._publish_lock:
+            try:
+                self._get_producer().publish(item, routing_key=contributor_id)
+                self._last_delivery_tag += 1
+                self._unconfirmed[self._last_delivery_tag] = time.time()
+                self._nb_published += 1
+                if wait_for_confirm:
+                    self.wait_for_confirms()
+            except Exception:
+                self._reset_producer()
+                raise
+
+    def wait_for_confirms(self):
+        """
+        Wait for the broker to confirm all publications (since the last call)
+        Raises socket.error if some of them were rejected, lost with their connection, or not confirmed in time
+        """
+        with self._publish_lock:
+            deadline = time.time() + self._confirm_timeout
+            while self._unconfirmed:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self._reset_producer()
+                    self._nb_lost = self._nb_rejected = 0
+                    raise socket.timeout("publications not confirmed by the broker in time")
+                try:
+                    self._publish_connection.drain_events(timeout=remaining)
+                except socket.timeout:
+                    pass
+                except Exception:
+                    self._reset_producer()
+                    self._nb_lost = self._nb_rejected = 0
+                    raise
+            if self._nb_lost:
+                nb_lost, self._nb_lost, self._nb_rejected = self._nb_lost, 0, 0
+                raise socket.error(
+                    "{} publications not confirmed before the connection was lost".format(nb_lost)
                 )
+            if self._nb_rejected:
+                nb_rejected, self._nb_rejected = self._nb_rejected, 0
+                raise socket.error("{} publications rejected by the broker".format(nb_rejected))
 
     def info(self):
         info = self._connection.info()
         info.pop("password", None)
+        info["publisher"] = {
+            "nb_published": self._nb_published,
+            "nb_in_flight": len(self._unconfirmed),
+            "last_confirm_latency": self._last_confirm_latency,
+        }
         return info
 
     def connect(self):
         self._connection.connect()
 
     def close(self):
+        self._reset_producer()
         for c in self._connections:
             c.release()
 
@@ -35,6 +35,7 @@ import jsonschema
 import sqlalchemy
 from flask_restful import Resource, marshal_with, fields, abort
 from kirin.core import model
+from kirin.core.builder_registry import invalidate_builder
 from kirin.core.types import ConnectorType
 from kirin.utils import db_commit
 
@@ -139,6 +140,7 @@ class Contributors(Resource):
                 nb_days_to_keep_rt_update,
             )
             db_commit(new_contrib)
+            invalidate_builder(id)
             return {"contributor": new_contrib}, 201
         except KeyError as e:
             err_msg = "Missing attribute '{}' in input data to construct a contributor".format(e)
@@ -169,6 +171,7 @@ class Contributors(Resource):
 
             model.Contributor.query.filter(model.Contributor.id == id).update(data)
             model.db.session.commit()
+            invalidate_builder(id)
             contributor = model.Contributor.query.get_or_404(id)
             return {"contributor": contributor}, 200
         except sqlalchemy.exc.SQLAlchemyError as e:
@@ -182,6 +185,7 @@ class Contributors(Resource):
         try:
             contributor.is_active = False
             model.db.session.commit()
+            invalidate_builder(id)
         except sqlalchemy.exc.SQLAlchemyError as e:
             abort(400, message=e)
 
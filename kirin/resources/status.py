@@ -41,6 +41,8 @@ from kirin.utils import (
     can_connect_to_database,
     get_database_pool_status,
 )
+from kirin.core.navitia_referential import get_navitia_referentials_status
+from kirin.core.schedule_snapshot import get_schedule_snapshots_status
 
 
 class Status(Resource):
@@ -51,6 +53,8 @@ class Status(Resource):
         res["db_version"] = get_database_version()
         res["navitia_url"] = current_app.config[str("NAVITIA_URL")]
         res["rabbitmq_info"] = kirin.rmq_handler.info()
+        res["navitia_referentials"] = get_navitia_referentials_status()
+        res["schedule_snapshots"] = get_schedule_snapshots_status()
         res["navitia_connection"] = "OK" if can_connect_to_navitia() else "KO"
         res["db_connection"] = "OK" if can_connect_to_database() else "KO"
 
@@ -37,6 +37,11 @@ from retrying import retry
 from kirin import app
 from kirin.core import model
 from kirin.core.model import TripUpdate, RealTimeUpdate, Contributor
+from kirin.core.rtu_partitions import (
+    is_real_time_update_partitioned,
+    drop_expired_real_time_update_partitions,
+    create_real_time_update_partitions,
+)
 from kirin.core.types import ConnectorType
 from kirin.gtfs_rt.gtfs_rt import get_gtfsrt_contributors
 from kirin.helper import make_celery
@@ -101,7 +106,13 @@ def purge_trip_update(self, config):
         until = datetime.date.today() - datetime.timedelta(days=int(config["nb_days_to_keep"]))
         logger.info("purge trip update for {} until {}".format(contributor, until))
 
-        TripUpdate.remove_by_contributors_and_period(contributors=[contributor], start_date=None, end_date=until)
+        TripUpdate.remove_by_contributors_and_period(
+            contributors=[contributor],
+            start_date=None,
+            end_date=until,
+            batch_size=app.config[str("PURGE_TRIP_UPDATE_BATCH_SIZE")],
+            sleep_ratio=app.config[str("PURGE_TRIP_UPDATE_SLEEP_RATIO")],
+        )
         logger.info("%s for %s is finished", func_name, contributor)
 
 
@@ -120,6 +131,18 @@ def purge_rt_update(self, config):
             logger.warning("%s for %s is already in progress", func_name, contributor)
             return
 
+        if is_real_time_update_partitioned():
+            # partitions hold all contributors: they are dropped after the longest retention, by a single task
+            partitions_lock_name = make_kirin_lock_name(func_name, "partitions")
+            with get_lock(logger, partitions_lock_name, app.config[str("REDIS_LOCK_TIMEOUT_PURGE")]) as locked:
+                if not locked:
+                    logger.info("partitions of real_time_update are already being purged")
+                    return
+                logger.info("purge realtime update by dropping partitions")
+                drop_expired_real_time_update_partitions()
+                create_real_time_update_partitions(app.config[str("REAL_TIME_UPDATE_PARTITIONS_DAYS_AHEAD")])
+            return
+
         until = datetime.date.today() - datetime.timedelta(days=int(config["nb_days_to_keep"]))
         logger.info("purge realtime update for {} until {}".format(contributor, until))
 
@@ -204,11 +204,17 @@ def build_redis_etag_key(contributor):
     return "|".join([contributor, "polling_HEAD"])
 
 
+def build_redis_entity_hashes_key(contributor):
+    # type: (unicode) -> unicode
+    return "|".join([contributor, "entity_hashes"])
+
+
 def allow_reprocess_same_data(contributor_id):
     # type: (unicode) -> None
     from kirin import redis_client
 
     redis_client.delete(build_redis_etag_key(contributor_id))  # wipe previous' ETag memory
+    redis_client.delete(build_redis_entity_hashes_key(contributor_id))  # wipe previous' entities memory
 
 
 def set_rtu_status_ko(rtu, error, is_reprocess_same_data_allowed):
@@ -245,6 +251,24 @@ def save_rt_data_with_error(data, connector_type, contributor_id, error, is_repr
     return rt_update
 
 
+def save_superseded_rt_data(superseded_data, connector_type, contributor_id):
+    """
+    Create and save (in a single commit) RTUs of realtime inputs that are not processed
+    because a newer input provides the complete state of the same object
+    :param superseded_data: list of (data, key of the object), in the order they were produced
+    """
+    for data, key in superseded_data:
+        rt_update = model.RealTimeUpdate(
+            data,
+            connector_type=connector_type,
+            contributor_id=contributor_id,
+            status="superseded",
+            error="superseded by a newer message for {}".format(key),
+        )
+        model.db.session.add(rt_update)
+    model.db.session.commit()
+
+
 def poke_updated_at(rtu):
     """
     just update the updated_at of the RealTimeUpdate object provided
@@ -0,0 +1,36 @@
+"""notify contributor changes
+
+Revision ID: 3d0c8b1ae2f4
+Revises: 7bfe6fc8271d
+Create Date: 2020-11-16 10:42:13.512374
+
+"""
+from __future__ import absolute_import, print_function, unicode_literals, division
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "3d0c8b1ae2f4"
+down_revision = "7bfe6fc8271d"
+
+
+def upgrade():
+    # Notify listeners (Kirin's contributor registry) on every change of the contributor table
+    op.execute(
+        """
+        CREATE OR REPLACE FUNCTION notify_contributor_change() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('contributor_change', TG_OP);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        """
+    )
+    op.execute(
+        "CREATE TRIGGER contributor_change AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON contributor "
+        "FOR EACH STATEMENT EXECUTE PROCEDURE notify_contributor_change();"
+    )
+
+
+def downgrade():
+    op.execute("DROP TRIGGER IF EXISTS contributor_change ON contributor;")
+    op.execute("DROP FUNCTION IF EXISTS notify_contributor_change();")
@@ -0,0 +1,31 @@
+"""
+Add feed_outbox table, storing feeds to publish for navitia
+
+Revision ID: 5e8a7c3d21f9
+Revises: a1f2c9e05b6d
+Create Date: 2020-11-24 09:31:52.264718
+
+"""
+from __future__ import absolute_import, print_function, unicode_literals, division
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "5e8a7c3d21f9"
+down_revision = "a1f2c9e05b6d"
+
+
+def upgrade():
+    op.create_table(
+        "feed_outbox",
+        sa.Column("id", sa.BigInteger(), nullable=False),
+        sa.Column("created_at", sa.DateTime(), nullable=False),
+        sa.Column("contributor_id", sa.Text(), nullable=False),
+        sa.Column("feed", sa.LargeBinary(), nullable=False),
+        sa.ForeignKeyConstraint(["contributor_id"], ["contributor.id"]),
+        sa.PrimaryKeyConstraint("id"),
+    )
+
+
+def downgrade():
+    op.drop_table("feed_outbox")
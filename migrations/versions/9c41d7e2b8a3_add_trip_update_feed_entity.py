@@ -0,0 +1,23 @@
+"""
+Add feed_entity to trip_update, storing its serialized GTFS-RT FeedEntity
+
+Revision ID: 9c41d7e2b8a3
+Revises: 5e8a7c3d21f9
+Create Date: 2020-11-26 14:05:11.482916
+
+"""
+from __future__ import absolute_import, print_function, unicode_literals, division
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "9c41d7e2b8a3"
+down_revision = "5e8a7c3d21f9"
+
+
+def upgrade():
+    op.add_column("trip_update", sa.Column("feed_entity", sa.LargeBinary(), nullable=True))
+
+
+def downgrade():
+    op.drop_column("trip_update", "feed_entity")
@@ -0,0 +1,30 @@
+"""
+Add 'superseded' value to possible real_time_update status
+
+Revision ID: a1f2c9e05b6d
+Revises: 3d0c8b1ae2f4
+Create Date: 2020-11-20 11:12:36.107245
+
+"""
+from __future__ import absolute_import, print_function, unicode_literals, division
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "a1f2c9e05b6d"
+down_revision = "3d0c8b1ae2f4"
+
+
+def upgrade():
+    op.execute("COMMIT")  # end previous transaction (automatically started by alembic)
+    op.execute("ALTER TYPE rt_status ADD VALUE 'superseded'")  # only possible outside of a transaction
+    op.execute("BEGIN")  # start new transaction (automatically ended by alembic)
+
+
+def downgrade():
+    op.execute("UPDATE real_time_update SET status = 'KO' WHERE status = 'superseded'")
+
+    # delete type 'superseded'
+    op.execute("ALTER TYPE rt_status RENAME TO rt_status_tmp")
+    op.execute("CREATE TYPE rt_status AS ENUM('OK', 'KO', 'pending')")  # no more 'superseded'
+    op.execute("ALTER TABLE real_time_update ALTER COLUMN status TYPE rt_status USING status::text::rt_status")
+    op.execute("DROP TYPE rt_status_tmp")
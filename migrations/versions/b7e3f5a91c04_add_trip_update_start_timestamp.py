@@ -0,0 +1,38 @@
+"""
+Add start_timestamp to trip_update (copy of its VJ's), indexed with contributor_id,
+to select the TripUpdates of a contributor on a period without joining vehicle_journey
+
+Revision ID: b7e3f5a91c04
+Revises: 9c41d7e2b8a3
+Create Date: 2020-12-01 10:22:47.103528
+
+"""
+from __future__ import absolute_import, print_function, unicode_literals, division
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "b7e3f5a91c04"
+down_revision = "9c41d7e2b8a3"
+
+
+def upgrade():
+    op.add_column("trip_update", sa.Column("start_timestamp", sa.DateTime(), nullable=True))
+    op.execute(
+        """
+        UPDATE trip_update SET start_timestamp = vehicle_journey.start_timestamp
+        FROM vehicle_journey WHERE vehicle_journey.id = trip_update.vj_id
+        """
+    )
+    op.alter_column("trip_update", "start_timestamp", nullable=False)
+    op.create_index(
+        "trip_update_contributor_id_start_timestamp_idx",
+        "trip_update",
+        ["contributor_id", "start_timestamp"],
+        unique=False,
+    )
+
+
+def downgrade():
+    op.drop_index("trip_update_contributor_id_start_timestamp_idx", table_name="trip_update")
+    op.drop_column("trip_update", "start_timestamp")
@@ -0,0 +1,47 @@
+"""
+Add stop_time_updates_data to trip_update, to store its StopTimeUpdates as a compact JSONB array
+(instead of rows of stop_time_update)
+
+Revision ID: e2a8c6f1d374
+Revises: b7e3f5a91c04
+Create Date: 2020-12-08 15:41:09.518347
+
+"""
+from __future__ import absolute_import, print_function, unicode_literals, division
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = "e2a8c6f1d374"
+down_revision = "b7e3f5a91c04"
+
+
+def upgrade():
+    op.add_column("trip_update", sa.Column("stop_time_updates_data", postgresql.JSONB(), nullable=True))
+
+
+def downgrade():
+    # StopTimeUpdates stored as compact arrays are converted back to rows of stop_time_update
+    # (see encode_stop_time_updates(): datetimes and delays are stored as seconds)
+    op.execute(
+        """
+        INSERT INTO stop_time_update (
+            id, trip_update_id, "order", stop_id, message,
+            departure, departure_delay, departure_status, arrival, arrival_delay, arrival_status,
+            created_at, updated_at
+        )
+        SELECT
+            CAST(st->>0 AS UUID), tu.vj_id, CAST(st->>2 AS INTEGER), st->>1, st->>3,
+            TIMESTAMP 'epoch' + CAST(st->>4 AS BIGINT) * INTERVAL '1 second',
+            CAST(st->>5 AS BIGINT) * INTERVAL '1 second',
+            CAST(st->>6 AS modification_type),
+            TIMESTAMP 'epoch' + CAST(st->>7 AS BIGINT) * INTERVAL '1 second',
+            CAST(st->>8 AS BIGINT) * INTERVAL '1 second',
+            CAST(st->>9 AS modification_type),
+            timezone('utc', now()), timezone('utc', now())
+        FROM trip_update tu, jsonb_array_elements(tu.stop_time_updates_data) st
+        WHERE tu.stop_time_updates_data IS NOT NULL
+        """
+    )
+    op.drop_column("trip_update", "stop_time_updates_data")
@@ -0,0 +1,23 @@
+"""
+Add fingerprint to trip_update, to skip TripUpdates received again without changes
+
+Revision ID: f4c19b7d3e58
+Revises: e2a8c6f1d374
+Create Date: 2020-12-10 11:05:37.264190
+
+"""
+from __future__ import absolute_import, print_function, unicode_literals, division
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "f4c19b7d3e58"
+down_revision = "e2a8c6f1d374"
+
+
+def upgrade():
+    op.add_column("trip_update", sa.Column("fingerprint", sa.Text(), nullable=True))
+
+
+def downgrade():
+    op.drop_column("trip_update", "fingerprint")
@@ -216,12 +216,17 @@ class PostgresDockerWrapper(DockerWrapper):
         psycopg2.connect(database=params.dbname, user=params.user, password=params.password, host=params.host)
 
 
-def postgres_docker(db_name="kirin_test", db_user="postgres", db_password="postgres", mounts=None):
-    # type: (unicode, unicode, unicode, Optional[List[docker.types.Mount]]) -> PostgresDockerWrapper
+def postgres_docker(
+    db_name="kirin_test",  # type: unicode
+    db_user="postgres",  # type: unicode
+    db_password="postgres",  # type: unicode
+    mounts=None,  # type: Optional[List[docker.types.Mount]]
+    postgres_image="postgres:9.4",  # type: unicode
+    container_name="kirin_test_postgres",  # type: unicode
+):
+    # type: (...) -> PostgresDockerWrapper
     env_vars = {"POSTGRES_DB": db_name, "POSTGRES_USER": db_user, "POSTGRES_PASSWORD": db_password}
 
-    postgres_image = "postgres:9.4"
-
     # The best way to get the image would be to get it from dockerhub,
     # but with this dumb wrapper the runtime time of the unit tests is reduced by 10s
     dockerfile_obj = BytesIO(str("FROM " + postgres_image))
@@ -229,7 +234,7 @@ def postgres_docker(db_name="kirin_test", db_user="postgres", db_password="postg
     pg_wrap = PostgresDockerWrapper(
         image_name=postgres_image,
         dockerfile_obj=dockerfile_obj,
-        container_name="kirin_test_postgres",
+        container_name=container_name,
         db_name=db_name,
         db_user=db_user,
         db_password=db_password,
@@ -34,7 +34,7 @@ import os
 import six
 
 from kirin import app, db
-from kirin.core import model
+from kirin.core import model, builder_registry, navitia_referential, vj_prefetcher, schedule_snapshot
 import pytest
 import flask_migrate
 
@@ -75,6 +75,10 @@ def clean_db(rabbitmq_docker_fixture):
     """
     before all tests the database is cleared
     """
+    builder_registry.clear()
+    navitia_referential.clear()
+    vj_prefetcher.clear()
+    schedule_snapshot.clear()
     with app.app_context():
         tables = [six.text_type(table) for table in db.metadata.sorted_tables]
         db.session.execute("TRUNCATE {} CASCADE;".format(", ".join(tables)))
@@ -159,7 +163,8 @@ def mock_rabbitmq(monkeypatch):
     from mock import MagicMock
 
     mock_amqp = MagicMock()
-    monkeypatch.setattr("kombu.messaging.Producer.publish", mock_amqp)
+    # publications are mocked at the handler level, as it waits for the broker to confirm them
+    monkeypatch.setattr("kirin.rabbitmq_handler.RabbitMQHandler.publish", mock_amqp)
 
     return mock_amqp
 
@@ -47,9 +47,19 @@ from kirin.core.model import (
     DEFAULT_DAYS_TO_KEEP_RT_UPDATE,
 )
 from kirin.command.purge_rt import purge_contributor
+from kirin.core import builder_registry
+from kirin.core.builder_registry import get_builder
+from kirin.core.contributor_registry import contributor_registry
 from kirin.core.types import ConnectorType
+from kirin.piv import KirinModelBuilder as PivKirinModelBuilder
 from kirin.utils import db_commit
 from tests.integration.gtfs_rt_test import basic_gtfs_rt_data, navitia
+from retrying import retry
+
+
+@retry(stop_max_delay=5000, wait_fixed=100)
+def wait_until(predicate):
+    assert predicate()
 
 
 def test_get_contributor_end_point(test_client):
@@ -568,3 +578,75 @@ def test_piv_contributor(test_client):
     assert contrib.navitia_token == "blablablabla"
     assert contrib.feed_url == "no_url"
     assert contrib.retrieval_interval == 30
+
+
+def test_builder_registry_invalidated_on_contributor_change(test_client):
+    db_commit(
+        model.Contributor(
+            id="realtime.sncf.piv",
+            navitia_coverage="sncf",
+            connector_type=ConnectorType.piv.value,
+            navitia_token="blablablabla",
+        )
+    )
+
+    def _get_builder():
+        contrib = model.Contributor.query_existing().filter_by(id="realtime.sncf.piv").first()
+        return get_builder(PivKirinModelBuilder, contrib)
+
+    # the builder is reused as long as the contributor's configuration doesn't change
+    builder = _get_builder()
+    assert _get_builder().navitia is builder.navitia
+    # each caller gets its own copy, so that concurrent requests don't share their state
+    assert _get_builder() is not builder
+
+    resp = test_client.put("/contributors/realtime.sncf.piv", json={"navitia_coverage": "sncf_piv"})
+    assert resp.status_code == 200
+    new_builder = _get_builder()
+    assert new_builder.navitia is not builder.navitia
+    assert new_builder.contributor.navitia_coverage == "sncf_piv"
+    assert _get_builder().navitia is new_builder.navitia
+
+    # a change not notified to the registry (ex: done by another process) is detected too
+    model.Contributor.query.filter_by(id="realtime.sncf.piv").update({"navitia_token": "new_token"})
+    db.session.commit()
+    assert _get_builder().navitia is not new_builder.navitia
+
+    resp = test_client.delete("/contributors/realtime.sncf.piv")
+    assert resp.status_code == 204
+    assert "realtime.sncf.piv" not in builder_registry._builders
+
+
+def test_contributor_registry_follows_contributor_changes(test_client):
+    new_contrib = {
+        "id": "realtime.sncf.piv",
+        "navitia_coverage": "sncf",
+        "connector_type": ConnectorType.piv.value,
+        "nb_days_to_keep_trip_update": DEFAULT_DAYS_TO_KEEP_TRIP_UPDATE,
+        "nb_days_to_keep_rt_update": DEFAULT_DAYS_TO_KEEP_RT_UPDATE,
+    }
+    assert contributor_registry.get("realtime.sncf.piv") is None
+    # changes are notified (not polled)
+    assert contributor_registry._listen_connection is not None
+
+    resp = test_client.post("/contributors", json=new_contrib)
+    assert resp.status_code == 201
+    contrib = contributor_registry.get("realtime.sncf.piv", connector_type=ConnectorType.piv.value)
+    assert contrib.navitia_coverage == "sncf"
+    assert contributor_registry.get("realtime.sncf.piv", connector_type=ConnectorType.cots.value) is None
+    assert "realtime.sncf.piv" in [
+        c.id for c in contributor_registry.find_by_connector_type(ConnectorType.piv.value)
+    ]
+
+    resp = test_client.put("/contributors/realtime.sncf.piv", json={"navitia_coverage": "sncf_piv"})
+    assert resp.status_code == 200
+    assert contributor_registry.get("realtime.sncf.piv").navitia_coverage == "sncf_piv"
+
+    # a change made outside of this process' sessions is notified by the db
+    db.engine.execute("UPDATE contributor SET navitia_token = 'new_token' WHERE id = 'realtime.sncf.piv';")
+    wait_until(lambda: contributor_registry.get("realtime.sncf.piv").navitia_token == "new_token")
+
+    resp = test_client.delete("/contributors/realtime.sncf.piv")
+    assert resp.status_code == 204
+    assert contributor_registry.get("realtime.sncf.piv") is None
+    assert contributor_registry.get("realtime.sncf.piv", include_deactivated=True) is not None
@@ -38,9 +38,11 @@ from kirin.core.model import TripUpdate
 from kirin.core.types import ConnectorType
 from kirin.cots import KirinModelBuilder, model_maker
 from kirin.cots.model_maker import ActionOnTrip
+from kirin.piv.model_maker import _extract_navitia_stop_time
 from tests.check_utils import get_fixture_data
 from tests.integration.utils_cots_test import requests_mock_cause_message
 from tests.integration.conftest import COTS_CONTRIBUTOR_ID
+import jmespath
 import json
 
 
@@ -201,3 +203,60 @@ def test_get_action_on_trip_delete(mock_navitia_fixture):
 
         action_on_trip = model_maker._get_action_on_trip(train_numbers, dict_version, pdps)
         assert action_on_trip == ActionOnTrip.FIRST_TIME_ADDED.name
+
+
+def _make_navitia_vj_with_stop_area_codes(nb_stops):
+    return {
+        "id": "vehicle_journey:1",
+        "trip": {"id": "trip:1"},
+        "stop_times": [
+            {
+                "utc_arrival_time": datetime(2015, 9, 8, 8, 0).time(),
+                "stop_point": {
+                    "id": "stop_point:{}".format(i),
+                    "stop_area": {
+                        "id": "stop_area:{}".format(i),
+                        "codes": [
+                            {"type": "CR-CI-CH", "value": "0087-{:06d}-00".format(i)},
+                            {"type": "source", "value": "{:08d}".format(i)},
+                        ],
+                    },
+                },
+            }
+            for i in range(nb_stops)
+        ],
+    }
+
+
+def test_navitia_stop_time_matching_index():
+    """
+    Matching all the stops of a 40-stop train by stop_area code gives the same stop_times as the jmespath
+    search previously run for each stop, using an index of the VJ built once on the first search
+    """
+    nb_stops = 40
+    nav_vj = _make_navitia_vj_with_stop_area_codes(nb_stops)
+    vj = model.VehicleJourney(nav_vj, datetime(2015, 9, 8, 7, 0), datetime(2015, 9, 8, 9, 0))
+    assert getattr(vj, "_stop_area_code_index", None) is None
+
+    code_index = None
+    for i in range(nb_stops):
+        nav_ext_code = "0087-{:06d}-00".format(i)
+        jmespath_stop_times = jmespath.search(
+            "stop_times[? stop_point.stop_area.codes[? value=='{}' && type=='CR-CI-CH']]".format(nav_ext_code),
+            nav_vj,
+        )
+        nav_st, log_dict = model_maker.get_navitia_stop_time_sncf("0087", "{:06d}".format(i), "00", vj)
+        assert nav_st is jmespath_stop_times[0]
+        assert nav_st["stop_point"]["id"] == "stop_point:{}".format(i)
+        assert not log_dict
+        # the index is built on the first search, then reused
+        code_index = code_index or vj._stop_area_code_index
+        assert vj._stop_area_code_index is code_index
+
+    # PIV matches on the UIC8 'source' code, using the same index
+    for i in range(nb_stops):
+        nav_st, log_dict = _extract_navitia_stop_time("{:08d}".format(i), vj)
+        assert nav_st["stop_point"]["id"] == "stop_point:{}".format(i)
+    nav_st, log_dict = _extract_navitia_stop_time("unknown", vj)
+    assert nav_st is None
+    assert log_dict == {"log": "missing stop point", "stop_point_code": "unknown"}
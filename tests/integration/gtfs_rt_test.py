@@ -54,7 +54,12 @@ from kirin.tasks import purge_trip_update, purge_rt_update
 from tests import mock_navitia
 from tests.check_utils import api_post, api_get
 from kirin import gtfs_realtime_pb2, app
-from kirin.utils import save_rt_data_with_error, manage_db_error, build_redis_etag_key
+from kirin.utils import (
+    save_rt_data_with_error,
+    manage_db_error,
+    build_redis_etag_key,
+    build_redis_entity_hashes_key,
+)
 from tests.integration.conftest import GTFS_CONTRIBUTOR_ID
 import time
 from sqlalchemy import desc
@@ -247,6 +252,75 @@ def test_gtfs_model_builder(basic_gtfs_rt_data, basic_gtfs_rt_data_without_delay
         assert trip_updates[0].effect == "UNKNOWN_EFFECT"
 
 
+def test_gtfs_model_builder_entity_change_detection(
+    basic_gtfs_rt_data, basic_gtfs_rt_data_without_delays, mock_rabbitmq
+):
+    """
+    with change detection, only the entities that changed since the previous feed are processed
+    """
+    redis_client.delete(build_redis_entity_hashes_key(GTFS_CONTRIBUTOR_ID))
+    with app.app_context():
+        contributor = model.Contributor(
+            id=GTFS_CONTRIBUTOR_ID, navitia_coverage=None, connector_type=ConnectorType.gtfs_rt.value
+        )
+        builder = KirinModelBuilder(contributor, detect_entity_changes=True)
+        processed_trips = []
+        make_trip_updates = builder._make_trip_updates
+
+        def _make_trip_updates(input_trip_update, input_data_time):
+            processed_trips.append(input_trip_update.trip.trip_id)
+            return make_trip_updates(input_trip_update, input_data_time)
+
+        builder._make_trip_updates = _make_trip_updates
+
+        wrap_build(builder, basic_gtfs_rt_data)
+        builder.save_entity_hashes()
+        assert processed_trips == ["Code-R-vj1"]
+        assert redis_client.hkeys(build_redis_entity_hashes_key(GTFS_CONTRIBUTOR_ID)) == [b"bob"]
+
+        # same entity in a newer feed: not processed
+        feed = gtfs_realtime_pb2.FeedMessage()
+        feed.ParseFromString(basic_gtfs_rt_data)
+        feed.header.timestamp += 60
+        wrap_build(builder, feed.SerializeToString())
+        builder.save_entity_hashes()
+        assert processed_trips == ["Code-R-vj1"]
+        rt_update = RealTimeUpdate.query.order_by(desc(RealTimeUpdate.created_at)).first()
+        assert rt_update.trip_updates == []
+        assert rt_update.status == "KO"
+
+        # same entity on the next day: searched on another period, so it is considered as changed
+        entity = feed.entity[0]
+        input_data_time = datetime.datetime.utcfromtimestamp(feed.header.timestamp)
+        assert builder._hash_entity(entity, input_data_time) != builder._hash_entity(
+            entity, input_data_time + timedelta(days=1)
+        )
+
+        # entity not matching its VJ (not applied): its hash is not saved, so it is processed again
+        entity.trip_update.stop_time_update[0].stop_id = "Code-StopUnknown"
+        for _ in range(2):
+            feed.header.timestamp += 60
+            wrap_build(builder, feed.SerializeToString())
+            assert builder.entity_hashes_update[0] == {}
+            builder.save_entity_hashes()
+        assert processed_trips == ["Code-R-vj1", "Code-R-vj1", "Code-R-vj1"]
+
+        # changed entity: processed
+        wrap_build(builder, basic_gtfs_rt_data_without_delays)
+        builder.save_entity_hashes()
+        assert processed_trips == ["Code-R-vj1"] * 4
+        assert TripUpdate.query.one().effect == "UNKNOWN_EFFECT"
+
+        # entity removed from the feed: forgotten, its TripUpdate is kept
+        feed = gtfs_realtime_pb2.FeedMessage()
+        feed.ParseFromString(basic_gtfs_rt_data)
+        del feed.entity[:]
+        wrap_build(builder, feed.SerializeToString())
+        builder.save_entity_hashes()
+        assert redis_client.hkeys(build_redis_entity_hashes_key(GTFS_CONTRIBUTOR_ID)) == []
+        assert TripUpdate.query.count() == 1
+
+
 def test_gtfs_rt_simple_delay(basic_gtfs_rt_data, mock_rabbitmq):
     """
     test the gtfs-rt post with a simple gtfs-rt
@@ -29,12 +29,16 @@
 # https://groups.google.com/d/forum/navitia
 # www.navitia.io
 from __future__ import absolute_import, print_function, unicode_literals, division
+from contextlib import contextmanager
 from datetime import timedelta
+import os
 
+import flask_migrate
 import pytest
+import sqlalchemy
 
-from kirin.core import model
-from kirin.core.build_wrapper import handle
+from kirin.core import model, build_wrapper
+from kirin.core.build_wrapper import handle, get_dated_vj_key
 from kirin.core.model import RealTimeUpdate, TripUpdate, VehicleJourney, StopTimeUpdate
 from kirin.core.types import ConnectorType
 from kirin.gtfs_rt import gtfs_rt
@@ -692,6 +696,278 @@ def test_multiple_delays_in_2_updates(navitia_vj):
         assert len(StopTimeUpdate.query.all()) == 3
 
 
+def test_bounded_real_time_update_history(navitia_vj, monkeypatch):
+    """
+    only the last MAX_RT_UPDATES_PER_TRIP_UPDATE RealTimeUpdates stay linked to a TripUpdate
+    """
+    monkeypatch.setitem(app.config, str("MAX_RT_UPDATES_PER_TRIP_UPDATE"), 2)
+    with app.app_context():
+        contributor = model.Contributor(
+            id=GTFS_CONTRIBUTOR_ID, navitia_coverage=None, connector_type=ConnectorType.gtfs_rt.value
+        )
+        builder = gtfs_rt.KirinModelBuilder(contributor)
+
+        rtu_ids = []
+        for delay in [5, 10, 15]:
+            trip_update = TripUpdate(_create_db_vj(navitia_vj), status="update", contributor_id=contributor.id)
+            real_time_update = make_rt_update(
+                raw_data=None, connector_type=ConnectorType.gtfs_rt.value, contributor_id=contributor.id
+            )
+            trip_update.stop_time_updates = [
+                StopTimeUpdate({"id": "sa:1"}, departure_delay=timedelta(minutes=delay), dep_status="update")
+            ]
+            res, _ = handle(builder, real_time_update, [trip_update])
+            rtu_ids.append(res.id)
+
+        db.session.expire_all()
+        trip_update = TripUpdate.query.one()
+        assert sorted(rtu.id for rtu in trip_update.real_time_updates) == sorted(rtu_ids[1:])
+        # RealTimeUpdates are kept, they are purged later
+        assert RealTimeUpdate.query.count() == 3
+
+
+def _make_long_navitia_vj(nb_stops):
+    start = datetime.datetime(2015, 9, 8, 1, 0)
+    return {
+        "trip": {"id": "vehicle_journey:{}_stops".format(nb_stops)},
+        "stop_times": [
+            {
+                "utc_arrival_time": (start + timedelta(minutes=3 * i)).time(),
+                "utc_departure_time": (start + timedelta(minutes=3 * i + 1)).time(),
+                "stop_point": {"id": "sa:{}".format(i), "stop_area": {"timezone": "UTC"}},
+            }
+            for i in range(nb_stops)
+        ],
+    }
+
+
+@contextmanager
+def count_stop_time_update_writes():
+    """
+    Count the rows of stop_time_update inserted, updated and deleted inside the block
+    """
+    counter = {"INSERT": 0, "UPDATE": 0, "DELETE": 0}
+
+    def _count(conn, cursor, statement, parameters, context, executemany):
+        words = statement.split(None, 3)
+        if words[0] in counter and "stop_time_update" in words[:3]:
+            counter[words[0]] += len(parameters) if executemany else 1
+
+    sqlalchemy.event.listen(db.engine, "before_cursor_execute", _count)
+    try:
+        yield counter
+    finally:
+        sqlalchemy.event.remove(db.engine, "before_cursor_execute", _count)
+
+
+def test_merge_stop_time_update_writes():
+    """
+    SQL statements persisting the merge of a delay change on one stop of long VJs:
+    only the row of this stop is updated (all the following ones used to be deleted and re-inserted)
+    """
+    with app.app_context():
+        contributor = model.Contributor(
+            id=GTFS_CONTRIBUTOR_ID, navitia_coverage=None, connector_type=ConnectorType.gtfs_rt.value
+        )
+        builder = gtfs_rt.KirinModelBuilder(contributor)
+        for nb_stops in [10, 100, 400]:
+            navitia_vj = _make_long_navitia_vj(nb_stops)
+            for delay in [1, 2]:
+                vj = VehicleJourney(
+                    navitia_vj, datetime.datetime(2015, 9, 8, 0, 0), datetime.datetime(2015, 9, 8, 2, 0)
+                )
+                trip_update = TripUpdate(vj, status="update", contributor_id=contributor.id)
+                real_time_update = make_rt_update(
+                    raw_data=None, connector_type=ConnectorType.gtfs_rt.value, contributor_id=contributor.id
+                )
+                # complete trip, with a delay on the stop in the middle
+                trip_update.stop_time_updates = [
+                    StopTimeUpdate(
+                        {"id": "sa:{}".format(i)},
+                        departure_delay=timedelta(minutes=delay if i == nb_stops // 2 else 0),
+                        dep_status="update" if i == nb_stops // 2 else "none",
+                    )
+                    for i in range(nb_stops)
+                ]
+                with count_stop_time_update_writes() as writes:
+                    handle(builder, real_time_update, [trip_update])
+
+            assert writes == {"INSERT": 0, "UPDATE": 1, "DELETE": 0}
+
+
+def _make_long_trip_update(contributor, nb_stops, delay):
+    vj = VehicleJourney(
+        _make_long_navitia_vj(nb_stops), datetime.datetime(2015, 9, 8, 0, 0), datetime.datetime(2015, 9, 8, 2, 0)
+    )
+    trip_update = TripUpdate(vj, status="update", contributor_id=contributor.id)
+    trip_update.stop_time_updates = [
+        StopTimeUpdate(
+            {"id": "sa:{}".format(i)},
+            departure=datetime.datetime(2015, 9, 8, 1, 3 * i % 60),
+            departure_delay=timedelta(minutes=delay if i == nb_stops // 2 else 0),
+            dep_status="update" if i == nb_stops // 2 else "none",
+            message="late" if i == nb_stops // 2 else None,
+        )
+        for i in range(nb_stops)
+    ]
+    return trip_update
+
+
+def _get_stop_times(trip_update):
+    return [
+        tuple(getattr(st, field) for field in StopTimeUpdate._fields) for st in trip_update.stop_time_updates
+    ]
+
+
+def test_compact_stop_time_update_storage(monkeypatch):
+    """
+    StopTimeUpdates of new TripUpdates are stored in the TripUpdate in compact storage,
+    and are read and merged the same way as rows; TripUpdates can be converted between both storages
+    """
+    monkeypatch.setitem(app.config, str("STOP_TIME_UPDATE_STORAGE"), model.STOP_TIME_UPDATE_COMPACT_STORAGE)
+    with app.app_context():
+        contributor = model.Contributor(
+            id=GTFS_CONTRIBUTOR_ID, navitia_coverage=None, connector_type=ConnectorType.gtfs_rt.value
+        )
+        builder = gtfs_rt.KirinModelBuilder(contributor)
+        for delay in [1, 2]:
+            real_time_update = make_rt_update(
+                raw_data=None, connector_type=ConnectorType.gtfs_rt.value, contributor_id=contributor.id
+            )
+            handle(builder, real_time_update, [_make_long_trip_update(contributor, 5, delay)])
+        expected_stop_times = _get_stop_times(_make_long_trip_update(contributor, 5, 2))
+        db.session.expire_all()
+
+        assert StopTimeUpdate.query.count() == 0
+        trip_update = TripUpdate.query.one()
+        assert trip_update.is_compact()
+        assert _get_stop_times(trip_update) == expected_stop_times
+        assert trip_update.find_stop("sa:2").departure_delay == timedelta(minutes=2)
+        stop_time_update_ids = [st.id for st in trip_update.stop_time_updates]
+
+        # only changed TripUpdates are encoded at flush
+        encoded = []
+        encode_stop_time_updates = model.encode_stop_time_updates
+
+        def _encode_stop_time_updates(stop_time_updates):
+            encoded.append(stop_time_updates)
+            return encode_stop_time_updates(stop_time_updates)
+
+        monkeypatch.setattr(model, "encode_stop_time_updates", _encode_stop_time_updates)
+        db.session.flush()
+        assert encoded == []
+        trip_update.find_stop("sa:3").message = "changed"
+        db.session.flush()
+        assert len(encoded) == 1
+        db.session.rollback()
+
+        # ids of StopTimeUpdates are kept in compact storage, and when converting it
+        trip_update = TripUpdate.query.one()
+        assert [st.id for st in trip_update.stop_time_updates] == stop_time_update_ids
+        assert TripUpdate.convert_stop_time_update_storage_batch(model.STOP_TIME_UPDATE_ROWS_STORAGE, 10) == 1
+        db.session.commit()
+        assert StopTimeUpdate.query.count() == 5
+        trip_update = TripUpdate.query.one()
+        assert not trip_update.is_compact()
+        assert _get_stop_times(trip_update) == expected_stop_times
+        assert [st.id for st in trip_update.stop_time_updates] == stop_time_update_ids
+
+        assert TripUpdate.convert_stop_time_update_storage_batch(model.STOP_TIME_UPDATE_COMPACT_STORAGE, 10) == 1
+        db.session.commit()
+        assert StopTimeUpdate.query.count() == 0
+        trip_update = TripUpdate.query.one()
+        assert trip_update.is_compact()
+        assert _get_stop_times(trip_update) == expected_stop_times
+
+        # StopTimeUpdates in compact storage are converted back to rows when downgrading the database
+        db.session.remove()
+        migration_dir = os.path.join(os.path.dirname(__file__), "..", "..", "migrations")
+        flask_migrate.downgrade(revision="b7e3f5a91c04", directory=migration_dir)
+        try:
+            rows = db.session.execute(
+                'SELECT id, stop_id, departure_delay FROM stop_time_update ORDER BY "order"'
+            ).fetchall()
+            assert [row[0] for row in rows] == stop_time_update_ids
+            assert rows[2][1] == "sa:2"
+            assert rows[2][2] == timedelta(minutes=2)
+            db.session.remove()
+        finally:
+            flask_migrate.upgrade(directory=migration_dir)
+        trip_update = TripUpdate.query.one()
+        assert not trip_update.is_compact()
+        assert _get_stop_times(trip_update) == expected_stop_times
+
+
+def test_unchanged_trip_update_is_skipped():
+    """
+    A TripUpdate received again without changes (same fingerprint) is neither merged nor published
+    """
+    with app.app_context():
+        contributor = model.Contributor(
+            id=GTFS_CONTRIBUTOR_ID, navitia_coverage=None, connector_type=ConnectorType.gtfs_rt.value
+        )
+        builder = gtfs_rt.KirinModelBuilder(contributor)
+        results = []
+        for delay in [1, 1, 2]:
+            real_time_update = make_rt_update(
+                raw_data=None, connector_type=ConnectorType.gtfs_rt.value, contributor_id=contributor.id
+            )
+            results.append(handle(builder, real_time_update, [_make_long_trip_update(contributor, 5, delay)]))
+
+        (first_rtu, first_log), (second_rtu, second_log), (third_rtu, third_log) = results
+        assert len(first_rtu.trip_updates) == 1
+        assert first_log["unchanged_trip_update_count"] == 0
+        assert first_rtu.trip_updates[0].fingerprint is not None
+
+        assert second_rtu.trip_updates == []
+        assert second_log["unchanged_trip_update_count"] == 1
+        assert second_log["trip_update_count"] == 0
+        assert second_rtu.status == "KO"
+
+        assert len(third_rtu.trip_updates) == 1
+        assert third_log["unchanged_trip_update_count"] == 0
+        trip_update = TripUpdate.query.one()
+        assert trip_update.find_stop("sa:2").departure_delay == timedelta(minutes=2)
+        assert trip_update.fingerprint == _make_long_trip_update(contributor, 5, 2).compute_fingerprint()
+
+
+def test_stop_time_update_storage_writes(monkeypatch):
+    """
+    Rows of stop_time_update written when persisting TripUpdates of long VJs in both storages,
+    the StopTimeUpdates being read the same way
+    """
+    nb_trips = 10
+    nb_stops = 100
+    with app.app_context():
+        contributor = model.Contributor(
+            id=GTFS_CONTRIBUTOR_ID, navitia_coverage=None, connector_type=ConnectorType.gtfs_rt.value
+        )
+        builder = gtfs_rt.KirinModelBuilder(contributor)
+        for storage in [model.STOP_TIME_UPDATE_ROWS_STORAGE, model.STOP_TIME_UPDATE_COMPACT_STORAGE]:
+            monkeypatch.setitem(app.config, str("STOP_TIME_UPDATE_STORAGE"), storage)
+            db.session.execute("TRUNCATE trip_update, vehicle_journey CASCADE;")
+            db.session.commit()
+            trip_updates = []
+            for i in range(nb_trips):
+                trip_update = _make_long_trip_update(contributor, nb_stops, 1)
+                trip_update.vj.navitia_trip_id = "vehicle_journey:{}".format(i)
+                trip_updates.append(trip_update)
+            real_time_update = make_rt_update(
+                raw_data=None, connector_type=ConnectorType.gtfs_rt.value, contributor_id=contributor.id
+            )
+            with count_stop_time_update_writes() as writes:
+                _, log_dict = handle(builder, real_time_update, trip_updates)
+            assert log_dict["unchanged_trip_update_count"] == 0
+            db.session.expire_all()
+
+            loaded = TripUpdate.query.all()
+            assert sum(len(tu.stop_time_updates) for tu in loaded) == nb_trips * nb_stops
+            if storage == model.STOP_TIME_UPDATE_COMPACT_STORAGE:
+                assert writes == {"INSERT": 0, "UPDATE": 0, "DELETE": 0}
+            else:
+                assert writes["INSERT"] == nb_trips * nb_stops
+
+
 def test_delays_then_cancellation(setup_database, navitia_vj):
     """
     We have a delay on the first st of a vj in the db and we receive a cancellation on this vj,
@@ -858,3 +1134,45 @@ def test_cancellation_then_delay_in_2_updates(navitia_vj):
         res, _ = handle(builder, real_time_update, [trip_update])
 
         _check_cancellation_then_delay(res)
+
+
+def _make_dated_trip_updates(nb_trips):
+    since_dt = datetime.datetime(2015, 9, 8, 7, 10)
+    until_dt = datetime.datetime(2015, 9, 8, 9, 10)
+    trip_updates = []
+    for i in range(nb_trips):
+        navitia_vj = {
+            "trip": {"id": "vehicle_journey:{}".format(i)},
+            "stop_times": [{"utc_arrival_time": datetime.time(8, 10)}],
+        }
+        trip_updates.append(
+            TripUpdate(VehicleJourney(navitia_vj, since_dt, until_dt), contributor_id=GTFS_CONTRIBUTOR_ID)
+        )
+    return trip_updates
+
+
+def test_dated_vj_matching_is_linear(monkeypatch):
+    """
+    Matching between incoming TripUpdates and the ones retrieved from db done in handle():
+    each TripUpdate's dated VJ key is computed once, whatever the number of entities (it used to be quadratic)
+    """
+    nb_keys = [0]
+
+    def _get_dated_vj_key(trip_update):
+        nb_keys[0] += 1
+        return get_dated_vj_key(trip_update)
+
+    monkeypatch.setattr(build_wrapper, "get_dated_vj_key", _get_dated_vj_key)
+    for nb_trips in [10, 100, 1000]:
+        new_trip_updates = _make_dated_trip_updates(nb_trips)
+        old_trip_updates = list(reversed(_make_dated_trip_updates(nb_trips)))
+
+        nb_keys[0] = 0
+        indexed_old_trip_updates = build_wrapper.index_by_dated_vj(old_trip_updates)
+        matches = [indexed_old_trip_updates.get(build_wrapper.get_dated_vj_key(tu)) for tu in new_trip_updates]
+
+        assert all(
+            old is not None and old.vj.navitia_trip_id == new.vj.navitia_trip_id
+            for old, new in zip(matches, new_trip_updates)
+        )
+        assert nb_keys[0] == 2 * nb_trips
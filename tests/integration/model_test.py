@@ -33,7 +33,7 @@ from __future__ import absolute_import, print_function, unicode_literals, divisi
 
 from sqlalchemy.orm.exc import FlushError
 
-from kirin.core.model import TripUpdate, StopTimeUpdate, Contributor
+from kirin.core.model import TripUpdate, StopTimeUpdate, Contributor, VehicleJourney
 from kirin.core.types import ConnectorType
 from kirin.utils import db_commit
 from tests.integration.conftest import COTS_CONTRIBUTOR_ID, GTFS_CONTRIBUTOR_ID
@@ -79,6 +79,25 @@ def test_find_by_vj(setup_database):
         assert row.vj_id == "70866ce8-0638-4fa1-8556-1ddfa22d09d4"
 
 
+def test_find_by_dated_vjs(setup_database):
+    with app.app_context():
+        dated_vjs = [
+            ("vehicle_journey:1", datetime.datetime(2015, 9, 8, 8, 0)),
+            ("vehicle_journey:1", datetime.datetime(2015, 9, 9, 8, 0)),
+            ("vehicle_journey:2", datetime.datetime(2015, 9, 9, 8, 0)),
+        ]
+        # result is the same whatever the number of chunks needed
+        for chunk_size in [1, 2, 500]:
+            rows = TripUpdate.find_by_dated_vjs(dated_vjs, chunk_size=chunk_size)
+            assert sorted(row.vj_id for row in rows) == [
+                "70866ce8-0638-4fa1-8556-1ddfa22d09d3",
+                "70866ce8-0638-4fa1-8556-1ddfa22d09d5",
+            ]
+            assert all(row.vj is not None for row in rows)
+
+        assert TripUpdate.find_by_dated_vjs([]) == []
+
+
 def test_find_stop():
     with app.app_context():
         vj = create_trip_update(
@@ -98,6 +117,108 @@ def test_find_stop():
         assert vj.find_stop("sa:4") is None
 
 
+def test_find_stop_after_stop_time_updates_change():
+    with app.app_context():
+        vj = create_trip_update(
+            "70866ce8-0638-4fa1-8556-1ddfa22d09d3", "vj1", datetime.date(2015, 9, 8), COTS_CONTRIBUTOR_ID
+        )
+        st1 = StopTimeUpdate({"id": "sa:1"}, None, None, order=0)
+        vj.stop_time_updates.append(st1)
+        assert vj.find_stop("sa:1") == st1
+        assert vj.find_stop("sa:2") is None
+
+        # lollipop: sa:1 is served again
+        st2 = StopTimeUpdate({"id": "sa:2"}, None, None, order=1)
+        vj.stop_time_updates.append(st2)
+        st3 = StopTimeUpdate({"id": "sa:1"}, None, None, order=2)
+        vj.stop_time_updates.append(st3)
+        assert vj.find_stop("sa:2") == st2
+        assert vj.find_stop("sa:1", 2) == st3
+        assert vj.find_stop("sa:1", 0) == st1
+        assert vj.find_stop("sa:1") == st1
+
+        # same StopTimeUpdates in a new order
+        vj.stop_time_updates = [st3, st2, st1]
+        assert vj.find_stop("sa:1") == st3
+
+        st4 = StopTimeUpdate({"id": "sa:4"}, None, None, order=0)
+        vj.stop_time_updates = [st4]
+        assert vj.find_stop("sa:1") is None
+        assert vj.find_stop("sa:4", 0) == st4
+
+        vj.stop_time_updates = []
+        assert vj.find_stop("sa:4") is None
+
+
+def test_find_stop_index():
+    """
+    Search all stops of a long VJ as merge() does:
+    the index of stops is built once and reused for each search, instead of scanning the stops
+    """
+    nb_stops = 1000
+    with app.app_context():
+        vj = create_trip_update(
+            "70866ce8-0638-4fa1-8556-1ddfa22d09d3", "vj1", datetime.date(2015, 9, 8), COTS_CONTRIBUTOR_ID
+        )
+        # every stop is served twice (lollipop)
+        for order in range(nb_stops):
+            vj.stop_time_updates.append(
+                StopTimeUpdate({"id": "sa:{}".format(order % (nb_stops // 2))}, None, None, order=order)
+            )
+
+        stop_index = vj._get_stop_index()
+        assert len(stop_index) == nb_stops // 2
+        assert [st.order for st in stop_index["sa:0"]] == [0, nb_stops // 2]
+        for order in range(nb_stops):
+            st = vj.find_stop("sa:{}".format(order % (nb_stops // 2)), order)
+            assert st.order == order
+        assert vj._get_stop_index() is stop_index
+
+        # modifying the stops resets the index
+        vj.stop_time_updates = vj.stop_time_updates[:1]
+        assert vj.find_stop("sa:1") is None
+        assert vj._get_stop_index() is not stop_index
+
+
+def test_vj_stop_time_positions():
+    navitia_vj = {
+        "trip": {"id": "vj1"},
+        "stop_times": [
+            {
+                "utc_arrival_time": datetime.time(8, 0),
+                "stop_point": {"id": "sp:1", "codes": [{"type": "source", "value": "s1"}]},
+            },
+            {
+                "utc_arrival_time": datetime.time(9, 0),
+                "stop_point": {"id": "sp:2", "codes": [{"type": "source", "value": "s2"}]},
+            },
+            {
+                "utc_arrival_time": datetime.time(10, 0),
+                "stop_point": {
+                    "id": "sp:1",
+                    "codes": [{"type": "source", "value": "s1"}, {"type": "source", "value": "other"}],
+                },
+            },
+        ],
+    }
+    vj = VehicleJourney(navitia_vj, datetime.datetime(2015, 9, 8, 7, 0), datetime.datetime(2015, 9, 8, 9, 0))
+
+    # lollipop: sp:1 is served twice
+    assert vj.get_stop_time_positions("sp:1") == [0, 2]
+    assert vj.get_stop_time_positions("sp:2") == [1]
+    assert vj.get_stop_time_positions("sp:3") == []
+    assert vj.get_stop_time_positions("s1", code_type="source") == [0, 2]
+    # only the first code of a given type is considered
+    assert vj.get_stop_time_positions("other", code_type="source") == []
+    assert vj.get_stop_time_positions("s1", code_type="uic") == []
+
+    assert vj.find_navitia_stop_time("sp:1") is navitia_vj["stop_times"][0]
+    assert vj.find_navitia_stop_time("sp:1", 2) is navitia_vj["stop_times"][2]
+    assert vj.find_navitia_stop_time("sp:1", 1) is navitia_vj["stop_times"][0]
+    assert vj.find_navitia_stop_time("sp:2") is navitia_vj["stop_times"][1]
+    assert vj.find_navitia_stop_time("sp:3") is None
+
+
 def test_find_activate():
     with app.app_context():
         create_rt_update_and_trip_update(
@@ -410,6 +531,54 @@ def test_find_activate():
         assert len(rtu) == 2
 
 
+def _explain(query):
+    compiled = query.statement.compile(dialect=db.engine.dialect)
+    rows = db.session.connection().execute("EXPLAIN " + str(compiled), compiled.params)
+    return "\n".join(row[0] for row in rows)
+
+
+def test_find_by_contributor_period_plan():
+    """
+    The selection of TripUpdates by contributor and period, as done for the full feed and the purge,
+    should use the index on (contributor_id, start_timestamp)
+    """
+    with app.app_context():
+        # TripUpdates of both contributors, starting on 100 days
+        db.session.execute(
+            """
+            INSERT INTO vehicle_journey (id, navitia_trip_id, start_timestamp)
+            SELECT md5(i::text)::uuid, 'vehicle_journey:' || i,
+                timestamp '2015-09-01 08:00' + (i % 100) * interval '1 day'
+            FROM generate_series(1, 10000) AS i;
+            INSERT INTO trip_update (vj_id, status, contributor_id, start_timestamp, created_at)
+            SELECT id, 'none', CASE WHEN i % 2 = 0 THEN :cots ELSE :gtfs END, start_timestamp, now()
+            FROM (SELECT id, start_timestamp, row_number() OVER () AS i FROM vehicle_journey) AS vj;
+            ANALYZE vehicle_journey;
+            ANALYZE trip_update;
+            SET LOCAL enable_seqscan = off;
+            """,
+            {"cots": COTS_CONTRIBUTOR_ID, "gtfs": GTFS_CONTRIBUTOR_ID},
+        )
+
+        full_feed_query = (
+            TripUpdate.filter_by_contributor_period(
+                db.session.query(TripUpdate.vj_id, TripUpdate.feed_entity),
+                [COTS_CONTRIBUTOR_ID],
+                datetime.date(2015, 9, 10),
+                datetime.date(2015, 9, 11),
+            )
+            .order_by(TripUpdate.vj_id)
+            .limit(1000)
+        )
+        purge_query = TripUpdate.filter_by_contributor_period(
+            db.session.query(TripUpdate.vj_id), [COTS_CONTRIBUTOR_ID], end_date=datetime.date(2015, 9, 3)
+        )
+        for query in [full_feed_query, purge_query]:
+            assert "trip_update_contributor_id_start_timestamp_idx" in _explain(query)
+
+        db.session.rollback()
+
+
 def test_update_stoptime():
     with app.app_context():
         st = StopTimeUpdate(
@@ -0,0 +1,145 @@
+# coding=utf-8
+
+# Copyright (c) 2001, Canal TP and/or its affiliates. All rights reserved.
+#
+# This file is part of Navitia,
+#     the software to build cool stuff with public transport.
+#
+# Hope you'll enjoy and contribute to this project,
+#     powered by Canal TP (www.canaltp.fr).
+# Help us simplify mobility and open public transport:
+#     a non ending quest to the responsive locomotion way of traveling!
+#
+# LICENCE: This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Stay tuned using
+# twitter @navitia
+# [matrix] channel #navitia:matrix.org (https://app.element.io/#/room/#navitia:matrix.org)
+# https://groups.google.com/d/forum/navitia
+# www.navitia.io
+
+from __future__ import absolute_import, print_function, unicode_literals, division
+
+from kirin import app
+from kirin.core import navitia_referential
+from kirin.core.navitia_referential import get_navitia_referential, get_navitia_referentials_status
+
+
+class FakeNavitia(object):
+    url = "http://navitia/v1/coverage/sncf/"
+
+    def __init__(self, nb_stop_points):
+        self.publication_date = "20201116T100000"
+        self.nb_stop_points = nb_stop_points
+        self.queries = []
+
+    def get_publication_date(self):
+        return self.publication_date
+
+    def query(self, query, q=None):
+        self.queries.append(query)
+        objects = {
+            "companies/": [{"id": "company:SN", "codes": [{"type": "source", "value": "1187"}]}],
+            "physical_modes/": [{"id": "physical_mode:Coach"}, {"id": "physical_mode:LongDistanceTrain"}],
+            "stop_points/": [
+                {
+                    "id": "stop_point:{}".format(i),
+                    "stop_area": {
+                        "id": "stop_area:{}".format(i),
+                        "codes": [{"type": "source", "value": str(i)}],
+                    },
+                }
+                for i in range(self.nb_stop_points)
+            ],
+        }[query]
+        count = int(q["count"])
+        start_page = int(q["start_page"])
+        return (
+            {
+                query[:-1]: objects[start_page * count : (start_page + 1) * count],
+                "pagination": {"total_result": len(objects), "start_page": start_page, "items_per_page": count},
+            },
+            200,
+        )
+
+
+def _no_fallback():
+    raise AssertionError("navitia should not be requested for a single object")
+
+
+def test_navitia_referential(monkeypatch):
+    monkeypatch.setattr(navitia_referential, "NAVITIA_REFERENTIAL_PAGE_SIZE", 2)
+    monkeypatch.setitem(app.config, str("NAVITIA_REFERENTIAL_CHECK_INTERVAL"), 0)
+    navitia = FakeNavitia(nb_stop_points=5)
+    with app.app_context():
+        referential = get_navitia_referential(navitia)
+        # the referential is loaded in the background: navitia is requested in the meantime
+        assert referential.find_company("source", "1187", lambda: {"id": "company:SN"})["id"] == "company:SN"
+        referential.load_thread.join()
+        assert referential.is_loaded
+
+        assert referential.find_company("source", "1187", _no_fallback)["id"] == "company:SN"
+        # navitia is requested for objects missing in the referential
+        assert referential.find_company("source", "1180", lambda: {"id": "company:new"})["id"] == "company:new"
+        assert referential.find_physical_mode("physical_mode:Coach", _no_fallback)["id"] == "physical_mode:Coach"
+        # stop_points are downloaded page by page
+        for i in range(5):
+            stop_point = referential.find_stop_point_by_stop_area_code("source", str(i), _no_fallback)
+            assert stop_point["id"] == "stop_point:{}".format(i)
+        assert navitia.queries.count("stop_points/") == 3
+        assert get_navitia_referential(navitia) is referential
+        assert get_navitia_referentials_status()[navitia.url]["nb_hits"] == 7
+        assert get_navitia_referentials_status()[navitia.url]["nb_misses"] == 2
+
+        # referential is reloaded only when navitia's publication date changes
+        referential.find_company("source", "1187", _no_fallback)
+        assert navitia.queries.count("companies/") == 1
+        navitia.publication_date = "20201117T100000"
+        navitia.nb_stop_points = 6
+        # the previous referential is used while the new one is loading
+        stop_point = referential.find_stop_point_by_stop_area_code("source", "5", lambda: {"id": "stop_point:5"})
+        assert stop_point["id"] == "stop_point:5"
+        referential.load_thread.join()
+        assert navitia.queries.count("companies/") == 2
+        assert referential.publication_date == "20201117T100000"
+        assert referential.find_stop_point_by_stop_area_code("source", "5", _no_fallback)["id"] == "stop_point:5"
+
+
+def test_navitia_referential_fallback():
+    class BrokenNavitia(FakeNavitia):
+        def query(self, query, q=None):
+            return {"message": "no region"}, 404
+
+    with app.app_context():
+        referential = get_navitia_referential(BrokenNavitia(nb_stop_points=0))
+        # objects are requested one by one when the referential can't be loaded
+        assert referential.find_company("source", "1187", lambda: {"id": "company:SN"})["id"] == "company:SN"
+        referential.load_thread.join()
+        assert not referential.is_loaded
+        assert referential.find_company("source", "1187", lambda: {"id": "company:SN"})["id"] == "company:SN"
+        assert referential.nb_misses == 2
+
+
+def test_navitia_publication_date_is_cached():
+    navitia = FakeNavitia(nb_stop_points=0)
+    with app.app_context():
+        referential = get_navitia_referential(navitia)
+        assert referential.get_publication_date() == "20201116T100000"
+        # navitia is requested again only once NAVITIA_REFERENTIAL_CHECK_INTERVAL is elapsed
+        navitia.publication_date = "20201117T100000"
+        assert referential.get_publication_date() == "20201116T100000"
+        referential.navitia_publication_date_checked_at = None
+        assert referential.get_publication_date() == "20201117T100000"
+        # the referential itself is not loaded for it
+        assert navitia.queries == []
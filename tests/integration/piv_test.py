@@ -45,12 +45,21 @@ from kirin.core.model import (
     VehicleJourney,
     DEFAULT_DAYS_TO_KEEP_TRIP_UPDATE,
     DEFAULT_DAYS_TO_KEEP_RT_UPDATE,
+    FeedOutbox,
 )
+from kirin.command.piv_worker import coalesce_messages, should_coalesce
+from kirin import gtfs_realtime_pb2
+from kirin.core.build_wrapper import wrap_build_batch
+from kirin.core.outbox import dispatch_outbox
+from kirin.core.populate_pb import make_feed_header, serialize_feed
 from kirin.core.types import ConnectorType, TripEffect, ModificationType
+from kirin.piv import KirinModelBuilder
+from kirin.piv.piv import get_piv_contributor
 from kirin.tasks import purge_trip_update, purge_rt_update
+from kirin.utils import save_superseded_rt_data
 from tests.check_utils import api_post, api_get, get_fixture_data_as_dict
 from tests import mock_navitia
-from tests.integration.conftest import PIV_CONTRIBUTOR_ID
+from tests.integration.conftest import PIV_CONTRIBUTOR_ID, COTS_CONTRIBUTOR_ID
 
 ModificationTuple = namedtuple("ModificationTuple", ["statut", "motif"])
 DisruptionTuple = namedtuple("DisruptionTuple", ["type", "texte"])
@@ -926,6 +935,156 @@ def test_piv_delayed_post_twice(mock_rabbitmq):
     assert mock_rabbitmq.call_count == 2
 
 
+def test_piv_batch(mock_rabbitmq):
+    """
+    a batch of PIV feeds is processed in a single transaction and published once,
+    each feed keeping its own RealTimeUpdate
+    """
+    piv_str = ujson.dumps(_get_stomp_20201022_23187_delayed_5min_fixture())
+    with app.app_context():
+        builder = KirinModelBuilder(get_piv_contributor(PIV_CONTRIBUTOR_ID))
+        wrap_build_batch(builder, [piv_str, "invalid json", piv_str])
+
+        rtus = RealTimeUpdate.query.order_by(RealTimeUpdate.created_at).all()
+        assert len(rtus) == 3
+        assert rtus[0].status == "OK"
+        assert rtus[0].error is None
+        assert rtus[1].status == "KO"
+        assert "invalid json" in rtus[1].error
+        assert rtus[1].trip_updates == []
+    _assert_db_stomp_20201022_23187_delayed_5min()
+    # a single feed is published for the whole batch
+    assert mock_rabbitmq.call_count == 1
+
+
+def test_piv_batch_error_after_rt_update_commit(mock_rabbitmq, monkeypatch):
+    """
+    an error raised once the RealTimeUpdate of a feed is committed (its SAVEPOINT released)
+    doesn't discard the feeds already processed in the batch
+    """
+    piv_str = ujson.dumps(_get_stomp_20201022_23187_delayed_5min_fixture())
+    with app.app_context():
+        builder = KirinModelBuilder(get_piv_contributor(PIV_CONTRIBUTOR_ID))
+        build_rt_update = builder.build_rt_update
+
+        def build_rt_update_then_fail(input_raw):
+            rt_update, log_dict = build_rt_update(input_raw)
+            if input_raw == "commit then fail":
+                raise Exception("failure after commit")
+            return rt_update, log_dict
+
+        monkeypatch.setattr(builder, "build_rt_update", build_rt_update_then_fail)
+        wrap_build_batch(builder, [piv_str, "commit then fail"])
+
+        rtus = RealTimeUpdate.query.order_by(RealTimeUpdate.created_at).all()
+        assert rtus[0].raw_data == piv_str
+        assert rtus[0].status == "OK"
+    _assert_db_stomp_20201022_23187_delayed_5min()
+    assert mock_rabbitmq.call_count == 1
+
+
+def test_piv_coalesce_superseded_messages(mock_rabbitmq):
+    """
+    only the last message of each train of a batch is processed, the others are stored as superseded
+    """
+    first_piv_str = ujson.dumps(_get_stomp_20201022_23187_partial_delayed_fixture())
+    last_piv_str = ujson.dumps(_get_stomp_20201022_23187_delayed_5min_fixture())
+    # only when the worker is known to be late
+    assert should_coalesce(timedelta(seconds=60), min_lag=30)
+    assert not should_coalesce(timedelta(seconds=10), min_lag=30)
+    assert not should_coalesce(None, min_lag=30)
+    assert not should_coalesce(timedelta(seconds=60), min_lag=None)
+
+    bodies, superseded = coalesce_messages([first_piv_str, "invalid json", last_piv_str])
+    assert bodies == ["invalid json", last_piv_str]
+    assert superseded == [(first_piv_str, "2020-10-22:23187:1187:rail:regionalRail:FERRE")]
+
+    with app.app_context():
+        save_superseded_rt_data(superseded, ConnectorType.piv.value, PIV_CONTRIBUTOR_ID)
+        wrap_build_batch(KirinModelBuilder(get_piv_contributor(PIV_CONTRIBUTOR_ID)), bodies)
+
+        rtus = RealTimeUpdate.query.order_by(RealTimeUpdate.created_at).all()
+        assert [rtu.status for rtu in rtus] == ["superseded", "KO", "OK"]
+        assert rtus[0].raw_data == first_piv_str
+        assert rtus[0].error == "superseded by a newer message for 2020-10-22:23187:1187:rail:regionalRail:FERRE"
+        assert rtus[0].trip_updates == []
+    _assert_db_stomp_20201022_23187_delayed_5min()
+    assert mock_rabbitmq.call_count == 1
+
+
+def test_piv_feed_outbox(mock_rabbitmq, monkeypatch):
+    """
+    with the outbox, feeds are stored with the TripUpdates, then published by the dispatcher:
+    consecutive feeds of a contributor are published at once
+    """
+    monkeypatch.setitem(app.config, str("USE_FEED_OUTBOX"), True)
+    piv_str = ujson.dumps(_get_stomp_20201022_23187_partial_delayed_fixture())
+    res = api_post("/piv/{}".format(PIV_CONTRIBUTOR_ID), data=piv_str)
+    assert "PIV feed processed" in res.get("message")
+    piv_str = ujson.dumps(_get_stomp_20201022_23187_delayed_5min_fixture())
+    res = api_post("/piv/{}".format(PIV_CONTRIBUTOR_ID), data=piv_str)
+    assert "PIV feed processed" in res.get("message")
+    # no new information: no (empty) feed is enqueued
+    api_post("/piv/{}".format(PIV_CONTRIBUTOR_ID), check=False, data=piv_str)
+    assert mock_rabbitmq.call_count == 0
+
+    with app.app_context():
+        assert FeedOutbox.query.count() == 2
+        assert dispatch_outbox(batch_size=10) == 2
+        assert FeedOutbox.query.count() == 0
+        assert dispatch_outbox(batch_size=10) == 0
+    assert mock_rabbitmq.call_count == 1
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.ParseFromString(mock_rabbitmq.call_args[0][0])
+    assert len(feed.entity) == 1
+    _assert_db_stomp_20201022_23187_delayed_5min()
+
+
+def test_feed_outbox_removes_only_dispatched_feeds(mock_rabbitmq, monkeypatch):
+    """
+    a feed committed by a concurrent writer after the dispatcher locked its batch is kept for the next dispatch,
+    even with an id lower than the ones of the batch
+    """
+    with app.app_context():
+        feed_str = serialize_feed(make_feed_header(gtfs_realtime_pb2.FeedHeader.DIFFERENTIAL), [])
+        db.session.add_all([FeedOutbox(PIV_CONTRIBUTOR_ID, feed_str) for _ in range(2)])
+        db.session.commit()
+
+        lock_next = FeedOutbox.lock_next
+
+        def _lock_next_then_concurrent_commit(limit):
+            outbox_feeds = lock_next(limit)
+            late_feed = FeedOutbox(PIV_CONTRIBUTOR_ID, feed_str)
+            late_feed.id = 0
+            db.session.add(late_feed)
+            db.session.flush()
+            return outbox_feeds
+
+        monkeypatch.setattr(FeedOutbox, "lock_next", staticmethod(_lock_next_then_concurrent_commit))
+        assert dispatch_outbox(batch_size=10) == 2
+        assert [outbox_feed.id for outbox_feed in FeedOutbox.query.all()] == [0]
+
+
+def test_feed_outbox_writers_lock_is_per_contributor():
+    """
+    writers of a contributor's feeds only wait for the other writers of the same contributor
+    """
+    with app.app_context():
+        FeedOutbox.lock_writers(PIV_CONTRIBUTOR_ID)
+        with db.engine.connect() as other_connection:
+            with other_connection.begin():
+
+                def _try_lock_writers(contributor_id):
+                    return other_connection.execute(
+                        "SELECT pg_try_advisory_xact_lock(%s, hashtext(%s))",
+                        (FeedOutbox.WRITERS_LOCK_NAMESPACE, contributor_id),
+                    ).scalar()
+
+                assert not _try_lock_writers(PIV_CONTRIBUTOR_ID)
+                assert _try_lock_writers(COTS_CONTRIBUTOR_ID)
+        db.session.rollback()
+
+
 def test_piv_partial_delayed_then_delayed(mock_rabbitmq):
     """
     partial delayed stops post
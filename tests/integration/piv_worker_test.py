@@ -40,7 +40,9 @@ from tests.integration.conftest import PIV_CONTRIBUTOR_ID, PIV_EXCHANGE_NAME, PI
 from amqp.exceptions import NotFound
 from kombu import Connection, Exchange, Queue
 import pytest
+import socket
 import threading
+import time
 from retrying import retry
 
 
@@ -147,3 +149,44 @@ def test_mq_message_received_and_stored(
         # Check that MQ message is received and stored in DB
         mq_handler.publish(str('{"key": "Some valid JSON"}'), PIV_CONTRIBUTOR_ID)
         wait_until(lambda: RealTimeUpdate.query.count() == 1)
+
+
+def test_rabbitmq_handler_publish_with_confirms(rabbitmq_docker_fixture, broker_connection):
+    handler = rabbitmq_docker_fixture.create_rabbitmq_handler("kirin_confirms", "fanout")
+    queue = Queue("kirin_confirms_queue", exchange=Exchange("kirin_confirms", type="fanout", no_declare=True))
+    # declares the exchange, once
+    handler.publish(str("first"), PIV_CONTRIBUTOR_ID)
+    queue(broker_connection.channel()).declare()
+
+    # publications are pipelined, then confirmed at once
+    for i in range(3):
+        handler.publish(str("pipelined {}".format(i)), PIV_CONTRIBUTOR_ID, wait_for_confirm=False)
+    handler.wait_for_confirms()
+    publisher_info = handler.info()["publisher"]
+    assert publisher_info["nb_published"] == 4
+    assert publisher_info["nb_in_flight"] == 0
+
+    # the publication connection is reopened transparently
+    handler._publish_connection.release()
+    handler.publish(str("after reconnection"), PIV_CONTRIBUTOR_ID)
+
+    bound_queue = queue(broker_connection.channel())
+    bodies = []
+    message = bound_queue.get(no_ack=True)
+    while message:
+        bodies.append(message.body)
+        message = bound_queue.get(no_ack=True)
+    assert bodies == ["pipelined 0", "pipelined 1", "pipelined 2", "after reconnection"]
+
+
+def test_rabbitmq_handler_reports_publications_lost_with_connection(rabbitmq_docker_fixture):
+    handler = rabbitmq_docker_fixture.create_rabbitmq_handler("kirin_confirms", "fanout")
+    handler.publish(str("first"), PIV_CONTRIBUTOR_ID, wait_for_confirm=False)
+    # the connection is lost before the confirmation of the publication
+    handler._unconfirmed[handler._last_delivery_tag] = time.time()
+    handler._reset_producer()
+    handler.publish(str("after reconnection"), PIV_CONTRIBUTOR_ID, wait_for_confirm=False)
+    with pytest.raises(socket.error):
+        handler.wait_for_confirms()
+    # reported once
+    handler.wait_for_confirms()
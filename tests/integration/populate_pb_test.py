@@ -32,7 +32,13 @@ from __future__ import absolute_import, print_function, unicode_literals, divisi
 from datetime import timedelta
 
 from kirin.core.model import TripUpdate, VehicleJourney, StopTimeUpdate
-from kirin.core.populate_pb import convert_to_gtfsrt, to_posix_time, fill_stop_times
+from kirin.core.populate_pb import (
+    convert_to_gtfsrt,
+    to_posix_time,
+    fill_stop_times,
+    cache_feed_entities,
+    convert_to_full_gtfsrt_str,
+)
 import datetime
 from kirin import app, db
 from kirin import gtfs_realtime_pb2, kirin_pb2
@@ -434,6 +440,56 @@ def test_populate_pb_with_full_dataset():
         assert len(feed_entity.entity[0].trip_update.stop_time_update) == 0
 
 
+def test_full_dataset_from_stored_feed_entities():
+    """
+    the full feed is built from the FeedEntities stored in TripUpdates, TripUpdates without one are converted
+    """
+    with app.app_context():
+        real_time_update = make_rt_update(
+            raw_data=None, connector_type=ConnectorType.cots.value, contributor_id=COTS_CONTRIBUTOR_ID
+        )
+        for trip_id, start_hour in (("vehicle_journey:1", 8), ("vehicle_journey:2", 9)):
+            navitia_vj = {
+                "trip": {"id": trip_id},
+                "stop_times": [{"utc_arrival_time": datetime.time(start_hour)}],
+            }
+            vj = VehicleJourney(
+                navitia_vj, datetime.datetime(2015, 9, 8, 7, 0, 0), datetime.datetime(2015, 9, 8, 10, 0, 0)
+            )
+            trip_update = TripUpdate(vj=vj, contributor_id=COTS_CONTRIBUTOR_ID, status="delete")
+            real_time_update.trip_updates.append(trip_update)
+        db.session.flush()
+        cache_feed_entities(real_time_update.trip_updates[:1])
+        db_commit(real_time_update)
+
+        feed_str, trip_update_count = convert_to_full_gtfsrt_str([COTS_CONTRIBUTOR_ID])
+        assert trip_update_count == 2
+        feed = gtfs_realtime_pb2.FeedMessage()
+        feed.ParseFromString(feed_str)
+        assert feed.header.incrementality == gtfs_realtime_pb2.FeedHeader.FULL_DATASET
+        expected_feed = convert_to_gtfsrt(
+            real_time_update.trip_updates, gtfs_realtime_pb2.FeedHeader.FULL_DATASET
+        )
+        assert sorted(e.SerializeToString() for e in feed.entity) == sorted(
+            e.SerializeToString() for e in expected_feed.entity
+        )
+
+        # TripUpdates are read and converted by chunks: the feed doesn't depend on the chunk size
+        chunked_feed_str, trip_update_count = convert_to_full_gtfsrt_str([COTS_CONTRIBUTOR_ID], chunk_size=1)
+        assert trip_update_count == 2
+        chunked_feed = gtfs_realtime_pb2.FeedMessage()
+        chunked_feed.ParseFromString(chunked_feed_str)
+        assert sorted(e.SerializeToString() for e in chunked_feed.entity) == sorted(
+            e.SerializeToString() for e in feed.entity
+        )
+
+        # out of the requested period
+        feed_str, trip_update_count = convert_to_full_gtfsrt_str(
+            [COTS_CONTRIBUTOR_ID], start_date=datetime.date(2015, 9, 9)
+        )
+        assert trip_update_count == 0
+
+
 def test_populate_pb_no_status_stop_times_status():
     st_no_status = StopTimeUpdate({"id": "id1"}, dep_status="none", arr_status="none")
     pb_stop_time = gtfs_realtime_pb2.TripUpdate.StopTimeUpdate()
@@ -0,0 +1,93 @@
+# coding=utf-8
+
+# Copyright (c) 2001, Canal TP and/or its affiliates. All rights reserved.
+#
+# This file is part of Navitia,
+#     the software to build cool stuff with public transport.
+#
+# Hope you'll enjoy and contribute to this project,
+#     powered by Canal TP (www.canaltp.fr).
+# Help us simplify mobility and open public transport:
+#     a non ending quest to the responsive locomotion way of traveling!
+#
+# LICENCE: This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Stay tuned using
+# twitter @navitia
+# [matrix] channel #navitia:matrix.org (https://app.element.io/#/room/#navitia:matrix.org)
+# https://groups.google.com/d/forum/navitia
+# www.navitia.io
+
+
+from __future__ import absolute_import, print_function, unicode_literals, division
+
+from datetime import date, timedelta
+
+from kirin import app
+from kirin.core.model import db, Contributor, RealTimeUpdate, TripUpdate, VehicleJourney
+from kirin.core.retention import RetentionRateLimiter, purge_contributor_slice
+from kirin.core.types import ConnectorType
+from tests.integration.conftest import COTS_CONTRIBUTOR_ID
+from tests.integration.utils_test import create_rt_update_and_trip_update
+
+
+def test_retention_rate_limiter():
+    rate_limiter = RetentionRateLimiter(
+        min_batch_size=10, max_batch_size=30, target_duration=0.2, max_replication_lag=5, interval=1
+    )
+    assert rate_limiter.batch_size == 10
+
+    # fast slices: bigger slices, up to the max
+    assert rate_limiter.update(0.1, replication_lag=0) == 1
+    assert rate_limiter.batch_size == 20
+    rate_limiter.update(0.1)
+    rate_limiter.update(0.1)
+    assert rate_limiter.batch_size == 30
+
+    # slow slices or lagging replicas: smaller slices and longer pauses
+    assert rate_limiter.update(0.5, replication_lag=0) == 2
+    assert rate_limiter.batch_size == 15
+    assert rate_limiter.update(0.1, replication_lag=10) == 4
+    assert rate_limiter.batch_size == 10
+
+    assert rate_limiter.update(0.1, replication_lag=0) == 1
+    assert rate_limiter.batch_size == 20
+
+
+def test_purge_contributor_slice(mock_rabbitmq):
+    with app.app_context():
+        contributor = Contributor.query.get(COTS_CONTRIBUTOR_ID)
+        for i in range(3):
+            create_rt_update_and_trip_update(
+                "70866ce8-0638-4fa1-8556-1ddfa22d0a0{}".format(i),
+                COTS_CONTRIBUTOR_ID,
+                ConnectorType.cots.value,
+                "70866ce8-0638-4fa1-8556-1ddfa22d090{}".format(i),
+                "trip:{}".format(i),
+                date.today() - timedelta(days=contributor.nb_days_to_keep_trip_update + 1),
+            )
+        db.session.commit()
+        for rtu in RealTimeUpdate.query.all():
+            rtu.created_at = date.today() - timedelta(days=contributor.nb_days_to_keep_rt_update + 1)
+        db.session.commit()
+
+        # RealTimeUpdates are purged once the TripUpdates they are associated to are purged
+        assert purge_contributor_slice(contributor, batch_size=2) == 4
+        assert TripUpdate.query.count() == 1
+        assert RealTimeUpdate.query.count() == 1
+        assert purge_contributor_slice(contributor, batch_size=2) == 2
+        assert TripUpdate.query.count() == 0
+        assert VehicleJourney.query.count() == 0
+        assert RealTimeUpdate.query.count() == 0
+        assert purge_contributor_slice(contributor, batch_size=2) == 0
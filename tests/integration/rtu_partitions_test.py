@@ -0,0 +1,148 @@
+# coding=utf-8
+
+# Copyright (c) 2001, Canal TP and/or its affiliates. All rights reserved.
+#
+# This file is part of Navitia,
+#     the software to build cool stuff with public transport.
+#
+# Hope you'll enjoy and contribute to this project,
+#     powered by Canal TP (www.canaltp.fr).
+# Help us simplify mobility and open public transport:
+#     a non ending quest to the responsive locomotion way of traveling!
+#
+# LICENCE: This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Stay tuned using
+# twitter @navitia
+# [matrix] channel #navitia:matrix.org (https://app.element.io/#/room/#navitia:matrix.org)
+# https://groups.google.com/d/forum/navitia
+# www.navitia.io
+
+
+from __future__ import absolute_import, print_function, unicode_literals, division
+
+import datetime
+import os
+from contextlib import closing
+
+import flask_migrate
+import pytest
+
+from kirin import app
+from kirin.core.model import db, Contributor, RealTimeUpdate
+from kirin.core.rtu_partitions import (
+    DEFAULT_PARTITION_NAME,
+    get_daily_partition_name,
+    get_legacy_partition_name,
+    get_partition_upper_bound,
+    get_real_time_update_partitions,
+    get_real_time_update_retention_limit,
+    is_real_time_update_partitioned,
+    create_real_time_update_partitions,
+    drop_expired_real_time_update_partitions,
+    partition_real_time_update,
+)
+from kirin.core.types import ConnectorType
+from tests.docker_wrapper import postgres_docker
+
+
+@pytest.yield_fixture
+def pg11_db(monkeypatch):
+    """
+    real_time_update can only be partitioned with PostgreSQL >= 11 (the common test database is older):
+    a dedicated database is started and migrated for the test
+    """
+    with closing(
+        postgres_docker(postgres_image="postgres:11", container_name="kirin_test_postgres_11")
+    ) as pg_db:
+        monkeypatch.setitem(app.config, str("SQLALCHEMY_DATABASE_URI"), pg_db.get_db_params().cnx_string())
+        with app.app_context():
+            migration_dir = os.path.join(os.path.dirname(__file__), "..", "..", "migrations")
+            flask_migrate.upgrade(directory=migration_dir)
+            db.session.add(Contributor("rt.partitioned", "sncf", ConnectorType.piv.value))
+            db.session.commit()
+        yield
+        with app.app_context():
+            db.session.remove()
+            db.get_engine().dispose()
+
+
+def test_partition_bounds():
+    day = datetime.date(2015, 9, 8)
+    assert get_daily_partition_name(day) == "real_time_update_p20150908"
+    assert get_partition_upper_bound(get_daily_partition_name(day)) == datetime.date(2015, 9, 9)
+    assert get_legacy_partition_name(day) == "real_time_update_before_20150908"
+    assert get_partition_upper_bound(get_legacy_partition_name(day)) == day
+    assert get_partition_upper_bound("real_time_update_other") is None
+
+
+def test_not_partitioned_real_time_update():
+    with app.app_context():
+        assert not is_real_time_update_partitioned()
+        assert drop_expired_real_time_update_partitions() == []
+
+
+def test_retention_limit_of_all_contributors():
+    with app.app_context():
+        for i, contributor in enumerate(Contributor.query.all()):
+            contributor.nb_days_to_keep_rt_update = i + 1
+        db.session.commit()
+        nb_contributors = Contributor.query.count()
+
+        assert get_real_time_update_retention_limit() == datetime.date.today() - datetime.timedelta(
+            days=nb_contributors
+        )
+
+
+def _count_rows(table_name):
+    return db.session.execute("SELECT count(*) FROM {}".format(table_name)).scalar()
+
+
+def test_partition_real_time_update(pg11_db):
+    def _make_rt_update(created_at):
+        rt_update = RealTimeUpdate("", ConnectorType.piv.value, "rt.partitioned")
+        rt_update.created_at = created_at
+        return rt_update
+
+    with app.app_context():
+        # RealTimeUpdates created on previous days and earlier today
+        now = datetime.datetime.utcnow()
+        db.session.add_all([_make_rt_update(now - datetime.timedelta(days=2)), _make_rt_update(now)])
+        db.session.commit()
+
+        partition_real_time_update(nb_days_ahead=2)
+        assert is_real_time_update_partitioned()
+        tomorrow = now.date() + datetime.timedelta(days=1)
+        legacy_partition = get_legacy_partition_name(tomorrow)
+        assert set(get_real_time_update_partitions()) == {
+            legacy_partition,
+            get_daily_partition_name(tomorrow),
+            get_daily_partition_name(tomorrow + datetime.timedelta(days=1)),
+            DEFAULT_PARTITION_NAME,
+        }
+        assert _count_rows(legacy_partition) == 2
+        assert RealTimeUpdate.query.count() == 2
+
+        # RealTimeUpdates are still inserted when their partition is not created (yet)
+        later = now + datetime.timedelta(days=5)
+        db.session.add_all([_make_rt_update(now), _make_rt_update(later)])
+        db.session.commit()
+        assert _count_rows(legacy_partition) == 3
+        assert _count_rows(DEFAULT_PARTITION_NAME) == 1
+
+        # they are moved to their partition once it is created
+        assert get_daily_partition_name(later.date()) in create_real_time_update_partitions(nb_days_ahead=5)
+        assert _count_rows(get_daily_partition_name(later.date())) == 1
+        assert _count_rows(DEFAULT_PARTITION_NAME) == 0
+        assert RealTimeUpdate.query.count() == 4
@@ -0,0 +1,151 @@
+# coding=utf-8
+
+# Copyright (c) 2001, Canal TP and/or its affiliates. All rights reserved.
+#
+# This file is part of Navitia,
+#     the software to build cool stuff with public transport.
+#
+# Hope you'll enjoy and contribute to this project,
+#     powered by Canal TP (www.canaltp.fr).
+# Help us simplify mobility and open public transport:
+#     a non ending quest to the responsive locomotion way of traveling!
+#
+# LICENCE: This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Stay tuned using
+# twitter @navitia
+# [matrix] channel #navitia:matrix.org (https://app.element.io/#/room/#navitia:matrix.org)
+# https://groups.google.com/d/forum/navitia
+# www.navitia.io
+
+
+from __future__ import absolute_import, print_function, unicode_literals, division
+
+import datetime
+import os
+
+from kirin import app
+from kirin.core.model import Contributor
+from kirin.core.schedule_snapshot import ScheduleSnapshot, get_schedule_snapshot, write_schedule_snapshot
+from kirin.core.types import ConnectorType
+from kirin.core.vj_prefetcher import VehicleJourneysIndex
+
+
+class FakeNavitia(object):
+    def __init__(self, publication_date):
+        self.publication_date = publication_date
+
+    def get_publication_date(self):
+        return self.publication_date
+
+
+def _make_vjs_index():
+    index = VehicleJourneysIndex(
+        datetime.datetime(2015, 9, 7), datetime.datetime(2015, 9, 10), publication_date="20150901T100000"
+    )
+    vj_1 = {
+        "id": "vj:1",
+        "headsign": "6111",
+        "codes": [{"type": "rt_piv", "value": "2015-09-08:6111"}],
+        "stop_times": [{"utc_arrival_time": None, "utc_departure_time": datetime.time(8, 0)}],
+    }
+    vj_2 = {
+        "id": "vj:2",
+        "headsign": "6113",
+        "codes": [],
+        "stop_times": [
+            {"utc_arrival_time": datetime.time(22, 0)},
+            {"utc_arrival_time": datetime.time(23, 0), "headsign": "6114"},
+        ],
+    }
+    for day in (7, 8, 9):
+        index.add(datetime.date(2015, 9, day), vj_1)
+    index.add(datetime.date(2015, 9, 8), vj_2)
+    return index
+
+
+def test_schedule_snapshot(tmpdir):
+    path = os.path.join(str(tmpdir), "rt.piv.snapshot")
+    stop_point = {"id": "stop_point:1", "stop_area": {"codes": [{"type": "source", "value": "87001479"}]}}
+    write_schedule_snapshot(path, "sncf", _make_vjs_index(), {("source", "87001479"): stop_point})
+    assert not os.path.exists("{}.tmp".format(path))
+
+    snapshot = ScheduleSnapshot(path, "sncf")
+    vjs = snapshot.find_vjs(code=("rt_piv", "2015-09-08:6111"))
+    assert [vj["id"] for vj in vjs] == ["vj:1"]
+    # VJs are stored once, whatever their number of circulations and keys
+    assert vjs[0]["stop_times"][0]["utc_departure_time"] == datetime.time(8, 0)
+    since = datetime.datetime(2015, 9, 8, 7, 0)
+    until = datetime.datetime(2015, 9, 8, 23, 30)
+    assert [vj["id"] for vj in snapshot.find_vjs(since, until, headsign="6113")] == ["vj:2"]
+    # headsign changing along the way
+    assert [vj["id"] for vj in snapshot.find_vjs(since, until, headsign="6114")] == ["vj:2"]
+    # vj:2 doesn't run on 2015-09-09
+    since = datetime.datetime(2015, 9, 9, 7, 0)
+    until = datetime.datetime(2015, 9, 9, 23, 30)
+    assert [vj["id"] for vj in snapshot.find_vjs(since, until, headsign="6111")] == ["vj:1"]
+    assert snapshot.find_vjs(since, until, headsign="6113") is None
+    # out of the snapshot's window
+    assert snapshot.find_vjs(since, datetime.datetime(2015, 9, 10, 2, 0), headsign="6111") is None
+
+    assert snapshot.find_stop_point_by_stop_area_code("source", "87001479") == stop_point
+    assert snapshot.find_stop_point_by_stop_area_code("source", "87000000") is None
+    assert snapshot.nb_hits == 5
+    assert snapshot.nb_misses == 3
+
+
+def test_schedule_snapshot_of_contributor(tmpdir, monkeypatch):
+    contributor = Contributor("rt.piv", "sncf", ConnectorType.piv.value, "token")
+    with app.app_context():
+        assert get_schedule_snapshot(contributor) is None
+
+        monkeypatch.setitem(app.config, str("NAVITIA_SCHEDULE_SNAPSHOT_DIR"), str(tmpdir))
+        snapshot = get_schedule_snapshot(contributor)
+        assert get_schedule_snapshot(contributor) is snapshot
+        snapshot.navitia = FakeNavitia("20150901T100000")
+        # no snapshot written yet: the caller has to request navitia
+        assert snapshot.find_vjs(headsign="6111") is None
+
+        write_schedule_snapshot(os.path.join(str(tmpdir), "rt.piv.snapshot"), "sncf", _make_vjs_index(), {})
+        snapshot.checked_at = None
+        assert [vj["id"] for vj in snapshot.find_vjs(headsign="6111")] == ["vj:1"]
+
+        # a snapshot of another coverage is not used
+        contributor.navitia_coverage = "sncf_piv"
+        other_snapshot = get_schedule_snapshot(contributor)
+        assert other_snapshot is not snapshot
+        assert other_snapshot.find_vjs(headsign="6111") is None
+
+
+def test_stale_schedule_snapshot(tmpdir):
+    path = os.path.join(str(tmpdir), "rt.piv.snapshot")
+    write_schedule_snapshot(path, "sncf", _make_vjs_index(), {})
+    navitia = FakeNavitia("20150901T100000")
+    snapshot = ScheduleSnapshot(path, "sncf", navitia=navitia)
+    assert [vj["id"] for vj in snapshot.find_vjs(headsign="6111")] == ["vj:1"]
+
+    # new data published in navitia: the snapshot doesn't answer anymore, navitia has to be requested
+    navitia.publication_date = "20150902T100000"
+    snapshot.checked_at = None
+    assert snapshot.find_vjs(headsign="6111") is None
+    assert snapshot.get_status()["stale"]
+
+    # until a snapshot of the new data is written
+    index = _make_vjs_index()
+    index.publication_date = "20150902T100000"
+    write_schedule_snapshot(path, "sncf", index, {})
+    snapshot.mtime = None
+    snapshot.checked_at = None
+    assert [vj["id"] for vj in snapshot.find_vjs(headsign="6111")] == ["vj:1"]
+    assert not snapshot.get_status()["stale"]
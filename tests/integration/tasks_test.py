@@ -170,3 +170,46 @@ def test_no_purge(mock_rabbitmq):
         assert VehicleJourney.query.count() == 1
         assert db.session.execute("select * from associate_realtimeupdate_tripupdate").rowcount == 1
         assert RealTimeUpdate.query.count() == 1
+
+
+def test_purge_trip_update_by_batches(mock_rabbitmq, monkeypatch):
+    monkeypatch.setitem(app.config, str("PURGE_TRIP_UPDATE_BATCH_SIZE"), 2)
+    monkeypatch.setitem(app.config, str("PURGE_TRIP_UPDATE_SLEEP_RATIO"), 0)
+    with app.app_context():
+        for i in range(5):
+            vj_id = "70866ce8-0638-4fa1-8556-1ddfa22d090{}".format(i)
+            create_rt_update_and_trip_update(
+                "70866ce8-0638-4fa1-8556-1ddfa22d0a0{}".format(i),
+                COTS_CONTRIBUTOR_ID,
+                ConnectorType.cots.value,
+                vj_id,
+                "trip:{}".format(i),
+                date.today() - timedelta(days=DEFAULT_DAYS_TO_KEEP_TRIP_UPDATE + 1),
+            )
+            TripUpdate.query.get(vj_id).stop_time_updates.append(
+                StopTimeUpdate({"id": "sa:1"}, None, None, order=0)
+            )
+        create_rt_update_and_trip_update(
+            "70866ce8-0638-4fa1-8556-1ddfa22d0a10",
+            COTS_CONTRIBUTOR_ID,
+            ConnectorType.cots.value,
+            VJ_ID,
+            TRIP_ID,
+            date.today(),
+        )
+        db.session.commit()
+        assert TripUpdate.query.count() == 6
+
+        config = {
+            "contributor": COTS_CONTRIBUTOR_ID,
+            "nb_days_to_keep": DEFAULT_DAYS_TO_KEEP_TRIP_UPDATE,
+        }
+        purge_trip_update(config)
+
+        # 5 TripUpdates deleted in 3 batches, with everything depending on them (only the recent one is kept)
+        assert TripUpdate.query.count() == 1
+        assert TripUpdate.query.first().vj_id == VJ_ID
+        assert VehicleJourney.query.count() == 1
+        assert StopTimeUpdate.query.count() == 0
+        assert db.session.execute("select * from associate_realtimeupdate_tripupdate").rowcount == 1
+        assert RealTimeUpdate.query.count() == 6
@@ -0,0 +1,119 @@
+# coding=utf-8
+
+# Copyright (c) 2001, Canal TP and/or its affiliates. All rights reserved.
+#
+# This file is part of Navitia,
+#     the software to build cool stuff with public transport.
+#
+# Hope you'll enjoy and contribute to this project,
+#     powered by Canal TP (www.canaltp.fr).
+# Help us simplify mobility and open public transport:
+#     a non ending quest to the responsive locomotion way of traveling!
+#
+# LICENCE: This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Stay tuned using
+# twitter @navitia
+# [matrix] channel #navitia:matrix.org (https://app.element.io/#/room/#navitia:matrix.org)
+# https://groups.google.com/d/forum/navitia
+# www.navitia.io
+
+from __future__ import absolute_import, print_function, unicode_literals, division
+
+import datetime
+
+from kirin import app
+from kirin.core import vj_prefetcher
+from kirin.core.model import Contributor
+from kirin.core.types import ConnectorType
+from kirin.core.vj_prefetcher import get_vj_prefetcher
+
+
+class FakeNavitia(object):
+    """
+    VJ "vj:1" (headsign 6111, starting at 8:00) runs everyday, "vj:2" (headsign 6113, starting at 22:00) only
+    on 2015-09-08
+    """
+
+    def __init__(self):
+        self.queries = []
+
+    def get_publication_date(self):
+        return "20150901T100000"
+
+    def vehicle_journeys(self, q):
+        self.queries.append(q)
+        vjs = [
+            {
+                "id": "vj:1",
+                "headsign": "6111",
+                "codes": [{"type": "rt_piv", "value": "2015-09-08:6111"}],
+                "stop_times": [{"utc_arrival_time": None, "utc_departure_time": datetime.time(8, 0)}],
+            }
+        ]
+        if q["since"] == "20150908T000000Z":
+            vjs.append(
+                {
+                    "id": "vj:2",
+                    "headsign": "6113",
+                    "codes": [],
+                    "stop_times": [
+                        {"utc_arrival_time": datetime.time(22, 0)},
+                        {"utc_arrival_time": datetime.time(23, 0), "headsign": "6114"},
+                    ],
+                }
+            )
+        # one VJ per page
+        return vjs[int(q["start_page"]) : int(q["start_page"]) + int(q["count"])]
+
+
+def test_vj_prefetcher(monkeypatch):
+    monkeypatch.setitem(app.config, str("NAVITIA_VJ_PREFETCH_CONTRIBUTORS"), ["rt.piv"])
+    monkeypatch.setattr(vj_prefetcher, "VJ_PREFETCH_PAGE_SIZE", 1)
+    contributor = Contributor("rt.piv", "sncf", ConnectorType.piv.value, "token")
+    with app.app_context():
+        assert get_vj_prefetcher(Contributor("rt.cots", "sncf", ConnectorType.cots.value)) is None
+        prefetcher = get_vj_prefetcher(contributor)
+        assert get_vj_prefetcher(contributor) is prefetcher
+        prefetcher.navitia = FakeNavitia()
+        # the index is not built yet: the caller has to request navitia
+        prefetcher.checked_at = datetime.datetime.utcnow()
+        assert prefetcher.find_vjs(code=("rt_piv", "2015-09-08:6111")) is None
+
+        prefetcher.build(datetime.datetime(2015, 9, 7), "20150901T100000")
+        # 3 days, with 1 page more than the number of VJs each day
+        assert len(prefetcher.navitia.queries) == 7
+
+        assert [vj["id"] for vj in prefetcher.find_vjs(code=("rt_piv", "2015-09-08:6111"))] == ["vj:1"]
+        since = datetime.datetime(2015, 9, 8, 7, 0)
+        until = datetime.datetime(2015, 9, 8, 23, 30)
+        assert [vj["id"] for vj in prefetcher.find_vjs(since, until, headsign="6111")] == ["vj:1"]
+        assert [vj["id"] for vj in prefetcher.find_vjs(since, until, headsign="6113")] == ["vj:2"]
+        # headsign changing along the way
+        assert [vj["id"] for vj in prefetcher.find_vjs(since, until, headsign="6114")] == ["vj:2"]
+        # vj:2 doesn't run on 2015-09-09
+        since = datetime.datetime(2015, 9, 9, 7, 0)
+        until = datetime.datetime(2015, 9, 9, 23, 30)
+        assert [vj["id"] for vj in prefetcher.find_vjs(since, until, headsign="6111")] == ["vj:1"]
+        assert prefetcher.find_vjs(since, until, headsign="6113") is None
+        # out of the prefetched window
+        since = datetime.datetime(2015, 9, 9, 22, 0)
+        until = datetime.datetime(2015, 9, 10, 2, 0)
+        assert prefetcher.find_vjs(since, until, headsign="6111") is None
+        assert prefetcher.nb_hits == 5
+        assert prefetcher.nb_misses == 3
+
+        # a change of navitia configuration of the contributor recreates the prefetcher
+        contributor.navitia_token = "new_token"
+        assert get_vj_prefetcher(contributor) is not prefetcher